@@ -1,107 +1,287 @@
 import anthropic
+import httpx
 import json
 import os
-from typing import Dict, Any
+from time import perf_counter
+from typing import Dict, Any, Iterator, Optional, Tuple
 from decimal import Decimal
-from prompts import INVOICE_EXTRACTION_PROMPT
+from metrics import span
+from page_content import PageContent, extraction_request, payload_bytes, response_usage
+from normalization import normalize_invoices
+from streaming_json import InvoiceStreamParser, parse_partial_response
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+# Message Batches limits: requests per batch and size of the create request
+MAX_BATCH_REQUESTS = 100_000
+MAX_BATCH_BYTES = 256 * 1024 * 1024
 
 class AnthropicClient:
-    def __init__(self):
+    def __init__(
+        self,
+        max_connections: int = 100,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+        max_retries: int = 2,
+        prompt_caching: bool = False,
+        tool_output: bool = False,
+        base_url: Optional[str] = None,
+    ):
+        """
+        Args:
+            prompt_caching (bool): Mark the static prompt as cacheable, so repeated
+                requests read it from the prompt cache instead of paying for it in full
+            tool_output (bool): Request the answer through the `record_invoices` tool
+                schema instead of free-form JSON
+            base_url (str): Send requests to this URL instead of the Anthropic API,
+                e.g. the local stand-in in replay_stub.py
+        """
+        # Load environment variables from .env file
+        load_dotenv()
         api_key = os.getenv('ANTHROPIC_API_KEY')
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY not found in environment variables. Please set it in your .env file.")
-        self.client = anthropic.Anthropic(api_key=api_key)
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self.client = anthropic.Anthropic(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=self.timeout,
+            max_retries=max_retries,
+            http_client=anthropic.DefaultHttpxClient(limits=self._pool_limits()),
+        )
+        self._async_client: Optional[anthropic.AsyncAnthropic] = None
         self.model = "claude-3-5-sonnet-20240620"
+        self.prompt_caching = prompt_caching
+        self.tool_output = tool_output
+        self.min_batch_requests = 1
+        self.max_batch_requests = MAX_BATCH_REQUESTS
+        self.max_batch_bytes = MAX_BATCH_BYTES
 
-    def _parse_numeric(self, value: str) -> float:
-        """Parse numeric values from strings, handling various formats."""
-        if not value or not isinstance(value, str):
-            return 0.0
-        try:
-            cleaned = "".join(c for c in value if c.isdigit() or c in ".-")
-            return float(cleaned)
-        except (ValueError, TypeError):
-            return 0.0
-
-    def _parse_line_items(self, items: list) -> list:
-        """Parse numeric values in line items."""
-        parsed_items = []
-        for item in items:
-            parsed_item = item.copy()
-            for field in ["quantity", "unit_price", "total"]:
-                if field in parsed_item and parsed_item[field] is not None:
-                    parsed_item[field] = self._parse_numeric(str(parsed_item[field]))
-                else:
-                    # Handle cases where a numeric field might be missing or None
-                    parsed_item[field] = 0.0 # Default to 0.0 or handle as appropriate
-            parsed_items.append(parsed_item)
-        return parsed_items
+    def _pool_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+        )
 
-    def extract_invoice_data(self, image_base64_list: list[str]) -> Dict[str, Any]:
-        """Extract invoice data from a list of images using Anthropic's Claude."""
-        try:
-            # Construct the content list with multiple images and the prompt
-            content_list = []
-            for image_data in image_base64_list:
-                content_list.append(
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": image_data,
-                        },
-                    }
-                )
-            content_list.append({"type": "text", "text": INVOICE_EXTRACTION_PROMPT})
-
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=4096, # Increased max_tokens for potentially longer multi-page documents
-                messages=[
-                    {
-                        "role": "user",
-                        "content": content_list, # Use the constructed content list
-                    }
-                ],
+    @property
+    def async_client(self) -> anthropic.AsyncAnthropic:
+        """AsyncAnthropic client sharing one connection pool, created on first use.
+
+        Its connections are bound to the event loop that first uses it.
+        """
+        if self._async_client is None:
+            self._async_client = anthropic.AsyncAnthropic(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+                http_client=anthropic.DefaultAsyncHttpxClient(limits=self._pool_limits()),
             )
+        return self._async_client
 
-            if response.content and isinstance(response.content, list) and len(response.content) > 0:
-                extracted_text = response.content[0].text
-            else:
-                print("Error: Unexpected response structure from Anthropic API.")
-                return None
-                
-            extracted_data = json.loads(extracted_text)
-
-            if "invoices" in extracted_data:
-                for invoice in extracted_data["invoices"]:
-                    invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "0")))
-                    invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "0")))
-                    invoice["payment_term_days"] = self._parse_numeric(str(invoice.get("payment_term_days", "0")))
-                    if "line_items" in invoice and isinstance(invoice["line_items"], list):
-                        invoice["line_items"] = self._parse_line_items(invoice["line_items"])
-                    else:
-                        invoice["line_items"] = []
-            else:
-                 extracted_data["invoices"] = []
+    @property
+    def model_key(self) -> str:
+        """Provider and model identifier used to key cached results."""
+        # Tool output uses a different prompt, so its results are kept apart
+        return f"anthropic:{self.model}" + (":tool" if self.tool_output else "")
 
-            return extracted_data
+    def _request_params(self, image_base64_list: list[PageContent]) -> Dict[str, Any]:
+        """Build the `messages.create` arguments shared by the sync and async calls."""
+        with span(
+            "request_build",
+            provider=self.model_key,
+            pages=len(image_base64_list),
+            payload_bytes=payload_bytes(image_base64_list),
+        ):
+            return {
+                "model": self.model,
+                "max_tokens": 4096, # Increased max_tokens for potentially longer multi-page documents
+                # The pages, followed by the prompt unless it is cached as the system prompt
+                **extraction_request(image_base64_list, self.prompt_caching, self.tool_output),
+            }
 
-        except anthropic.APIStatusError as e:
-            print(f"Anthropic API returned an error: {e.status_code} - {e.message}")
+    def _process_response(self, response) -> Optional[Dict[str, Any]]:
+        """Parse the model's JSON answer (or tool input) and normalize the numeric fields."""
+        if response.content and isinstance(response.content, list) and len(response.content) > 0:
+            with span("json_parse", provider=self.model_key):
+                tool_use = next((block for block in response.content if block.type == "tool_use"), None)
+                if tool_use is not None:
+                    extracted_data = dict(tool_use.input)
+                elif response.stop_reason == "max_tokens":
+                    # Cut off mid-answer: keep the invoices completed before the limit
+                    text = response.content[0].text
+                    extracted_data = parse_partial_response(text)
+                    if extracted_data is None:
+                        raise json.JSONDecodeError("Response cut off at max_tokens", text, 0)
+                else:
+                    extracted_data = json.loads(response.content[0].text)
+                if response.stop_reason == "max_tokens":
+                    # Tool input is cut off at the limit too, with the remaining invoices missing
+                    extracted_data["truncated"] = True
+        else:
+            print("Error: Unexpected response structure from Anthropic API.")
             return None
-        except anthropic.APIConnectionError as e:
+
+        with span("postprocess", provider=self.model_key) as attributes:
+            extracted_data["invoices"] = normalize_invoices(extracted_data.get("invoices") or [])
+            attributes["invoices"] = len(extracted_data["invoices"])
+
+        extracted_data["usage"] = response_usage(response.usage)
+        return extracted_data
+
+    def _report_error(self, e: Exception) -> None:
+        if isinstance(e, anthropic.APIStatusError):
+            print(f"Anthropic API returned an error: {e.status_code} - {e.message}")
+        elif isinstance(e, anthropic.APIConnectionError):
             print(f"Failed to connect to Anthropic API: {e}")
-            return None
-        except json.JSONDecodeError as e:
+        elif isinstance(e, json.JSONDecodeError):
             print(f"Error decoding JSON from Anthropic response: {e}")
-            print(f"Raw response text: {extracted_text if 'extracted_text' in locals() else 'N/A'}")
+            print(f"Raw response text: {e.doc}")
+        else:
+            print(f"An unexpected error occurred in Anthropic client: {str(e)}")
+
+    def classify_error(self, e: Exception) -> tuple[str, Optional[float]]:
+        """Classify a request error as "throttle", "transient" or "fatal".
+
+        Also returns the server's retry-after delay in seconds, if it sent one.
+        """
+        if isinstance(e, anthropic.APIStatusError):
+            headers = e.response.headers
+            retry_after = None
+            try:
+                if "retry-after-ms" in headers:
+                    retry_after = float(headers["retry-after-ms"]) / 1000
+                elif "retry-after" in headers:
+                    retry_after = float(headers["retry-after"])
+            except ValueError:
+                pass
+            # 529 is Anthropic's "overloaded" status
+            if e.status_code in (429, 529):
+                return "throttle", retry_after
+            if e.status_code >= 500:
+                return "transient", retry_after
+            return "fatal", None
+        if isinstance(e, anthropic.APIConnectionError):
+            return "transient", None
+        return "fatal", None
+
+    def extract_invoice_data(self, image_base64_list: list[PageContent], raise_errors: bool = False) -> Dict[str, Any]:
+        """Extract invoice data from a list of images using Anthropic's Claude.
+
+        Errors are printed and None is returned, unless `raise_errors` is set.
+        """
+        try:
+            params = self._request_params(image_base64_list)
+            with span("model_request", provider=self.model_key, pages=len(image_base64_list)) as attributes:
+                response = self.client.messages.create(**params)
+                attributes.update(response_usage(response.usage))
+            return self._process_response(response)
+        except Exception as e:
+            if raise_errors:
+                raise
+            self._report_error(e)
             return None
+
+    async def extract_invoice_data_async(
+        self, image_base64_list: list[PageContent], raise_errors: bool = False
+    ) -> Dict[str, Any]:
+        """Async variant of `extract_invoice_data` on the pooled AsyncAnthropic client.
+
+        Many documents can be awaited concurrently from one event loop; they
+        share up to `max_connections` keep-alive connections.
+        """
+        try:
+            params = self._request_params(image_base64_list)
+            with span("model_request", provider=self.model_key, pages=len(image_base64_list)) as attributes:
+                response = await self.async_client.messages.create(**params)
+                attributes.update(response_usage(response.usage))
+            return self._process_response(response)
         except Exception as e:
-            print(f"An unexpected error occurred in Anthropic client: {str(e)}")
-            return None 
\ No newline at end of file
+            if raise_errors:
+                raise
+            self._report_error(e)
+            return None
+
+    def extract_invoice_data_stream(
+        self, image_base64_list: list[PageContent]
+    ) -> Iterator[Tuple[str, Any]]:
+        """Stream the extraction, yielding results as soon as they are parsed.
+
+        Yields ("document_type", str) once the classification is known and
+        ("invoice", dict) for each invoice as soon as it is complete, then
+        always ends with ("result", dict or None) carrying the whole result.
+        If the stream breaks off or hits max_tokens, the invoices completed so
+        far are kept and the result is marked "truncated".
+        """
+        parser = InvoiceStreamParser()
+        usage = None
+        try:
+            params = self._request_params(image_base64_list)
+            start = perf_counter()
+            with span(
+                "model_request", provider=self.model_key, pages=len(image_base64_list), streaming=True
+            ) as attributes, self.client.messages.stream(**params) as stream:
+                for stream_event in stream:
+                    # Free-form JSON arrives as text, tool output as partial tool input JSON
+                    if stream_event.type == "text":
+                        text = stream_event.text
+                    elif stream_event.type == "input_json":
+                        text = stream_event.partial_json
+                    else:
+                        continue
+                    if "time_to_first_token" not in attributes:
+                        attributes["time_to_first_token"] = perf_counter() - start
+                    for event, value in parser.feed(text):
+                        if event == "invoice":
+                            normalize_invoices([value])
+                        yield event, value
+                final_message = stream.get_final_message()
+                usage = response_usage(final_message.usage)
+                attributes.update(usage)
+        except Exception as e:
+            self._report_error(e)
+
+        result = parser.result()
+        if result is not None and usage is not None:
+            result["usage"] = usage
+        yield "result", result
+
+    def batch_request(self, custom_id: str, image_base64_list: list[PageContent]) -> Dict[str, Any]:
+        """One Message Batches request extracting `image_base64_list`, as `submit_batch` takes it."""
+        return {"custom_id": custom_id, "params": self._request_params(image_base64_list)}
+
+    def submit_batch(self, requests: list[Dict[str, Any]]) -> str:
+        """Create a Message Batch from `batch_request` entries and return its ID.
+
+        Batches are billed at half the price of `messages.create` and do not
+        count against its rate limits, but take up to 24 hours to finish.
+        """
+        with span("batch_submit", provider=self.model_key, requests=len(requests)):
+            return self.client.messages.batches.create(requests=requests).id
+
+    def batch_status(self, batch_id: str) -> str:
+        """"in_progress" until the batch has ended and its results can be read, then "ended"."""
+        batch = self.client.messages.batches.retrieve(batch_id)
+        return "ended" if batch.processing_status == "ended" else "in_progress"
+
+    def batch_results(self, batch_id: str) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Yield (custom_id, extracted data) for every request of an ended batch.
+
+        Results go through the same post-processing as `extract_invoice_data`.
+        Failed requests are printed and yield None.
+        """
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type != "succeeded":
+                error = getattr(entry.result, "error", None)
+                print(f"Batch request {entry.custom_id} {entry.result.type}: {getattr(error, 'error', error)}")
+                yield entry.custom_id, None
+                continue
+            try:
+                extracted_data = self._process_response(entry.result.message)
+            except Exception as e:
+                self._report_error(e)
+                extracted_data = None
+            yield entry.custom_id, extracted_data
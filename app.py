@@ -1,11 +1,12 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-from bedrock_client import BedrockClient
-from anthropic_client import AnthropicClient
-from image_processor import get_image_from_pdf
-import base64
+from extraction import CHUNK_PAGES, EXTRACTED_DOCUMENT_TYPES, apply_triage
+from image_processor import get_pdf_page_images, kept_page_numbers, triage_pdf_pages
+from metrics import configure_from_env
+from result_cache import ExtractionCache, extract_invoice_data_cached, hash_pdf, result_model_key
 from io import BytesIO
+from typing import Optional
 
 st.set_page_config(
     page_title="Invoice Processing Platform", page_icon="📄", layout="wide"
@@ -34,6 +35,193 @@ st.markdown(
 
 st.title("📄 Invoice Processing Platform")
 
+@st.cache_resource
+def get_client(api_option: str):
+    """Build each API client once per process and share it across reruns.
+
+    The provider SDK is only imported once its client is first used.
+    """
+    if api_option == "Anthropic API":
+        from anthropic_client import AnthropicClient
+
+        return AnthropicClient()
+    from bedrock_client import BedrockClient
+
+    return BedrockClient()
+
+
+@st.cache_resource
+def get_cache() -> ExtractionCache:
+    """Shared cache of rendered pages and extraction results."""
+    return ExtractionCache()
+
+
+@st.cache_resource
+def configure_metrics():
+    """Set up the metrics sink from the environment once per process."""
+    return configure_from_env()
+
+
+configure_metrics()
+
+
+def render_preview(pdf_bytes: bytes) -> Optional[bytes]:
+    """JPEG of the first page, rendered on its own rather than with the whole document."""
+    try:
+        page_images = get_pdf_page_images(pdf_bytes, page_numbers=[0], max_workers=1)
+    except Exception as e:
+        print(f"Error rendering preview: {str(e)}")
+        return None
+    return page_images[0].data if page_images else None
+
+
+def render_invoice(idx: int, invoice: dict):
+    """Display one extracted invoice with its line items."""
+    st.markdown("---")
+    # Display extracted information in a clean layout
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.write(f"**Invoice Number:** {invoice.get('number', '')}")
+        st.write(f"**PO Number:** {invoice.get('po_number', '')}")
+        st.write(f"**Vendor:** {invoice.get('vendor', '')}")
+        st.write(f"**Invoice Date:** {invoice.get('date', '')}")
+        st.write(f"**Due Date:** {invoice.get('due_date', '')}")
+        st.write(
+            f"**Payment Terms:** {invoice.get('payment_terms', '')}"
+        )
+
+    with col2:
+        currency = invoice.get("currency_code", "")
+        amount = invoice.get("amount", "")
+        tax_amount = invoice.get("tax_amount", "")
+        st.write(f"**Currency:** {currency}")
+        if amount:
+            st.write(f"**Total Amount:** {float(amount):,.2f}")
+        else:
+            st.write(f"**Total Amount:**")
+        if tax_amount:
+            st.write(f"**Tax Amount:** {float(tax_amount):,.2f}")
+        else:
+            st.write(f"**Tax Amount:**")
+
+    # Display line items in a table
+    if "line_items" in invoice:
+        st.subheader("Line Items")
+        df = pd.DataFrame(invoice["line_items"])
+
+        # Convert numeric columns to float
+        numeric_columns = ["quantity", "unit_price", "total"]
+        for col in numeric_columns:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+
+        st.dataframe(
+            df,
+            column_config={
+                "description": "Description",
+                "quantity": st.column_config.NumberColumn(
+                    "Quantity", format="%.0f"
+                ),
+                "unit_price": st.column_config.NumberColumn(
+                    "Unit Price", format="%.2f"
+                ),
+                "total": st.column_config.NumberColumn(
+                    "Total", format="%.2f"
+                ),
+            },
+            hide_index=True,
+            use_container_width=True,
+        )
+
+        # Add a download button for the extracted data
+        st.download_button(
+            label="Download Invoice Data",
+            data=df.to_csv(index=False),
+            file_name=f"invoice_{invoice.get('number', 'unknown')}.csv",
+            mime="text/csv",
+            key=f"download_{idx}",
+            on_click="ignore",
+        )
+
+
+def render_warnings(extracted_data: dict):
+    if extracted_data.get("skipped_pages"):
+        st.info(
+            "Skipped pages: "
+            + "; ".join(
+                f"{page['page']} ({page['reason']}"
+                + (f" of page {page['duplicate_of']})" if "duplicate_of" in page else ")")
+                for page in extracted_data["skipped_pages"]
+            )
+        )
+    if extracted_data.get("possible_duplicates"):
+        st.info(
+            "Extracted pages that look like duplicates: "
+            + "; ".join(
+                f"{page['page']} (like page {page['duplicate_of']})"
+                for page in extracted_data["possible_duplicates"]
+            )
+        )
+    if extracted_data.get("failed_pages"):
+        st.warning(
+            "Extraction failed for pages "
+            f"{', '.join(map(str, extracted_data['failed_pages']))}; "
+            "the results below may be incomplete."
+        )
+    if extracted_data.get("validation_issues"):
+        st.warning(
+            "Some extracted values do not add up: "
+            + "; ".join(issue["detail"] for issue in extracted_data["validation_issues"])
+        )
+    if extracted_data.get("truncated"):
+        st.warning(
+            "The model's response ended early; showing the invoices received before it stopped."
+        )
+
+
+def render_extraction(extracted_data: dict):
+    """Display a complete extraction result."""
+    render_warnings(extracted_data)
+    # Display document type
+    st.subheader(
+        f"Document Type: {extracted_data.get('document_type', 'Unknown').upper()}"
+    )
+
+    # Only proceed if we have invoices to display
+    if extracted_data.get("document_type") in EXTRACTED_DOCUMENT_TYPES and extracted_data.get("invoices"):
+        for idx, invoice in enumerate(extracted_data["invoices"]):
+            render_invoice(idx, invoice)
+    else:
+        st.info("No invoice data to display for this document type.")
+
+
+def stream_extraction(client, image_base64_list: list):
+    """Extract with a streaming request, displaying each invoice as it arrives."""
+    header = st.empty()
+    header.subheader("Document Type: ...")
+    status = st.empty()
+    status.info("Processing document...")
+
+    extracted_data = None
+    invoice_count = 0
+    for event, value in client.extract_invoice_data_stream(image_base64_list):
+        if event == "document_type":
+            header.subheader(f"Document Type: {value.upper()}")
+        elif event == "invoice":
+            render_invoice(invoice_count, value)
+            invoice_count += 1
+        elif event == "result":
+            extracted_data = value
+    status.empty()
+
+    if extracted_data is not None:
+        render_warnings(extracted_data)
+        if not invoice_count:
+            st.info("No invoice data to display for this document type.")
+    return extracted_data
+
+
 # Add API selection
 api_option = st.radio(
     "Select API Provider",
@@ -42,11 +230,11 @@ api_option = st.radio(
     help="Choose which API to use for invoice processing"
 )
 
-# Initialize appropriate client
-if api_option == "Anthropic API":
-    client = AnthropicClient()
-else:
-    client = BedrockClient()
+# Results of this session keyed by (upload hash, provider) and first-page
+# previews keyed by upload hash, so reruns triggered by widgets are served
+# without rendering the PDF or calling the model again
+extractions = st.session_state.setdefault("extractions", {})
+previews = st.session_state.setdefault("previews", {})
 
 # File uploader
 uploaded_file = st.file_uploader("Upload an invoice (PDF)", type=["pdf"])
@@ -54,117 +242,77 @@ uploaded_file = st.file_uploader("Upload an invoice (PDF)", type=["pdf"])
 if uploaded_file is not None:
     try:
         # Read PDF content
-        pdf_bytes = uploaded_file.read()
-
-        # Convert PDF to image
-        with st.spinner("Converting PDF to images..."):
-            image_base64_list = get_image_from_pdf(pdf_bytes)
-
-            if not image_base64_list:
-                st.error("Failed to process the PDF or no images found. Please try again.")
-                st.stop()
-
-        # Show processing status
-        with st.spinner("Processing document..."):
-            # Extract data using the selected client
-            extracted_data = client.extract_invoice_data(image_base64_list)
-
-            if extracted_data is None:
-                st.error("Failed to extract data from the document. Please try again.")
-                st.stop()
-
-            # Create two columns for the main layout
-            preview_col, data_col = st.columns([0.4, 0.6])
-
-            # Display the processed image in the left column
-            with preview_col:
-                st.subheader("Document Preview (First Page)")
-                if image_base64_list:
-                    st.image(base64.b64decode(image_base64_list[0]), use_container_width=True)
-
-            # Display extracted data in the right column
-            with data_col:
-                # Display document type
-                st.subheader(
-                    f"Document Type: {extracted_data.get('document_type', 'Unknown').upper()}"
-                )
-
-                # Only proceed if we have invoices to display
-                if extracted_data.get("document_type") in [
-                    "invoice",
-                    "reminder",
-                    "credit_note",
-                ] and extracted_data.get("invoices"):
-                    for idx, invoice in enumerate(extracted_data["invoices"]):
-                        st.markdown("---")
-                        # Display extracted information in a clean layout
-                        col1, col2 = st.columns(2)
-
-                        with col1:
-                            st.write(f"**Invoice Number:** {invoice.get('number', '')}")
-                            st.write(f"**PO Number:** {invoice.get('po_number', '')}")
-                            st.write(f"**Vendor:** {invoice.get('vendor', '')}")
-                            st.write(f"**Invoice Date:** {invoice.get('date', '')}")
-                            st.write(f"**Due Date:** {invoice.get('due_date', '')}")
-                            st.write(
-                                f"**Payment Terms:** {invoice.get('payment_terms', '')}"
-                            )
-
-                        with col2:
-                            currency = invoice.get("currency_code", "")
-                            amount = invoice.get("amount", "")
-                            tax_amount = invoice.get("tax_amount", "")
-                            st.write(f"**Currency:** {currency}")
-                            if amount:
-                                st.write(f"**Total Amount:** {float(amount):,.2f}")
-                            else:
-                                st.write(f"**Total Amount:**")
-                            if tax_amount:
-                                st.write(f"**Tax Amount:** {float(tax_amount):,.2f}")
-                            else:
-                                st.write(f"**Tax Amount:**")
-
-                        # Display line items in a table
-                        if "line_items" in invoice:
-                            st.subheader("Line Items")
-                            df = pd.DataFrame(invoice["line_items"])
-
-                            # Convert numeric columns to float
-                            numeric_columns = ["quantity", "unit_price", "total"]
-                            for col in numeric_columns:
-                                if col in df.columns:
-                                    df[col] = pd.to_numeric(df[col], errors="coerce")
-
-                            st.dataframe(
-                                df,
-                                column_config={
-                                    "description": "Description",
-                                    "quantity": st.column_config.NumberColumn(
-                                        "Quantity", format="%.0f"
-                                    ),
-                                    "unit_price": st.column_config.NumberColumn(
-                                        "Unit Price", format="%.2f"
-                                    ),
-                                    "total": st.column_config.NumberColumn(
-                                        "Total", format="%.2f"
-                                    ),
-                                },
-                                hide_index=True,
-                                use_container_width=True,
-                            )
-
-                            # Add a download button for the extracted data
-                            if st.button(f"Download Invoice Data"):
-                                # Convert to CSV
-                                csv = df.to_csv(index=False)
-                                st.download_button(
-                                    label="Download CSV",
-                                    data=csv,
-                                    file_name=f"invoice_{invoice.get('number', 'unknown')}.csv",
-                                    mime="text/csv",
-                                )
+        pdf_bytes = uploaded_file.getvalue()
+        pdf_hash = hash_pdf(pdf_bytes)
+
+        if pdf_hash not in previews:
+            # Only the first page is rendered for the preview; the pages sent
+            # to the model are rendered when they are needed
+            with st.spinner("Converting PDF to images..."):
+                preview = render_preview(pdf_bytes)
+
+                if preview is None:
+                    st.error("Failed to process the PDF or no images found. Please try again.")
+                    st.stop()
+                previews[pdf_hash] = preview
+
+        # Create two columns for the main layout
+        preview_col, data_col = st.columns([0.4, 0.6])
+
+        # Display the processed image in the left column
+        with preview_col:
+            st.subheader("Document Preview (First Page)")
+            st.image(previews[pdf_hash], use_container_width=True)
+
+        # Display extracted data in the right column
+        with data_col:
+            extraction_key = (pdf_hash, api_option)
+            client = get_client(api_option)
+            # Blank, duplicate and boilerplate pages are not sent to the model
+            model_key = result_model_key(client.model_key, triage=True)
+            if extraction_key not in extractions:
+                extracted_data = get_cache().get_result(pdf_hash, model_key)
+            else:
+                extracted_data = extractions[extraction_key]
+
+            if extracted_data is not None:
+                render_extraction(extracted_data)
+            else:
+                page_triage = triage_pdf_pages(pdf_bytes)
+                page_numbers = kept_page_numbers(page_triage)
+                if len(page_numbers) > CHUNK_PAGES:
+                    # Long documents are extracted as concurrent page windows instead,
+                    # with their pages streamed rather than all held in memory
+                    with st.spinner("Processing document..."):
+                        extracted_data = extract_invoice_data_cached(
+                            client, pdf_bytes, get_cache(), pdf_hash, triage=True
+                        )
+                    if extracted_data is not None:
+                        render_extraction(extracted_data)
                 else:
-                    st.info("No invoice data to display for this document type.")
+                    with st.spinner("Converting PDF to images..."):
+                        image_base64_list = get_cache().load_page_images(pdf_bytes, pdf_hash, page_numbers)
+
+                    if not image_base64_list:
+                        st.error("Failed to process the PDF or no images found. Please try again.")
+                        st.stop()
+                    extracted_data = apply_triage(
+                        stream_extraction(client, image_base64_list), page_triage
+                    )
+                    if extracted_data is not None and (
+                        extracted_data.get("skipped_pages") or extracted_data.get("possible_duplicates")
+                    ):
+                        render_warnings({
+                            "skipped_pages": extracted_data.get("skipped_pages"),
+                            "possible_duplicates": extracted_data.get("possible_duplicates"),
+                        })
+                    if extracted_data is not None and not extracted_data.get("truncated"):
+                        get_cache().put_result(pdf_hash, model_key, extracted_data)
+
+                if extracted_data is None:
+                    st.error("Failed to extract data from the document. Please try again.")
+                    st.stop()
+            extractions[extraction_key] = extracted_data
 
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
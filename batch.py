@@ -0,0 +1,799 @@
+"""Headless batch extraction over many PDFs.
+
+Usage:
+    python batch.py invoices/ "inbox/**/*.pdf" --manifest todo.txt \
+        --output results.jsonl --provider anthropic --concurrency 8
+
+Each input is a directory (searched recursively for PDFs), a glob pattern or
+a single PDF path; a manifest lists one path per line. Results are appended
+to the output JSONL file as soon as each document finishes, and documents
+already recorded there as successful are skipped, so an interrupted run can
+simply be started again.
+
+With `--failover bedrock` (or `--requests-per-minute`), requests go through
+the rate-limited scheduler of scheduler.py instead: throttled and failed
+requests are retried with backoff, and while one provider throttles, work
+spills over to the other.
+
+Backlogs that do not need results right away can go through the providers'
+batch APIs instead, at half the price and outside the request rate limits:
+
+    python batch.py invoices/ --output results.jsonl --provider anthropic --batch-api
+
+Documents are submitted as Anthropic Message Batches or Bedrock batch
+inference jobs, which are polled until they end. Submitted batches are
+recorded in `<output>.batches.json`, so an interrupted run resumes polling
+them when it is started again.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from contextlib import nullcontext
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import asdict, dataclass, field
+from time import sleep, time
+from typing import Any, Dict, Iterable, Optional
+
+from export import InvoiceDatasetWriter, export_records
+from extraction import (
+    apply_triage,
+    correct_invoice_data,
+    extract_invoice_data_chunked,
+    merge_window_results,
+    page_windows,
+    result_status,
+)
+from image_processor import (
+    PageTriage,
+    RenderBudget,
+    get_document_pages,
+    get_image_from_pdf,
+    kept_page_numbers,
+    triage_pdf_pages,
+)
+from metrics import (
+    JsonlMetricsSink,
+    MultiMetricsSink,
+    PrometheusMetricsSink,
+    Span,
+    collect_spans,
+    record_span,
+    record_spans,
+    set_metrics_sink,
+)
+from page_content import PageContent, payload_bytes
+from result_cache import hash_pdf
+from scheduler import ExtractionScheduler, ProviderLane, ScheduledClient
+from worker import PROVIDERS, make_client
+
+# Seconds between polls of submitted batches
+DEFAULT_POLL_INTERVAL = 60.0
+# Allowance for the prompt and framing of each batch request on top of its pages
+BATCH_REQUEST_OVERHEAD_BYTES = 16 * 1024
+# Batch request IDs are a PDF hash prefix and the page window index, within
+# the 64 characters Message Batches allows
+BATCH_DOCUMENT_ID_CHARS = 40
+
+
+@dataclass
+class BatchSummary:
+    documents: int = 0
+    failed: int = 0
+    skipped: int = 0
+    elapsed_time: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+    cache_hits: int = 0
+
+    def add_record(self, record: Dict[str, Any]) -> None:
+        """Count a written output record."""
+        self.documents += 1
+        if record["status"] != "error":
+            self.latencies.append(record["latency_seconds"])
+            usage = record["result"].get("usage", {})
+            self.input_tokens += usage.get("input_tokens", 0)
+            self.output_tokens += usage.get("output_tokens", 0)
+            self.cache_creation_input_tokens += usage.get("cache_creation_input_tokens", 0)
+            self.cache_read_input_tokens += usage.get("cache_read_input_tokens", 0)
+            if usage.get("cache_read_input_tokens"):
+                self.cache_hits += 1
+        if record["status"] != "ok":
+            self.failed += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        minutes = self.elapsed_time / 60
+        extracted = len(self.latencies)
+        # Everything sent as input, whether billed in full, written to or read from the cache
+        total_input_tokens = (
+            self.input_tokens + self.cache_creation_input_tokens + self.cache_read_input_tokens
+        )
+        return {
+            "documents": self.documents,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_seconds": round(self.elapsed_time, 3),
+            "documents_per_minute": round(self.documents / minutes, 2) if minutes else 0.0,
+            "latency_p50_seconds": round(percentile(self.latencies, 50), 3),
+            "latency_p95_seconds": round(percentile(self.latencies, 95), 3),
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_creation_input_tokens": self.cache_creation_input_tokens,
+            "cache_read_input_tokens": self.cache_read_input_tokens,
+            "input_tokens_per_document": round(total_input_tokens / extracted) if extracted else 0,
+            "output_tokens_per_document": round(self.output_tokens / extracted) if extracted else 0,
+            "prompt_cache_hit_rate": round(self.cache_hits / extracted, 3) if extracted else 0.0,
+            "prompt_cache_read_ratio": (
+                round(self.cache_read_input_tokens / total_input_tokens, 3) if total_input_tokens else 0.0
+            ),
+        }
+
+
+@dataclass
+class _Document:
+    path: str
+    submitted_at: float
+    pdf_hash: str = ""
+    page_count: int = 0
+    render_time: float = 0.0
+    page_routes: list[Dict[str, Any]] = field(default_factory=list)
+    page_triage: Optional[list[PageTriage]] = None
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile, 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def collect_pdf_paths(inputs: Iterable[str], manifest: Optional[str] = None) -> list[str]:
+    """Expand directories, globs, files and a manifest into unique absolute paths."""
+    candidates = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            candidates.extend(
+                glob.glob(os.path.join(entry, "**", "*.pdf"), recursive=True)
+            )
+        elif os.path.isfile(entry):
+            candidates.append(entry)
+        else:
+            candidates.extend(glob.glob(entry, recursive=True))
+    if manifest:
+        with open(manifest) as f:
+            candidates.extend(line.strip() for line in f if line.strip())
+
+    paths = []
+    seen = set()
+    for candidate in candidates:
+        path = os.path.abspath(candidate)
+        if path not in seen:
+            seen.add(path)
+            paths.append(path)
+    return paths
+
+
+def load_completed(output_path: str) -> set[str]:
+    """Source paths already extracted successfully in a previous run."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a partially written last line
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["source"])
+    return completed
+
+
+def render_document(
+    path: str,
+    text_layer: bool = False,
+    word_positions: bool = False,
+    budget: Optional[RenderBudget] = None,
+    triage: bool = False,
+) -> tuple[str, list[PageContent], list[Dict[str, Any]], Optional[list[PageTriage]], float, list[Span]]:
+    """Read and rasterize one PDF; runs in a render worker process.
+
+    With `text_layer`, born-digital pages are sent as text and the returned
+    routes record which path every page took. With `triage`, only the pages
+    kept by `triage_pdf_pages` are rendered and the triage is returned too.
+    The worker's timing spans are returned to be recorded in the parent
+    process.
+    """
+    start_time = time()
+    with collect_spans() as spans:
+        with open(path, "rb") as f:
+            pdf_bytes = f.read()
+        page_triage = triage_pdf_pages(pdf_bytes) if triage else None
+        page_numbers = kept_page_numbers(page_triage) if triage else None
+        # Documents are already spread over the pool, so each renders serially
+        if text_layer:
+            pages, routes = get_document_pages(
+                pdf_bytes, word_positions, max_workers=1, budget=budget, page_numbers=page_numbers
+            )
+            page_routes = [asdict(route) for route in routes]
+        else:
+            pages = get_image_from_pdf(pdf_bytes, max_workers=1, budget=budget, page_numbers=page_numbers)
+            page_routes = []
+    return hash_pdf(pdf_bytes), pages, page_routes, page_triage, time() - start_time, spans
+
+
+def run_batch(
+    paths: list[str],
+    output_path: str,
+    client,
+    concurrency: int = 8,
+    render_workers: Optional[int] = None,
+    text_layer: bool = False,
+    word_positions: bool = False,
+    budget: Optional[RenderBudget] = None,
+    triage: bool = False,
+    exporter: Optional[InvoiceDatasetWriter] = None,
+    validate: bool = False,
+) -> BatchSummary:
+    """Extract every PDF in `paths`, appending one JSON line per document.
+
+    Rendering runs in a process pool while up to `concurrency` requests are in
+    flight on a thread pool. At most `concurrency` plus the render worker
+    count documents are held in memory at any time. With `validate`, the
+    pages behind invoices that fail validation are requested again (see
+    `correct_invoice_data`). Successful results are also appended to
+    `exporter`'s datasets, if one is given.
+    """
+    summary = BatchSummary()
+    completed = load_completed(output_path)
+    todo = [path for path in paths if path not in completed]
+    summary.skipped = len(paths) - len(todo)
+    render_workers = render_workers or os.cpu_count() or 1
+    max_in_pipeline = concurrency + render_workers
+
+    start_time = time()
+    with open(output_path, "a") as output, ProcessPoolExecutor(
+        max_workers=render_workers
+    ) as render_pool, ThreadPoolExecutor(max_workers=concurrency) as request_pool:
+
+        def write_record(record: Dict[str, Any]) -> None:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            summary.add_record(record)
+            if exporter is not None:
+                export_records([record], exporter)
+            print(
+                f"[{summary.documents}/{len(todo)}] {record['status']}: {record['source']}",
+                file=sys.stderr,
+            )
+
+        def extract(
+            document: _Document, image_base64_list: list[PageContent]
+        ) -> tuple[Optional[Dict[str, Any]], float]:
+            request_start = time()
+            result = extract_invoice_data_chunked(client, image_base64_list)
+            if document.page_triage is not None:
+                result = apply_triage(result, document.page_triage)
+            if validate and result is not None:
+                page_numbers = kept_page_numbers(document.page_triage) if document.page_triage is not None else None
+                with open(document.path, "rb") as f:
+                    # Up to `concurrency` documents are corrected at once, so each renders serially
+                    result = correct_invoice_data(
+                        client, f.read(), result, budget, page_numbers, max_workers=1
+                    )
+            return result, time() - request_start
+
+        # Maps each in-flight future to its stage ("render" or "request")
+        pending: dict[Any, tuple[str, _Document]] = {}
+        remaining = iter(todo)
+        while True:
+            while len(pending) < max_in_pipeline:
+                path = next(remaining, None)
+                if path is None:
+                    break
+                future = render_pool.submit(
+                    render_document, path, text_layer, word_positions, budget, triage
+                )
+                pending[future] = ("render", _Document(path, time()))
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, document = pending.pop(future)
+                record = {"source": document.path}
+                try:
+                    if stage == "render":
+                        (
+                            document.pdf_hash,
+                            image_base64_list,
+                            document.page_routes,
+                            document.page_triage,
+                            document.render_time,
+                            spans,
+                        ) = future.result()
+                        record_spans(spans)
+                        if not image_base64_list:
+                            raise ValueError("no pages could be rendered")
+                        document.page_count = len(image_base64_list)
+                        pending[request_pool.submit(extract, document, image_base64_list)] = ("request", document)
+                        continue
+
+                    result, request_time = future.result()
+                    if result is None:
+                        raise ValueError("extraction failed")
+                    record.update(
+                        # Partial results are not treated as done, so a re-run retries them
+                        status=result_status(result),
+                        pdf_hash=document.pdf_hash,
+                        pages=document.page_count,
+                        render_seconds=round(document.render_time, 3),
+                        request_seconds=round(request_time, 3),
+                        latency_seconds=round(time() - document.submitted_at, 3),
+                        result=result,
+                    )
+                    if document.page_routes:
+                        record["page_routes"] = document.page_routes
+                except Exception as e:
+                    record.update(status="error", error=str(e))
+                usage = record.get("result", {}).get("usage", {})
+                record_span(
+                    "document",
+                    time() - document.submitted_at,
+                    status=record["status"],
+                    pages=document.page_count,
+                    **usage,
+                )
+                write_record(record)
+
+    summary.elapsed_time = time() - start_time
+    return summary
+
+
+def batch_state_path(output_path: str) -> str:
+    """File the batches submitted for an output file are tracked in until they end."""
+    return f"{output_path}.batches.json"
+
+
+def load_batch_state(output_path: str) -> list[Dict[str, Any]]:
+    path = batch_state_path(output_path)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)["batches"]
+
+
+def save_batch_state(output_path: str, batches: list[Dict[str, Any]]) -> None:
+    path = batch_state_path(output_path)
+    if not batches:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    # Written to a temporary file first, so a crash never leaves half a state file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"batches": batches}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _batch_document_record(
+    path: str,
+    document: Dict[str, Any],
+    result: Optional[Dict[str, Any]],
+    submitted_at: float,
+    batch_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """The output record of one document extracted through a batch."""
+    record: Dict[str, Any] = {"source": path}
+    if batch_id is not None:
+        record["batch_id"] = batch_id
+    if result is None:
+        record.update(status="error", error="extraction failed")
+        return record
+    record.update(
+        status=result_status(result),
+        pdf_hash=document["pdf_hash"],
+        pages=document["pages"],
+        latency_seconds=round(time() - submitted_at, 3),
+        result=result,
+    )
+    if document["page_routes"]:
+        record["page_routes"] = document["page_routes"]
+    return record
+
+
+def _apply_document_triage(document: Dict[str, Any], result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if result is not None and document["page_triage"] is not None:
+        result = apply_triage(result, [PageTriage(**page) for page in document["page_triage"]])
+    return result
+
+
+def run_batch_jobs(
+    paths: list[str],
+    output_path: str,
+    client,
+    render_workers: Optional[int] = None,
+    text_layer: bool = False,
+    word_positions: bool = False,
+    budget: Optional[RenderBudget] = None,
+    triage: bool = False,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    wait_for_results: bool = True,
+    concurrency: int = 8,
+    exporter: Optional[InvoiceDatasetWriter] = None,
+) -> BatchSummary:
+    """Extract every PDF in `paths` through the provider's batch API.
+
+    Documents are rendered in a process pool as in `run_batch` and packed
+    into batches up to the client's request count and size limits, long
+    documents as one request per page window. Each batch is submitted as
+    soon as it is full and recorded in the state file (see
+    `batch_state_path`). Submitted batches are then polled every
+    `poll_interval` seconds, and the results of each are put through the
+    same post-processing as `extract_invoice_data` and appended to the
+    output as it ends. Without `wait_for_results`, this returns after
+    submitting; a later run picks up the pending batches.
+
+    Documents already done or in a pending batch are not submitted again.
+    A last batch smaller than the provider accepts is extracted with
+    regular requests, `concurrency` at a time, instead. Successful results
+    are also appended to `exporter`'s datasets, if one is given.
+    """
+    summary = BatchSummary()
+    completed = load_completed(output_path)
+    batches = load_batch_state(output_path)
+    pending_paths = {
+        path for batch in batches for document in batch["documents"].values() for path in document["paths"]
+    }
+    todo = [path for path in paths if path not in completed and path not in pending_paths]
+    summary.skipped = len(paths) - len(todo)
+    render_workers = render_workers or os.cpu_count() or 1
+
+    start_time = time()
+    with open(output_path, "a") as output:
+
+        def write_record(record: Dict[str, Any]) -> None:
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            summary.add_record(record)
+            if exporter is not None:
+                export_records([record], exporter)
+            usage = record.get("result", {}).get("usage", {})
+            record_span(
+                "document",
+                record.get("latency_seconds", 0.0),
+                status=record["status"],
+                pages=record.get("pages", 0),
+                **usage,
+            )
+            print(f"[{summary.documents}] {record['status']}: {record['source']}", file=sys.stderr)
+
+        # The batch being filled: its documents by ID, their requests and pages
+        documents: Dict[str, Dict[str, Any]] = {}
+        document_pages: Dict[str, list[PageContent]] = {}
+        requests: list[Dict[str, Any]] = []
+        request_bytes = 0
+
+        def submit() -> None:
+            nonlocal documents, document_pages, requests, request_bytes
+            submitted_at = time()
+            try:
+                batch_id = client.submit_batch(requests)
+            except Exception as e:
+                print(f"Error submitting batch: {str(e)}", file=sys.stderr)
+                for document in documents.values():
+                    for path in document["paths"]:
+                        write_record({"source": path, "status": "error", "error": str(e)})
+            else:
+                batches.append({
+                    "batch_id": batch_id,
+                    "model_key": client.model_key,
+                    "submitted_at": submitted_at,
+                    "documents": documents,
+                })
+                save_batch_state(output_path, batches)
+                print(
+                    f"Submitted batch {batch_id}: {len(requests)} requests for {len(documents)} documents",
+                    file=sys.stderr,
+                )
+            documents, document_pages, requests, request_bytes = {}, {}, [], 0
+
+        def extract_directly() -> None:
+            """Extract the batch being filled with regular requests."""
+            submitted_at = time()
+            with ThreadPoolExecutor(max_workers=concurrency) as request_pool:
+                results = request_pool.map(
+                    lambda document_id: extract_invoice_data_chunked(client, document_pages[document_id]),
+                    list(documents),
+                )
+                for document, result in zip(documents.values(), results):
+                    result = _apply_document_triage(document, result)
+                    for path in document["paths"]:
+                        write_record(_batch_document_record(path, document, result, submitted_at))
+
+        with ProcessPoolExecutor(max_workers=render_workers) as render_pool:
+            pending: Dict[Any, str] = {}
+            remaining = iter(todo)
+            while True:
+                while len(pending) < 2 * render_workers:
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    future = render_pool.submit(
+                        render_document, path, text_layer, word_positions, budget, triage
+                    )
+                    pending[future] = path
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        pdf_hash, pages, page_routes, page_triage, _, spans = future.result()
+                        record_spans(spans)
+                        if not pages:
+                            raise ValueError("no pages could be rendered")
+                    except Exception as e:
+                        write_record({"source": path, "status": "error", "error": str(e)})
+                        continue
+
+                    document_id = pdf_hash[:BATCH_DOCUMENT_ID_CHARS]
+                    if document_id in documents:
+                        # The same PDF under another path is extracted once
+                        documents[document_id]["paths"].append(path)
+                        continue
+                    windows = page_windows(len(pages))
+                    size = payload_bytes(pages) + BATCH_REQUEST_OVERHEAD_BYTES * len(windows)
+                    if requests and (
+                        len(requests) + len(windows) > client.max_batch_requests
+                        or request_bytes + size > client.max_batch_bytes
+                    ):
+                        submit()
+                    documents[document_id] = {
+                        "paths": [path],
+                        "pdf_hash": pdf_hash,
+                        "pages": len(pages),
+                        "windows": [[window.start, window.stop] for window in windows],
+                        "page_routes": page_routes,
+                        "page_triage": [asdict(page) for page in page_triage] if page_triage is not None else None,
+                    }
+                    document_pages[document_id] = pages
+                    requests.extend(
+                        client.batch_request(f"{document_id}-{index}", pages[window.start:window.stop])
+                        for index, window in enumerate(windows)
+                    )
+                    request_bytes += size
+
+        if requests:
+            if len(requests) < client.min_batch_requests:
+                extract_directly()
+            else:
+                submit()
+        # Release the submitted pages before waiting on the batches
+        documents, document_pages, requests = {}, {}, []
+
+        other_batches = [batch for batch in batches if batch["model_key"] != client.model_key]
+        if other_batches:
+            print(
+                f"{len(other_batches)} pending batches were submitted with another provider or model "
+                "and are left for a run with it",
+                file=sys.stderr,
+            )
+        while wait_for_results:
+            waiting = [batch for batch in batches if batch["model_key"] == client.model_key]
+            if not waiting:
+                break
+            for batch in waiting:
+                batch_id = batch["batch_id"]
+                try:
+                    status = client.batch_status(batch_id)
+                    if status == "in_progress":
+                        continue
+                    partials = {
+                        document_id: [None] * len(document["windows"])
+                        for document_id, document in batch["documents"].items()
+                    }
+                    if status == "ended":
+                        for custom_id, result in client.batch_results(batch_id):
+                            document_id, _, index = custom_id.rpartition("-")
+                            if document_id in partials:
+                                partials[document_id][int(index)] = result
+                except Exception as e:
+                    # Polled again next round
+                    print(f"Error polling batch {batch_id}: {str(e)}", file=sys.stderr)
+                    continue
+
+                for document_id, document in batch["documents"].items():
+                    windows = [range(*window) for window in document["windows"]]
+                    result = _apply_document_triage(
+                        document, merge_window_results(windows, partials[document_id])
+                    )
+                    for path in document["paths"]:
+                        write_record(
+                            _batch_document_record(path, document, result, batch["submitted_at"], batch_id)
+                        )
+                batches.remove(batch)
+                save_batch_state(output_path, batches)
+            if any(batch["model_key"] == client.model_key for batch in batches):
+                sleep(poll_interval)
+
+    summary.elapsed_time = time() - start_time
+    return summary
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Extract invoice data from many PDFs.")
+    parser.add_argument("inputs", nargs="*", help="PDF files, directories or glob patterns")
+    parser.add_argument("--manifest", help="File listing one PDF path per line")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--provider", choices=PROVIDERS, default="anthropic")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests kept in flight")
+    parser.add_argument("--render-workers", type=int, default=None, help="Rasterization processes")
+    parser.add_argument(
+        "--text-layer",
+        action="store_true",
+        help="Send born-digital pages as their text layer instead of an image",
+    )
+    parser.add_argument(
+        "--word-positions",
+        action="store_true",
+        help="Include line positions with text-layer pages",
+    )
+    parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Skip blank, duplicate and boilerplate pages instead of sending them to the model",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check totals and line items locally and request the pages of failing invoices again",
+    )
+    parser.add_argument(
+        "--max-image-bytes",
+        type=int,
+        default=None,
+        help="Render pages adaptively, keeping each page image under this many bytes",
+    )
+    parser.add_argument(
+        "--prompt-caching",
+        action="store_true",
+        help="Mark the static prompt as cacheable so later requests read it from the prompt cache",
+    )
+    parser.add_argument(
+        "--tool-output",
+        action="store_true",
+        help="Request the answer through a tool schema instead of free-form JSON",
+    )
+    parser.add_argument(
+        "--failover",
+        choices=PROVIDERS,
+        help="Spill requests over to this provider while --provider is throttling",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=float,
+        default=None,
+        help="Rate limit per provider; with --failover or this, requests are scheduled with retries",
+    )
+    parser.add_argument(
+        "--input-tokens-per-minute",
+        type=float,
+        default=None,
+        help="Input token rate limit per provider",
+    )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Submit the documents as Message Batches or Bedrock batch inference jobs and poll for the results",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between polls of submitted batches",
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="With --batch-api, exit after submitting; run again later to collect the results",
+    )
+    parser.add_argument(
+        "--export-dir",
+        help="Also append successful results to partitioned Parquet datasets in this directory",
+    )
+    parser.add_argument("--metrics-jsonl", help="Append a JSON line per pipeline stage span to this file")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics for the pipeline stages on this port at /metrics",
+    )
+    args = parser.parse_args(argv)
+
+    if args.validate and args.batch_api:
+        parser.error("--validate needs regular requests and cannot be used with --batch-api")
+    scheduled = bool(args.failover or args.requests_per_minute or args.input_tokens_per_minute)
+    if scheduled and args.batch_api:
+        parser.error("--failover and rate limits apply to regular requests and cannot be used with --batch-api")
+
+    paths = collect_pdf_paths(args.inputs, args.manifest)
+    if not paths:
+        parser.error("no PDF files found")
+
+    sinks = []
+    if args.metrics_jsonl:
+        sinks.append(JsonlMetricsSink(args.metrics_jsonl))
+    if args.metrics_port:
+        prometheus = PrometheusMetricsSink()
+        prometheus.serve(args.metrics_port)
+        sinks.append(prometheus)
+    if sinks:
+        set_metrics_sink(MultiMetricsSink(sinks))
+
+    if scheduled:
+        # Throttles and errors are retried by the scheduler rather than inside the SDKs
+        limits = {"max_in_flight": args.concurrency}
+        if args.requests_per_minute:
+            limits["requests_per_minute"] = args.requests_per_minute
+        if args.input_tokens_per_minute:
+            limits["input_tokens_per_minute"] = args.input_tokens_per_minute
+        providers = [args.provider] + ([args.failover] if args.failover and args.failover != args.provider else [])
+        client = ScheduledClient(ExtractionScheduler([
+            ProviderLane(make_client(provider, args.prompt_caching, args.tool_output, max_retries=0), **limits)
+            for provider in providers
+        ]))
+    else:
+        client = make_client(args.provider, args.prompt_caching, args.tool_output)
+    budget = RenderBudget(max_bytes=args.max_image_bytes) if args.max_image_bytes else None
+    exporter = InvoiceDatasetWriter(args.export_dir) if args.export_dir else None
+    with exporter or nullcontext():
+        if args.batch_api:
+            summary = run_batch_jobs(
+                paths,
+                args.output,
+                client,
+                render_workers=args.render_workers,
+                text_layer=args.text_layer,
+                word_positions=args.word_positions,
+                budget=budget,
+                triage=args.triage,
+                poll_interval=args.poll_interval,
+                wait_for_results=not args.no_wait,
+                concurrency=args.concurrency,
+                exporter=exporter,
+            )
+        else:
+            summary = run_batch(
+                paths,
+                args.output,
+                client,
+                concurrency=args.concurrency,
+                render_workers=args.render_workers,
+                text_layer=args.text_layer,
+                word_positions=args.word_positions,
+                budget=budget,
+                triage=args.triage,
+                exporter=exporter,
+                validate=args.validate,
+            )
+    if scheduled:
+        client.close()
+    print(json.dumps(summary.as_dict(), indent=2))
+    return 1 if summary.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
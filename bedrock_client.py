@@ -1,109 +1,485 @@
 import boto3
+import httpx
 import json
 import os
-from typing import Dict, Any
+import threading
+from time import perf_counter, time
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+from typing import Dict, Any, Iterator, Optional, Tuple
 from decimal import Decimal
-from prompts import INVOICE_EXTRACTION_PROMPT
+from urllib.parse import quote, urlparse
+from uuid import uuid4
+from metrics import span
+from page_content import PageContent, extraction_request, payload_bytes, response_usage
+from normalization import normalize_invoices
+from streaming_json import InvoiceStreamParser, parse_partial_response
+from dotenv import load_dotenv
 
-# Set AWS region in environment variable
-os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+# boto3 sessions are not thread-safe to create clients from, so a single
+# session and one runtime client per pool configuration are shared
+# process-wide. The clients themselves are thread-safe.
+_session_lock = threading.Lock()
+_session: Optional[boto3.Session] = None
+_runtime_clients: Dict[tuple, Any] = {}
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceQuotaExceededException",
+}
+TRANSIENT_ERROR_CODES = {
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "InternalServerException",
+    "ServiceUnavailableException",
+}
+
+# Batch inference job limits: Bedrock rejects jobs with fewer than
+# MIN_BATCH_REQUESTS records, and the default quota allows up to
+# MAX_BATCH_REQUESTS records in an input file of up to MAX_BATCH_BYTES
+MIN_BATCH_REQUESTS = 100
+MAX_BATCH_REQUESTS = 50_000
+MAX_BATCH_BYTES = 1024 * 1024 * 1024
+# Job states whose output can be read, complete or not
+BATCH_ENDED_STATUSES = {"Completed", "PartiallyCompleted", "Stopped", "Expired"}
+
+
+def split_s3_uri(uri: str) -> tuple[str, str]:
+    """Split s3://bucket/key into the bucket and key."""
+    parsed = urlparse(uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def get_session(region: str = "us-east-1") -> boto3.Session:
+    """Return the process-wide boto3 session."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = boto3.Session(region_name=region)
+        return _session
+
+
+def get_runtime_client(
+    region: str = "us-east-1",
+    max_connections: int = 100,
+    timeout: float = 120.0,
+    connect_timeout: float = 10.0,
+    max_retries: int = 4,
+    endpoint_url: Optional[str] = None,
+):
+    """Return the shared, pooled bedrock-runtime client for this configuration."""
+    session = get_session(region)
+    key = (region, max_connections, timeout, connect_timeout, max_retries, endpoint_url)
+    with _session_lock:
+        if key not in _runtime_clients:
+            _runtime_clients[key] = session.client(
+                "bedrock-runtime",
+                region_name=region,
+                endpoint_url=endpoint_url,
+                config=Config(
+                    max_pool_connections=max_connections,
+                    read_timeout=timeout,
+                    connect_timeout=connect_timeout,
+                    retries={"total_max_attempts": max_retries + 1, "mode": "standard"},
+                ),
+            )
+        return _runtime_clients[key]
 
 
 class BedrockClient:
-    def __init__(self):
-        # Create session with explicit region
-        session = boto3.Session(region_name="us-east-1")
-        self.client = session.client("bedrock-runtime")
+    def __init__(
+        self,
+        region: str = "us-east-1",
+        max_connections: int = 100,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+        max_retries: int = 4,
+        prompt_caching: bool = False,
+        tool_output: bool = False,
+        endpoint_url: Optional[str] = None,
+        batch_s3_uri: Optional[str] = None,
+        batch_role_arn: Optional[str] = None,
+    ):
+        """
+        Args:
+            prompt_caching (bool): Mark the static prompt as cacheable; only takes
+                effect on Bedrock models that support prompt caching
+            tool_output (bool): Request the answer through the `record_invoices` tool
+                schema instead of free-form JSON
+            endpoint_url (str): Send requests to this endpoint instead of the regional
+                Bedrock runtime endpoint, e.g. the local stand-in in replay_stub.py; batch
+                jobs and their S3 objects then go to it too
+            batch_s3_uri (str): s3://bucket/prefix batch job input and output files are
+                written under; defaults to BEDROCK_BATCH_S3_URI
+            batch_role_arn (str): IAM role Bedrock assumes to read and write them;
+                defaults to BEDROCK_BATCH_ROLE_ARN
+        """
+        # Credentials may come from a .env file; the region is passed explicitly
+        load_dotenv()
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.batch_s3_uri = batch_s3_uri or os.getenv("BEDROCK_BATCH_S3_URI")
+        self.batch_role_arn = batch_role_arn or os.getenv("BEDROCK_BATCH_ROLE_ARN")
+        self.min_batch_requests = MIN_BATCH_REQUESTS
+        self.max_batch_requests = MAX_BATCH_REQUESTS
+        self.max_batch_bytes = MAX_BATCH_BYTES
+        self._s3_client = None
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.client = get_runtime_client(
+            region, max_connections, timeout, connect_timeout, max_retries, endpoint_url
+        )
+        self._async_client: Optional[httpx.AsyncClient] = None
         self.model_id = (
             "anthropic.claude-3-5-sonnet-20240620-v1:0"  # Using Claude 3.5 Sonnet
         )
+        self.prompt_caching = prompt_caching
+        self.tool_output = tool_output
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """Pooled HTTP client for async Bedrock calls, created on first use.
+
+        boto3 has no asyncio support, so async requests are signed with
+        botocore's SigV4 signer and sent over httpx. Its connections are
+        bound to the event loop that first uses it.
+        """
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._async_client
 
-    def _parse_numeric(self, value: str) -> float:
-        """Parse numeric values from strings, handling various formats."""
-        if not value or not isinstance(value, str):
-            return 0.0
+    @property
+    def model_key(self) -> str:
+        """Provider and model identifier used to key cached results."""
+        # Tool output uses a different prompt, so its results are kept apart
+        return f"bedrock:{self.model_id}" + (":tool" if self.tool_output else "")
+
+    def _request_params(self, image_base64_list: list[PageContent]) -> Dict[str, Any]:
+        """Build the InvokeModel request shared by the sync, async and batch calls."""
+        with span(
+            "request_build",
+            provider=self.model_key,
+            pages=len(image_base64_list),
+            payload_bytes=payload_bytes(image_base64_list),
+        ):
+            return {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": 4096,  # Increased max_tokens
+                # The prompt text should come first for Claude via Bedrock according to some examples
+                **extraction_request(
+                    image_base64_list, self.prompt_caching, self.tool_output, prompt_first=True
+                ),
+            }
+
+    def _request_body(self, image_base64_list: list[PageContent]) -> str:
+        return json.dumps(self._request_params(image_base64_list))
+
+    def _process_response_body(self, response_body: Dict[str, Any]) -> Dict[str, Any]:
+        """Parse the model's JSON answer (or tool input) and normalize the numeric fields."""
+        with span("json_parse", provider=self.model_key):
+            tool_use = next(
+                (block for block in response_body["content"] if block.get("type") == "tool_use"), None
+            )
+            if tool_use is not None:
+                extracted_data = dict(tool_use["input"])
+            elif response_body.get("stop_reason") == "max_tokens":
+                # Cut off mid-answer: keep the invoices completed before the limit
+                text = response_body["content"][0]["text"]
+                extracted_data = parse_partial_response(text)
+                if extracted_data is None:
+                    raise json.JSONDecodeError("Response cut off at max_tokens", text, 0)
+            else:
+                # Parse the JSON response
+                extracted_data = json.loads(response_body["content"][0]["text"])
+            if response_body.get("stop_reason") == "max_tokens":
+                # Tool input is cut off at the limit too, with the remaining invoices missing
+                extracted_data["truncated"] = True
+
+        # Parse numeric values in the response
+        with span("postprocess", provider=self.model_key) as attributes:
+            extracted_data["invoices"] = normalize_invoices(extracted_data.get("invoices") or [])
+            attributes["invoices"] = len(extracted_data["invoices"])
+
+        extracted_data["usage"] = response_usage(response_body.get("usage", {}))
+        return extracted_data
+
+    def classify_error(self, e: Exception) -> tuple[str, Optional[float]]:
+        """Classify a request error as "throttle", "transient" or "fatal".
+
+        Also returns the server's retry-after delay in seconds, if it sent one.
+        """
+        if isinstance(e, ClientError):
+            code = e.response.get("Error", {}).get("Code", "")
+            headers = e.response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        elif isinstance(e, httpx.HTTPStatusError):
+            code = e.response.headers.get("x-amzn-errortype", "").split(":")[0]
+            headers = e.response.headers
+            status = e.response.status_code
+        elif isinstance(e, (BotocoreConnectionError, HTTPClientError, httpx.TransportError)):
+            return "transient", None
+        else:
+            return "fatal", None
+
+        retry_after = None
         try:
-            # Remove currency symbols and other non-numeric characters except decimal point and minus
-            cleaned = "".join(c for c in value if c.isdigit() or c in ".-")
-            return float(cleaned)
-        except (ValueError, TypeError):
-            return 0.0
-
-    def _parse_line_items(self, items: list) -> list:
-        """Parse numeric values in line items."""
-        parsed_items = []
-        for item in items:
-            parsed_item = item.copy()
-            for field in ["quantity", "unit_price", "total"]:
-                if field in parsed_item:
-                    parsed_item[field] = self._parse_numeric(str(parsed_item[field]))
-            parsed_items.append(parsed_item)
-        return parsed_items
-
-    def extract_invoice_data(self, image_base64_list: list[str]) -> Dict[str, Any]:
+            if "retry-after" in headers:
+                retry_after = float(headers["retry-after"])
+        except ValueError:
+            pass
+        if code in THROTTLING_ERROR_CODES or status == 429:
+            return "throttle", retry_after
+        if code in TRANSIENT_ERROR_CODES or status >= 500:
+            return "transient", retry_after
+        return "fatal", None
+
+    def extract_invoice_data(self, image_base64_list: list[PageContent], raise_errors: bool = False) -> Dict[str, Any]:
         """
         Extract invoice data using AWS Bedrock's Claude model from a list of images.
 
         Args:
-            image_base64_list (list[str]): List of base64 encoded images of the invoice pages
+            image_base64_list (list[PageContent]): Base64 encoded images (or text layers) of the invoice pages
+            raise_errors (bool): Raise request errors instead of printing them and returning None
 
         Returns:
             Dict[str, Any]: Extracted invoice data
         """
         try:
-            # Construct the content list with multiple images and the prompt
-            content_list = []
-            # The prompt text should come first for Claude via Bedrock according to some examples
-            content_list.append({"type": "text", "text": INVOICE_EXTRACTION_PROMPT})
-            for image_data in image_base64_list:
-                content_list.append(
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": image_data,
-                        },
-                    }
+            body = self._request_body(image_base64_list)
+            with span("model_request", provider=self.model_key, pages=len(image_base64_list)) as attributes:
+                response = self.client.invoke_model(
+                    modelId=self.model_id,
+                    body=body,
                 )
 
-            response = self.client.invoke_model(
-                modelId=self.model_id,
-                body=json.dumps(
-                    {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 4096,  # Increased max_tokens
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": content_list,  # Use the constructed content list
-                            }
-                        ],
-                    }
-                ),
-            )
+                # Parse the response
+                response_body = json.loads(response["body"].read())
+                attributes.update(response_usage(response_body.get("usage", {})))
+            return self._process_response_body(response_body)
 
-            # Parse the response
-            response_body = json.loads(response["body"].read())
-            extracted_text = response_body["content"][0]["text"]
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"Error calling Bedrock: {str(e)}")
+            return None
 
-            # Parse the JSON response
-            extracted_data = json.loads(extracted_text)
+    def _signed_request(self, method: str, url: str, body: Optional[str] = None) -> AWSRequest:
+        """Build a Bedrock HTTP request signed with the session credentials."""
+        request = AWSRequest(
+            method=method,
+            url=url,
+            data=body.encode("utf-8") if body is not None else None,
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+        )
+        credentials = get_session(self.region).get_credentials().get_frozen_credentials()
+        SigV4Auth(credentials, "bedrock", self.region).add_auth(request)
+        return request
 
-            # Parse numeric values in the response
-            if extracted_data.get("invoices"):
-                for invoice in extracted_data["invoices"]:
-                    # Parse main invoice amounts
-                    invoice["amount"] = self._parse_numeric(str(invoice.get("amount", "0")))
-                    invoice["tax_amount"] = self._parse_numeric(str(invoice.get("tax_amount", "0")))
-                    invoice["payment_term_days"] = self._parse_numeric(str(invoice.get("payment_term_days", "0")))
+    def _signed_invoke_request(self, body: str) -> AWSRequest:
+        """Build an InvokeModel HTTP request signed with the session credentials."""
+        # The endpoint boto3 resolved, so a custom endpoint_url applies here too
+        url = f"{self.client.meta.endpoint_url}/model/{quote(self.model_id, safe='')}/invoke"
+        return self._signed_request("POST", url, body)
 
-                    # Parse line items
-                    if "line_items" in invoice:
-                        invoice["line_items"] = self._parse_line_items(invoice["line_items"])
+    async def extract_invoice_data_async(
+        self, image_base64_list: list[PageContent], raise_errors: bool = False
+    ) -> Dict[str, Any]:
+        """
+        Async variant of `extract_invoice_data`.
 
-            return extracted_data
+        Requests go over one pooled httpx connection pool, so hundreds of
+        documents can be in flight from a single event loop without a thread
+        per request.
+
+        Args:
+            image_base64_list (list[PageContent]): Base64 encoded images (or text layers) of the invoice pages
+            raise_errors (bool): Raise request errors instead of printing them and returning None
+
+        Returns:
+            Dict[str, Any]: Extracted invoice data
+        """
+        try:
+            request = self._signed_invoke_request(self._request_body(image_base64_list))
+            with span("model_request", provider=self.model_key, pages=len(image_base64_list)) as attributes:
+                response = await self.async_client.post(
+                    request.url, content=request.body, headers=dict(request.headers)
+                )
+                response.raise_for_status()
+                response_body = response.json()
+                attributes.update(response_usage(response_body.get("usage", {})))
+            return self._process_response_body(response_body)
 
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Error calling Bedrock: {str(e)}")
             return None
+
+    def extract_invoice_data_stream(
+        self, image_base64_list: list[PageContent]
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Stream the extraction with InvokeModelWithResponseStream.
+
+        Yields ("document_type", str) once the classification is known and
+        ("invoice", dict) for each invoice as soon as it is complete, then
+        always ends with ("result", dict or None) carrying the whole result.
+        If the stream breaks off or hits max_tokens, the invoices completed so
+        far are kept and the result is marked "truncated".
+
+        Args:
+            image_base64_list (list[PageContent]): Base64 encoded images (or text layers) of the invoice pages
+        """
+        parser = InvoiceStreamParser()
+        usage = response_usage({})
+        try:
+            body = self._request_body(image_base64_list)
+            start = perf_counter()
+            with span(
+                "model_request", provider=self.model_key, pages=len(image_base64_list), streaming=True
+            ) as attributes:
+                response = self.client.invoke_model_with_response_stream(
+                    modelId=self.model_id,
+                    body=body,
+                )
+                for stream_event in response["body"]:
+                    chunk = json.loads(stream_event["chunk"]["bytes"])
+                    if chunk["type"] == "message_start":
+                        # Input and cache token counts arrive with the start of the message
+                        usage = response_usage(chunk["message"].get("usage", {}))
+                    elif chunk["type"] == "message_delta":
+                        usage["output_tokens"] = chunk.get("usage", {}).get("output_tokens", 0)
+                    elif chunk["type"] == "content_block_delta":
+                        # Free-form JSON arrives as text, tool output as partial tool input JSON
+                        delta = chunk["delta"]
+                        if delta.get("type") == "text_delta":
+                            text = delta["text"]
+                        elif delta.get("type") == "input_json_delta":
+                            text = delta["partial_json"]
+                        else:
+                            continue
+                        if "time_to_first_token" not in attributes:
+                            attributes["time_to_first_token"] = perf_counter() - start
+                        for event, value in parser.feed(text):
+                            if event == "invoice":
+                                normalize_invoices([value])
+                            yield event, value
+                attributes.update(usage)
+
+        except Exception as e:
+            print(f"Error calling Bedrock: {str(e)}")
+
+        result = parser.result()
+        if result is not None:
+            result["usage"] = usage
+        yield "result", result
+
+    @property
+    def s3_client(self):
+        """S3 client for batch job input and output files, created on first use."""
+        if self._s3_client is None:
+            session = get_session(self.region)
+            with _session_lock:
+                self._s3_client = session.client(
+                    "s3",
+                    region_name=self.region,
+                    endpoint_url=self.endpoint_url,
+                    # A custom endpoint serves buckets as paths rather than host names
+                    config=Config(s3={"addressing_style": "path"}) if self.endpoint_url else None,
+                )
+        return self._s3_client
+
+    def _batch_control(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Call the Bedrock control plane API.
+
+        The pinned boto3 predates the batch inference operations, so their
+        requests are signed and sent over httpx as the async calls are.
+        """
+        endpoint = self.endpoint_url or f"https://bedrock.{self.region}.amazonaws.com"
+        request = self._signed_request(
+            method, f"{endpoint}{path}", json.dumps(payload) if payload is not None else None
+        )
+        response = httpx.request(
+            method, request.url, content=request.body, headers=dict(request.headers), timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def batch_request(self, custom_id: str, image_base64_list: list[PageContent]) -> Dict[str, Any]:
+        """One batch inference record extracting `image_base64_list`, as `submit_batch` takes it."""
+        return {"recordId": custom_id, "modelInput": self._request_params(image_base64_list)}
+
+    def submit_batch(self, requests: list[Dict[str, Any]]) -> str:
+        """Upload `batch_request` records to S3, start a batch inference job on them and return its ARN.
+
+        Batch inference is billed at half the on-demand price and does not
+        count against the InvokeModel quotas, but jobs take up to 24 hours.
+        """
+        if not self.batch_s3_uri or not self.batch_role_arn:
+            raise ValueError(
+                "Bedrock batch inference needs BEDROCK_BATCH_S3_URI and BEDROCK_BATCH_ROLE_ARN to be set."
+            )
+        job_name = f"invoice-batch-{int(time())}-{uuid4().hex[:8]}"
+        bucket, prefix = split_s3_uri(self.batch_s3_uri.rstrip("/") + f"/{job_name}")
+        with span("batch_submit", provider=self.model_key, requests=len(requests)) as attributes:
+            body = "\n".join(json.dumps(request) for request in requests).encode("utf-8")
+            attributes["payload_bytes"] = len(body)
+            self.s3_client.put_object(Bucket=bucket, Key=f"{prefix}/input.jsonl", Body=body)
+            response = self._batch_control("POST", "/model-invocation-job", {
+                "jobName": job_name,
+                "roleArn": self.batch_role_arn,
+                "modelId": self.model_id,
+                "inputDataConfig": {
+                    "s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{prefix}/input.jsonl", "s3InputFormat": "JSONL"}
+                },
+                "outputDataConfig": {"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{prefix}/output/"}},
+            })
+        return response["jobArn"]
+
+    def _batch_job(self, batch_id: str) -> Dict[str, Any]:
+        return self._batch_control("GET", f"/model-invocation-job/{quote(batch_id, safe='')}")
+
+    def batch_status(self, batch_id: str) -> str:
+        """"in_progress", "ended" once its output can be read (complete or not) or "failed"."""
+        job = self._batch_job(batch_id)
+        if job["status"] == "Failed":
+            print(f"Bedrock batch job {batch_id} failed: {job.get('message', '')}")
+            return "failed"
+        return "ended" if job["status"] in BATCH_ENDED_STATUSES else "in_progress"
+
+    def batch_results(self, batch_id: str) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        """Yield (record ID, extracted data) for every record in an ended job's output.
+
+        Results go through the same post-processing as `extract_invoice_data`.
+        Failed records are printed and yield None; records the job did not
+        get to are missing.
+        """
+        job = self._batch_job(batch_id)
+        input_name = split_s3_uri(job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"])[1].rsplit("/", 1)[-1]
+        bucket, output_prefix = split_s3_uri(job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"])
+        # Output goes to <output prefix>/<job ID>/<input file name>.out
+        key = f"{output_prefix.rstrip('/')}/{batch_id.rsplit('/', 1)[-1]}/{input_name}.out"
+        output = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+        for line in output.iter_lines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "modelOutput" not in record:
+                print(f"Batch record {record.get('recordId')} failed: {record.get('error')}")
+                yield record.get("recordId"), None
+                continue
+            try:
+                extracted_data = self._process_response_body(record["modelOutput"])
+            except Exception as e:
+                print(f"Error calling Bedrock: {str(e)}")
+                extracted_data = None
+            yield record["recordId"], extracted_data
@@ -0,0 +1,687 @@
+"""Offline benchmarks of rasterization, the API clients and batch runs.
+
+Usage:
+    python benchmark.py --output benchmark_results.json
+    python benchmark.py --output new.json --baseline benchmark_results.json
+    python benchmark.py --scenarios rasterize client/anthropic --repeat 5
+
+The corpus is generated locally with PyMuPDF into --corpus-dir: a single
+page invoice, a 100-page bundle of invoices, a scanned-style document
+(pages rendered, rotated, noised and embedded as JPEGs, with no text layer)
+and a text-only document. The clients talk to the replay_stub stand-in for
+the Anthropic and Bedrock endpoints, so no network access or credentials
+are needed; its latency and throttling are set with the --latency,
+--tokens-per-second, --jitter, --throttle-rate and --max-concurrency flags.
+
+Scenarios:
+    import/<module>            cold import in a fresh interpreter, against its budget
+    rasterize/<document>       get_image_from_pdf, in pages per second
+    stream_pages/<document>    iter_image_from_pdf, consumed page by page
+    text_layer/<document>      get_document_pages, in pages per second
+    client/<provider>/<mode>   sync, async and stream requests, in requests per second
+    batch/<provider>           run_batch over the corpus, in documents per minute
+
+Each scenario runs in a fresh process, so its peak RSS is its own, and
+reports a sampled peak over it and its render workers as well as p50, p95
+and p99 latencies of the pipeline stages it recorded (see metrics.py).
+Results are written as JSON; with --baseline, throughput, stage p95s and
+peak RSS are compared with an earlier result file and the exit status is 1
+if anything got worse by more than --tolerance, or an import is over its
+budget. Compare runs made with the same settings on the same machine.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+import cv2
+import fitz
+import numpy as np
+
+from batch import PROVIDERS, percentile, run_batch
+from image_processor import get_document_pages, get_image_from_pdf, iter_image_from_pdf
+from metrics import CollectingMetricsSink, Span, collect_spans, set_metrics_sink
+from page_content import PDFPageText, payload_bytes
+from replay_stub import ReplayServer, ReplayStore
+
+CORPUS_DOCUMENTS = ("single_page", "hundred_page", "scanned", "text_only")
+CLIENT_MODES = ("sync", "async", "stream")
+# A4 in points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+SCAN_DPI = 150
+SCAN_JPEG_QUALITY = 75
+VENDORS = ("Acme Supplies GmbH", "Northwind Traders Ltd", "Globex Corporation", "Initech BV")
+PRODUCTS = ("Printer paper A4", "Toner cartridge", "Office chair", "Desk lamp", "Consulting hours", "Shipping")
+# Stage p95 changes smaller than this are timer noise, not regressions
+MIN_STAGE_DELTA = 0.005
+# Cold import budgets in seconds, as measured by `python -X importtime`, for
+# the modules a worker process starts from. Importing them must not load
+# any of LAZY_MODULES, which are imported on first use.
+IMPORT_BUDGETS = {"worker": 0.5, "batch": 0.6}
+LAZY_MODULES = ("streamlit", "pandas", "pyarrow", "cv2", "anthropic", "boto3")
+# Seconds between samples of the process tree's memory
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def synthetic_invoice(index: int, rng: random.Random) -> Dict[str, Any]:
+    """Invoice fields as a model would return them, with string amounts."""
+    line_items = []
+    for line in range(rng.randint(3, 12)):
+        quantity = rng.randint(1, 40)
+        unit_price = round(rng.uniform(2, 900), 2)
+        line_items.append({
+            "description": f"{rng.choice(PRODUCTS)} #{line + 1}",
+            "quantity": str(quantity),
+            "unit_price": f"{unit_price:,.2f}",
+            "total": f"{quantity * unit_price:,.2f}",
+        })
+    net = sum(float(item["total"].replace(",", "")) for item in line_items)
+    return {
+        "number": f"INV-{2024_00000 + index}",
+        "po_number": f"PO-{rng.randint(1000, 9999)}",
+        "vendor": rng.choice(VENDORS),
+        "date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "due_date": "",
+        "payment_terms": "30 days net",
+        "payment_term_days": "30",
+        "currency_code": "EUR",
+        "amount": f"{net * 1.2:,.2f}",
+        "tax_amount": f"{net * 0.2:,.2f}",
+        "line_items": line_items,
+    }
+
+
+def draw_invoice_page(page: fitz.Page, invoice: Dict[str, Any]) -> None:
+    """Lay out an invoice on a page as text, rules and a line item table."""
+    page.draw_rect(fitz.Rect(40, 40, PAGE_WIDTH - 40, 110), color=(0.2, 0.3, 0.6), fill=(0.9, 0.92, 0.97))
+    page.insert_text((56, 72), invoice["vendor"], fontsize=18, fontname="hebo")
+    page.insert_text((56, 96), "Industriestrasse 12, 10115 Berlin", fontsize=10)
+    page.insert_text((400, 72), "INVOICE", fontsize=20, fontname="hebo")
+    details = [
+        ("Invoice number", invoice["number"]),
+        ("PO number", invoice["po_number"]),
+        ("Invoice date", invoice["date"]),
+        ("Payment terms", invoice["payment_terms"]),
+    ]
+    for row, (label, value) in enumerate(details):
+        page.insert_text((56, 145 + row * 16), f"{label}:", fontsize=10, fontname="hebo")
+        page.insert_text((170, 145 + row * 16), value, fontsize=10)
+
+    top = 230
+    columns = (56, 330, 400, 480)
+    for x, header in zip(columns, ("Description", "Qty", "Unit price", "Total")):
+        page.insert_text((x, top), header, fontsize=10, fontname="hebo")
+    page.draw_line((50, top + 6), (PAGE_WIDTH - 50, top + 6))
+    for row, item in enumerate(invoice["line_items"]):
+        y = top + 24 + row * 18
+        values = (item["description"], item["quantity"], item["unit_price"], item["total"])
+        for x, value in zip(columns, values):
+            page.insert_text((x, y), value, fontsize=10)
+    bottom = top + 24 + len(invoice["line_items"]) * 18
+    page.draw_line((50, bottom), (PAGE_WIDTH - 50, bottom))
+    page.insert_text((400, bottom + 20), f"VAT 20%:  {invoice['tax_amount']} EUR", fontsize=10)
+    page.insert_text((400, bottom + 38), f"Total:  {invoice['amount']} EUR", fontsize=11, fontname="hebo")
+
+
+def scanned_page_jpeg(invoice: Dict[str, Any], rng: random.Random) -> bytes:
+    """An invoice page as a scanner would deliver it: gray, skewed, noisy JPEG."""
+    with fitz.open() as doc:
+        page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        draw_invoice_page(page, invoice)
+        zoom = SCAN_DPI / 72
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY)
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.stride)[:, :pix.w]
+    center = (pix.w / 2, pix.h / 2)
+    rotation = cv2.getRotationMatrix2D(center, rng.uniform(-2.0, 2.0), 1.0)
+    image = cv2.warpAffine(image, rotation, (pix.w, pix.h), borderValue=255)
+    image = cv2.GaussianBlur(image, (3, 3), 0)
+    noise = np.random.default_rng(rng.randrange(2**32)).normal(0, 12, image.shape)
+    image = np.clip(image.astype(np.float32) * 0.92 + 10 + noise, 0, 255).astype(np.uint8)
+    _, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, SCAN_JPEG_QUALITY])
+    return encoded.tobytes()
+
+
+def text_only_page(page: fitz.Page, page_number: int, rng: random.Random) -> None:
+    """A page of plain running text (terms and conditions), no graphics."""
+    words = (
+        "invoice payment supplier delivery goods services terms conditions liability "
+        "agreement customer period days notice written order price tax amount due"
+    ).split()
+    lines = [f"General terms and conditions - page {page_number + 1}", ""]
+    for paragraph in range(6):
+        lines.append(f"{page_number + 1}.{paragraph + 1}")
+        for _ in range(7):
+            lines.append(" ".join(rng.choice(words) for _ in range(12)).capitalize() + ".")
+        lines.append("")
+    page.insert_text((56, 60), "\n".join(lines), fontsize=9)
+
+
+def generate_corpus(directory: str, regenerate: bool = False, seed: int = 0) -> Dict[str, str]:
+    """Write the synthetic benchmark PDFs, unless present; returns their paths by name."""
+    os.makedirs(directory, exist_ok=True)
+    paths = {name: os.path.join(directory, f"{name}.pdf") for name in CORPUS_DOCUMENTS}
+    if not regenerate and all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    rng = random.Random(seed)
+    for name, path in paths.items():
+        with fitz.open() as doc:
+            if name in ("single_page", "hundred_page"):
+                for index in range(1 if name == "single_page" else 100):
+                    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+                    draw_invoice_page(page, synthetic_invoice(index, rng))
+            elif name == "scanned":
+                for index in range(3):
+                    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+                    page.insert_image(page.rect, stream=scanned_page_jpeg(synthetic_invoice(index, rng), rng))
+            else:
+                for index in range(5):
+                    text_only_page(doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT), index, rng)
+            doc.save(path, garbage=3, deflate=True)
+    return paths
+
+
+def fallback_result(seed: int = 0) -> Dict[str, Any]:
+    """The result the stand-in returns for unrecorded requests."""
+    return {"document_type": "invoice", "invoices": [synthetic_invoice(0, random.Random(seed))]}
+
+
+def stage_percentiles(spans: list[Span]) -> Dict[str, Dict[str, float]]:
+    """p50/p95/p99 and total seconds per stage, with time to first token as its own stage."""
+    durations: Dict[str, list[float]] = {}
+    errors: Dict[str, int] = {}
+    for recorded in spans:
+        durations.setdefault(recorded.name, []).append(recorded.duration)
+        if "time_to_first_token" in recorded.attributes:
+            durations.setdefault("time_to_first_token", []).append(recorded.attributes["time_to_first_token"])
+        if recorded.attributes.get("error"):
+            errors[recorded.name] = errors.get(recorded.name, 0) + 1
+    return {
+        name: {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            "p50": round(percentile(values, 50), 6),
+            "p95": round(percentile(values, 95), 6),
+            "p99": round(percentile(values, 99), 6),
+            "total": round(sum(values), 6),
+        }
+        for name, values in sorted(durations.items())
+    }
+
+
+def _status_kb(pid: int, field: str) -> int:
+    """A memory field of /proc/<pid>/status in kB, 0 if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _descendants(pid: int) -> list[int]:
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        return pids
+    return pids + [grandchild for child in pids for grandchild in _descendants(child)]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB.
+
+    ru_maxrss survives exec on Linux, so a spawned process would report at
+    least its parent's footprint; VmHWM starts over.
+    """
+    peak_kb = _status_kb(os.getpid(), "VmHWM") or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak_kb / 1024, 1)
+
+
+class TreeRssSampler:
+    """Samples the summed RSS of this process and its descendants, e.g. render workers."""
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        pid = os.getpid()
+        while not self._stopped.is_set():
+            total = sum(_status_kb(process, "VmRSS") for process in [pid] + _descendants(pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self._stopped.wait(self.interval)
+
+    def __enter__(self) -> "TreeRssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak_kb / 1024, 1)
+
+
+def read_pdf(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def bench_import(module: str, budget: float, repeat: int) -> Dict[str, Any]:
+    """Import `module` in a fresh interpreter and check its time against `budget`."""
+    code = (
+        f"import json, sys; import {module}; "
+        f"print(json.dumps([name for name in {LAZY_MODULES!r} if name in sys.modules]))"
+    )
+    best = float("inf")
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        # "import time: self [us] | cumulative | name", with nested imports indented
+        for line in completed.stderr.splitlines():
+            fields = line.split("|")
+            if line.startswith("import time:") and fields[-1] == f" {module}":
+                best = min(best, int(fields[1]) / 1_000_000)
+        eager_modules = json.loads(completed.stdout)
+    return {
+        "seconds": round(best, 4),
+        "budget_seconds": budget,
+        "eager_modules": eager_modules,
+        "over_budget": best > budget or bool(eager_modules),
+        "throughput": round(1 / best, 2),
+        "throughput_unit": "imports/s",
+    }
+
+
+def bench_rasterize(path: str, repeat: int) -> Dict[str, Any]:
+    """Render and encode every page as get_image_from_pdf does for the clients."""
+    pdf_bytes = read_pdf(path)
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        pages = get_image_from_pdf(pdf_bytes)
+        best = min(best, perf_counter() - start)
+    return {
+        "seconds": round(best, 4),
+        "pages": len(pages),
+        "payload_bytes": payload_bytes(pages),
+        "throughput": round(len(pages) / best, 2),
+        "throughput_unit": "pages/s",
+    }
+
+
+def bench_stream_pages(path: str, repeat: int) -> Dict[str, Any]:
+    """Render and encode every page lazily, dropping each once it is consumed."""
+    pdf_bytes = read_pdf(path)
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        pages = total_bytes = 0
+        for page in iter_image_from_pdf(pdf_bytes):
+            pages += 1
+            total_bytes += len(page)
+        best = min(best, perf_counter() - start)
+    return {
+        "seconds": round(best, 4),
+        "pages": pages,
+        "payload_bytes": total_bytes,
+        "throughput": round(pages / best, 2),
+        "throughput_unit": "pages/s",
+    }
+
+
+def bench_text_layer(path: str, repeat: int) -> Dict[str, Any]:
+    """Route every page and read its text layer, rendering the rest."""
+    pdf_bytes = read_pdf(path)
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        pages, _ = get_document_pages(pdf_bytes)
+        best = min(best, perf_counter() - start)
+    return {
+        "seconds": round(best, 4),
+        "pages": len(pages),
+        "text_pages": sum(1 for page in pages if isinstance(page, PDFPageText)),
+        "payload_bytes": payload_bytes(pages),
+        "throughput": round(len(pages) / best, 2),
+        "throughput_unit": "pages/s",
+    }
+
+
+def make_replay_client(provider: str, url: str, prompt_caching: bool = False, tool_output: bool = False):
+    """A client of `provider` pointed at the stand-in."""
+    if provider == "anthropic":
+        from anthropic_client import AnthropicClient
+
+        return AnthropicClient(base_url=url, prompt_caching=prompt_caching, tool_output=tool_output)
+    from bedrock_client import BedrockClient
+
+    return BedrockClient(endpoint_url=url, prompt_caching=prompt_caching, tool_output=tool_output)
+
+
+def bench_client(
+    provider: str,
+    mode: str,
+    url: str,
+    path: str,
+    requests: int,
+    concurrency: int,
+    prompt_caching: bool,
+    tool_output: bool,
+) -> Dict[str, Any]:
+    """Send `requests` extractions of one document, `concurrency` at a time."""
+    # Rendering is not part of this scenario, so its spans are left out
+    with collect_spans():
+        pages = get_image_from_pdf(read_pdf(path))
+    client = make_replay_client(provider, url, prompt_caching, tool_output)
+
+    def extract_stream(_) -> Optional[Dict[str, Any]]:
+        return list(client.extract_invoice_data_stream(pages))[-1][1]
+
+    async def extract_all_async() -> list:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def extract(_) -> Optional[Dict[str, Any]]:
+            async with semaphore:
+                return await client.extract_invoice_data_async(pages)
+
+        return await asyncio.gather(*(extract(index) for index in range(requests)))
+
+    start = perf_counter()
+    # Clients print errors; they are counted as failures instead
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == "async":
+            results = asyncio.run(extract_all_async())
+        else:
+            extract = extract_stream if mode == "stream" else lambda _: client.extract_invoice_data(pages)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(extract, range(requests)))
+    seconds = perf_counter() - start
+    return {
+        "seconds": round(seconds, 4),
+        "requests": requests,
+        "failed": sum(1 for result in results if result is None),
+        "throughput": round(requests / seconds, 2),
+        "throughput_unit": "requests/s",
+    }
+
+
+def bench_batch(
+    provider: str,
+    url: str,
+    paths: list[str],
+    copies: int,
+    concurrency: int,
+    render_workers: Optional[int],
+) -> Dict[str, Any]:
+    """run_batch over `copies` copies of every corpus document."""
+    client = make_replay_client(provider, url)
+    with tempfile.TemporaryDirectory() as directory:
+        batch_paths = []
+        for copy in range(copies):
+            for path in paths:
+                batch_paths.append(os.path.join(directory, f"{copy}_{os.path.basename(path)}"))
+                shutil.copyfile(path, batch_paths[-1])
+        # Progress lines and client errors are left out of the report
+        with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+            summary = run_batch(
+                batch_paths,
+                os.path.join(directory, "results.jsonl"),
+                client,
+                concurrency=concurrency,
+                render_workers=render_workers,
+            )
+    report = summary.as_dict()
+    return {
+        "seconds": report["elapsed_seconds"],
+        "documents": report["documents"],
+        "failed": report["failed"],
+        "latency_p50_seconds": report["latency_p50_seconds"],
+        "latency_p95_seconds": report["latency_p95_seconds"],
+        "throughput": report["documents_per_minute"],
+        "throughput_unit": "documents/min",
+    }
+
+
+def _scenario_worker(function: Callable[..., Dict[str, Any]], kwargs: Dict[str, Any], connection) -> None:
+    # The stand-in ignores credentials; placeholders keep real ones from being sent to it
+    os.environ.update(
+        ANTHROPIC_API_KEY="replay", AWS_ACCESS_KEY_ID="replay", AWS_SECRET_ACCESS_KEY="replay"
+    )
+    os.environ.pop("AWS_SESSION_TOKEN", None)
+    sink = CollectingMetricsSink()
+    set_metrics_sink(sink)
+    try:
+        with TreeRssSampler() as sampler:
+            result = function(**kwargs)
+        result["stages"] = stage_percentiles(sink.spans)
+        result["peak_rss_mb"] = peak_rss_mb()
+        # Render worker processes included; shared pages are counted once per process
+        result["peak_tree_rss_mb"] = sampler.peak_mb
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    connection.send(result)
+    connection.close()
+
+
+def run_scenario(function: Callable[..., Dict[str, Any]], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """Run a scenario in a fresh process and return its report."""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_scenario_worker, args=(function, kwargs, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "scenario process exited without a result"}
+    process.join()
+    return result
+
+
+def scenario_plan(args: argparse.Namespace, corpus: Dict[str, str], url: str) -> list[tuple]:
+    """(name, function, kwargs) of every scenario selected by --scenarios."""
+    plan = [
+        (f"import/{module}", bench_import, {"module": module, "budget": budget, "repeat": args.repeat})
+        for module, budget in IMPORT_BUDGETS.items()
+    ]
+    for name, path in corpus.items():
+        plan.append((f"rasterize/{name}", bench_rasterize, {"path": path, "repeat": args.repeat}))
+        plan.append((f"stream_pages/{name}", bench_stream_pages, {"path": path, "repeat": args.repeat}))
+        plan.append((f"text_layer/{name}", bench_text_layer, {"path": path, "repeat": args.repeat}))
+    for provider in PROVIDERS:
+        for mode in CLIENT_MODES:
+            plan.append((f"client/{provider}/{mode}", bench_client, {
+                "provider": provider,
+                "mode": mode,
+                "url": url,
+                "path": corpus["single_page"],
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "prompt_caching": args.prompt_caching,
+                "tool_output": args.tool_output,
+            }))
+        plan.append((f"batch/{provider}", bench_batch, {
+            "provider": provider,
+            "url": url,
+            "paths": list(corpus.values()),
+            "copies": args.batch_copies,
+            "concurrency": args.concurrency,
+            "render_workers": args.render_workers,
+        }))
+    if args.scenarios:
+        plan = [entry for entry in plan if any(entry[0].startswith(prefix) for prefix in args.scenarios)]
+    return plan
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(
+    current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> list[Dict[str, Any]]:
+    """Changes in throughput, stage p95s and peak RSS against a baseline run."""
+    rows = []
+    for name, scenario in current["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous or "error" in scenario or "error" in previous:
+            continue
+        # (metric, value, baseline value, higher is better, smallest change that counts)
+        metrics = [
+            ("throughput", scenario["throughput"], previous["throughput"], True, 0.0),
+            ("peak_rss_mb", scenario["peak_rss_mb"], previous["peak_rss_mb"], False, 0.0),
+        ]
+        for stage, stats in scenario["stages"].items():
+            if stage in previous["stages"]:
+                metrics.append(
+                    (f"{stage} p95", stats["p95"], previous["stages"][stage]["p95"], False, MIN_STAGE_DELTA)
+                )
+        for metric, value, old, higher_is_better, min_delta in metrics:
+            if not old:
+                continue
+            change = (value - old) / old
+            worse = -change if higher_is_better else change
+            rows.append({
+                "scenario": name,
+                "metric": metric,
+                "baseline": old,
+                "current": value,
+                "change": round(change, 4),
+                "regressed": worse > tolerance and abs(value - old) > min_delta,
+            })
+    return rows
+
+
+def print_report(results: Dict[str, Any], comparison: Optional[list[Dict[str, Any]]]) -> None:
+    for name, scenario in results["scenarios"].items():
+        if "error" in scenario:
+            print(f"{name:32} ERROR {scenario['error']}")
+            continue
+        slowest = max(scenario["stages"].items(), key=lambda item: item[1]["total"], default=None)
+        print(
+            f"{name:32} {scenario['throughput']:>10} {scenario['throughput_unit']:14}"
+            f" peak RSS {scenario['peak_rss_mb']:>7} MB"
+            + (f"  slowest stage {slowest[0]} p95 {slowest[1]['p95']:.4f}s" if slowest else "")
+            + ("  OVER BUDGET" if scenario.get("over_budget") else "")
+        )
+    if comparison is not None:
+        regressions = [row for row in comparison if row["regressed"]]
+        print(f"\n{len(regressions)} regressions against the baseline")
+        for row in regressions:
+            print(
+                f"  {row['scenario']} {row['metric']}: {row['baseline']} -> {row['current']}"
+                f" ({row['change']:+.1%})"
+            )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file results are written to")
+    parser.add_argument("--baseline", help="Earlier result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change counted as a regression")
+    parser.add_argument("--scenarios", nargs="*", help="Only run scenarios starting with these prefixes")
+    parser.add_argument("--corpus-dir", default=".benchmark_corpus")
+    parser.add_argument("--regenerate", action="store_true", help="Rewrite the corpus even if it exists")
+    parser.add_argument("--repeat", type=int, default=3, help="Rasterization runs, the best is kept")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per client scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests kept in flight")
+    parser.add_argument("--batch-copies", type=int, default=3, help="Copies of the corpus per batch run")
+    parser.add_argument("--render-workers", type=int, default=None)
+    parser.add_argument("--prompt-caching", action="store_true")
+    parser.add_argument("--tool-output", action="store_true")
+    parser.add_argument("--recordings", help="replay_stub recordings to replay instead of the synthetic result")
+    parser.add_argument("--latency", type=float, default=0.25, help="Stand-in seconds to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    corpus = generate_corpus(args.corpus_dir, args.regenerate, args.seed)
+    server = ReplayServer(
+        ReplayStore(args.recordings, fallback_result(args.seed)),
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        max_concurrency=args.max_concurrency,
+        seed=args.seed,
+    )
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "scenarios": {},
+    }
+    with server:
+        for name, function, kwargs in scenario_plan(args, corpus, server.url):
+            print(f"Running {name}...", file=sys.stderr)
+            results["scenarios"][name] = run_scenario(function, kwargs)
+        results["stub"] = dict(server.stats)
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_results(results, baseline, args.tolerance)
+        results["comparison"] = comparison
+        changed = [
+            name
+            for name, value in results["config"].items()
+            if name != "scenarios" and baseline.get("config", {}).get(name) != value
+        ]
+        if changed or baseline.get("platform") != results["platform"]:
+            print(
+                f"Warning: the baseline was run with different settings ({', '.join(changed) or 'platform'})",
+                file=sys.stderr,
+            )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_report(results, comparison)
+    failed = any("error" in scenario or scenario.get("over_budget") for scenario in results["scenarios"].values())
+    regressed = comparison is not None and any(row["regressed"] for row in comparison)
+    return 1 if failed or regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""Benchmark the shared normalization against the old per-item parsing loop.
+
+Usage:
+    python benchmark_normalization.py --invoices 20000 --line-items 10
+
+Synthetic invoices carry amounts in the formats models return (plain
+numbers, thousands separators, decimal commas, currency prefixes,
+parentheses for negatives). The old loop is the one both clients used
+before normalization.py. It is timed against `normalize_invoices` (same
+dict output), both over all invoices at once and called once per invoice
+as the clients do for each response, and, followed by a DataFrame build,
+against `invoices_to_frames` (typed tables). Wrongly parsed totals are
+counted.
+"""
+import argparse
+import copy
+import json
+import random
+from time import perf_counter
+
+import pandas as pd
+
+from normalization import invoices_to_frames, normalize_invoices
+
+# (raw value, correct value) pairs the synthetic invoices draw from
+AMOUNT_FORMATS = [
+    (lambda x: x, lambda x: x),
+    (lambda x: f"{x:.2f}", lambda x: x),
+    (lambda x: f"{x:,.2f}", lambda x: x),
+    (lambda x: f"EUR {x:,.2f}".replace(",", " ").replace(".", ","), lambda x: x),
+    (lambda x: f"{x:,.2f}".replace(",", "_").replace(".", ",").replace("_", "."), lambda x: x),
+    (lambda x: f"({x:.2f})", lambda x: -x),
+    (lambda x: f"${x:,.2f}", lambda x: x),
+]
+
+
+def legacy_parse_numeric(value: str) -> float:
+    """The per-character parser both clients used."""
+    if not value or not isinstance(value, str):
+        return 0.0
+    try:
+        cleaned = "".join(c for c in value if c.isdigit() or c in ".-")
+        return float(cleaned)
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def legacy_normalize_invoices(invoices: list) -> list:
+    """The per-invoice, per-item loop both clients used."""
+    for invoice in invoices:
+        invoice["amount"] = legacy_parse_numeric(str(invoice.get("amount", "0")))
+        invoice["tax_amount"] = legacy_parse_numeric(str(invoice.get("tax_amount", "0")))
+        invoice["payment_term_days"] = legacy_parse_numeric(str(invoice.get("payment_term_days", "0")))
+        parsed_items = []
+        for item in invoice.get("line_items", []):
+            parsed_item = item.copy()
+            for field in ["quantity", "unit_price", "total"]:
+                if field in parsed_item and parsed_item[field] is not None:
+                    parsed_item[field] = legacy_parse_numeric(str(parsed_item[field]))
+                else:
+                    parsed_item[field] = 0.0
+            parsed_items.append(parsed_item)
+        invoice["line_items"] = parsed_items
+    return invoices
+
+
+def legacy_to_frame(invoices: list):
+    """The old loop followed by the DataFrame the app builds from line items."""
+    return pd.DataFrame(
+        [item for invoice in legacy_normalize_invoices(invoices) for item in invoice["line_items"]]
+    )
+
+
+def synthetic_invoices(count: int, line_items: int, seed: int = 0) -> tuple[list, list]:
+    """Invoices with mixed amount formats, plus the correct line item totals."""
+    rng = random.Random(seed)
+    invoices = []
+    expected_totals = []
+    for index in range(count):
+        items = []
+        for line in range(line_items):
+            total = round(rng.uniform(1, 20_000), 2)
+            raw, correct = rng.choice(AMOUNT_FORMATS)
+            items.append({
+                "description": f"Item {line}",
+                "quantity": str(rng.randint(1, 50)),
+                "unit_price": f"{total / 2:.2f}",
+                "total": raw(total),
+            })
+            expected_totals.append(correct(total))
+        amount = round(rng.uniform(100, 200_000), 2)
+        invoices.append({
+            "number": f"INV{index:06d}",
+            "amount": rng.choice(AMOUNT_FORMATS)[0](amount),
+            "tax_amount": f"{amount * 0.2:.2f}",
+            "currency_code": rng.choice(["EUR", "gbp", "€", "USD"]),
+            "date": "2024-11-09",
+            "payment_term_days": "30",
+            "line_items": items,
+        })
+    return invoices, expected_totals
+
+
+def time_call(function, invoices: list, repeat: int) -> float:
+    """Best wall time of `repeat` runs, each on a fresh copy of the input."""
+    best = float("inf")
+    for _ in range(repeat):
+        data = copy.deepcopy(invoices)
+        start = perf_counter()
+        function(data)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def count_wrong(totals: list, expected: list) -> int:
+    return sum(1 for value, correct in zip(totals, expected) if abs(value - correct) > 0.005)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=20_000)
+    parser.add_argument("--line-items", type=int, default=10, help="Line items per invoice")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    invoices, expected = synthetic_invoices(args.invoices, args.line_items)
+    results = [{"document_type": "invoice", "invoices": [invoice]} for invoice in invoices]
+
+    legacy = legacy_normalize_invoices(copy.deepcopy(invoices))
+    shared = normalize_invoices(copy.deepcopy(invoices))
+    _, line_item_table = invoices_to_frames(results)
+    report = {
+        "invoices": args.invoices,
+        "line_items": args.invoices * args.line_items,
+        "legacy_loop_seconds": round(time_call(legacy_normalize_invoices, invoices, args.repeat), 4),
+        "legacy_loop_to_dataframe_seconds": round(time_call(legacy_to_frame, invoices, args.repeat), 4),
+        "normalize_invoices_seconds": round(time_call(normalize_invoices, invoices, args.repeat), 4),
+        "normalize_invoices_per_response_seconds": round(
+            time_call(lambda data: [normalize_invoices([invoice]) for invoice in data], invoices, args.repeat), 4
+        ),
+        "invoices_to_frames_seconds": round(
+            time_call(lambda _: invoices_to_frames(results), invoices, args.repeat), 4
+        ),
+        "legacy_wrong_totals": count_wrong(
+            [item["total"] for invoice in legacy for item in invoice["line_items"]], expected
+        ),
+        "normalize_invoices_wrong_totals": count_wrong(
+            [item["total"] for invoice in shared for item in invoice["line_items"]], expected
+        ),
+        "invoices_to_frames_wrong_totals": count_wrong(line_item_table["total"].tolist(), expected),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
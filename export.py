@@ -0,0 +1,236 @@
+"""Columnar export of extraction results to partitioned Parquet datasets.
+
+Usage:
+    python export.py results.jsonl --output invoice_dataset
+    python batch.py invoices/ --output results.jsonl --export-dir invoice_dataset
+
+Results are appended to two datasets under the output directory, `invoices`
+and `line_items`, with the typed columns of `invoices_to_frames` plus the
+source document's path and content hash. Both are partitioned by the
+invoice's month (`invoice_month=2024-06/`, undated invoices under
+`__HIVE_DEFAULT_PARTITION__`) and every flush writes new files next to the
+existing ones, so exports from many runs accumulate in one dataset.
+
+The datasets can be scanned without loading them whole, reading only the
+partitions and columns a query needs:
+
+    import pyarrow.dataset as ds
+    from export import open_table
+
+    line_items = open_table("invoice_dataset", "line_items")
+    june = line_items.to_table(
+        columns=["pdf_hash", "invoice", "description", "total"],
+        filter=ds.field("invoice_month") == "2024-06",
+    )
+
+A document exported twice (e.g. re-extracted after a prompt change) appears
+twice; `exported_at` tells the copies apart.
+"""
+import argparse
+import json
+import os
+import sys
+import uuid
+from typing import Any, Dict, Iterable, Optional
+
+from normalization import invoices_to_frames
+
+# Rows buffered across both tables before they are written out
+DEFAULT_BATCH_ROWS = 100_000
+TABLES = ("invoices", "line_items")
+PARTITION_COLUMN = "invoice_month"
+
+
+def table_schema(table: str):
+    """Arrow schema of the `invoices` or `line_items` dataset."""
+    import pyarrow as pa
+
+    keys = [("pdf_hash", pa.string()), ("source", pa.string()), ("invoice", pa.int64())]
+    if table == "invoices":
+        columns = [
+            ("document_type", pa.string()),
+            ("number", pa.string()),
+            ("po_number", pa.string()),
+            ("vendor", pa.string()),
+            ("amount", pa.float64()),
+            ("tax_amount", pa.float64()),
+            ("payment_term_days", pa.int64()),
+            ("currency_code", pa.string()),
+            ("date", pa.date32()),
+            ("due_date", pa.date32()),
+        ]
+    elif table == "line_items":
+        columns = [
+            ("line", pa.int64()),
+            ("description", pa.string()),
+            ("quantity", pa.float64()),
+            ("unit_price", pa.float64()),
+            ("total", pa.float64()),
+        ]
+    else:
+        raise ValueError(f"Unknown table: {table}")
+    return pa.schema(
+        keys + columns + [("exported_at", pa.timestamp("us", tz="UTC")), (PARTITION_COLUMN, pa.string())]
+    )
+
+
+def _partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive")
+
+
+def open_table(directory: str, table: str):
+    """Open an exported table as a `pyarrow.dataset.Dataset`.
+
+    Nothing is read until it is scanned; filters on `invoice_month` skip
+    whole partitions and other filters are checked against row group
+    statistics first.
+    """
+    import pyarrow.dataset as ds
+
+    return ds.dataset(
+        os.path.join(directory, table),
+        schema=table_schema(table),
+        format="parquet",
+        partitioning=_partitioning(),
+    )
+
+
+class InvoiceDatasetWriter:
+    """Appends extraction results to the `invoices` and `line_items` datasets.
+
+    Results are buffered until they add up to `batch_rows` invoice and line
+    item rows, then converted and written as one set of Parquet files per
+    partition, so memory stays bounded however many documents are exported.
+    Call `close` (or use it as a context manager) to write the remainder.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        batch_rows: int = DEFAULT_BATCH_ROWS,
+        decimal_comma: Optional[bool] = None,
+    ):
+        """
+        Args:
+            directory (str): Dataset root; `invoices/` and `line_items/` are created under it
+            batch_rows (int): Rows buffered before they are written out
+            decimal_comma (bool): Passed to the amount parsing of `invoices_to_frames`
+        """
+        self.directory = directory
+        self.batch_rows = batch_rows
+        self.decimal_comma = decimal_comma
+        self.documents = 0
+        self.rows = {table: 0 for table in TABLES}
+        self._results: list[Dict[str, Any]] = []
+        self._sources: list[tuple[str, str]] = []
+        self._buffered_rows = 0
+
+    def add(self, result: Optional[Dict[str, Any]], source: str, pdf_hash: str) -> None:
+        """Buffer one document's extraction result, writing out once the buffer is full."""
+        if not result or not result.get("invoices"):
+            return
+        self._results.append(result)
+        self._sources.append((source, pdf_hash))
+        self._buffered_rows += sum(
+            1 + len(invoice.get("line_items") or []) for invoice in result["invoices"]
+        )
+        if self._buffered_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered results out as new files in both datasets."""
+        if not self._results:
+            return
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        invoices, line_items = invoices_to_frames(self._results, decimal_comma=self.decimal_comma)
+        # `source` is the position in the buffer until it is mapped back below
+        sources = pd.DataFrame(self._sources, columns=["source", "pdf_hash"], dtype="string")
+        invoices[PARTITION_COLUMN] = invoices["date"].dt.strftime("%Y-%m").astype("string")
+        line_items = line_items.merge(
+            invoices[["source", "invoice", PARTITION_COLUMN]], on=["source", "invoice"], how="left"
+        )
+        exported_at = pd.Timestamp.now(tz="UTC")
+        # One basename per flush, so files from earlier flushes and runs are kept
+        basename_template = f"part-{uuid.uuid4().hex}-{{i}}.parquet"
+        for table, frame in (("invoices", invoices), ("line_items", line_items)):
+            if frame.empty:
+                continue
+            positions = frame["source"].to_numpy(dtype="int64")
+            frame["source"] = sources["source"].to_numpy()[positions]
+            frame["pdf_hash"] = sources["pdf_hash"].to_numpy()[positions]
+            frame["exported_at"] = exported_at
+            schema = table_schema(table)
+            arrow_table = pa.Table.from_pandas(frame[schema.names], schema=schema, preserve_index=False)
+            ds.write_dataset(
+                arrow_table,
+                os.path.join(self.directory, table),
+                format="parquet",
+                partitioning=_partitioning(),
+                basename_template=basename_template,
+                existing_data_behavior="overwrite_or_ignore",
+            )
+            self.rows[table] += arrow_table.num_rows
+
+        self.documents += len(self._results)
+        self._results = []
+        self._sources = []
+        self._buffered_rows = 0
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> "InvoiceDatasetWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def export_records(records: Iterable[Dict[str, Any]], writer: InvoiceDatasetWriter) -> int:
+    """Export `batch.py` output records that succeeded; returns how many were skipped."""
+    skipped = 0
+    for record in records:
+        if record.get("status") != "ok" or not record.get("pdf_hash"):
+            skipped += 1
+            continue
+        writer.add(record["result"], record["source"], record["pdf_hash"])
+    return skipped
+
+
+def read_records(paths: Iterable[str]) -> Iterable[Dict[str, Any]]:
+    """Records of JSONL output files, read one line at a time."""
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="JSONL output files of batch.py")
+    parser.add_argument("--output", required=True, help="Dataset root directory")
+    parser.add_argument(
+        "--batch-rows",
+        type=int,
+        default=DEFAULT_BATCH_ROWS,
+        help="Invoice and line item rows buffered before they are written out",
+    )
+    args = parser.parse_args(argv)
+
+    with InvoiceDatasetWriter(args.output, batch_rows=args.batch_rows) as writer:
+        skipped = export_records(read_records(args.inputs), writer)
+    print(
+        json.dumps({"documents": writer.documents, "skipped": skipped, **writer.rows}, indent=2)
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,533 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import chain
+from math import isnan
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from image_processor import (
+    MAX_DETAIL_LEVEL,
+    PageTriage,
+    RenderBudget,
+    encode_page_images,
+    get_pdf_page_images,
+    iter_image_from_pdf,
+    kept_page_numbers,
+    locate_invoice_pages,
+    pdf_page_count,
+    possible_duplicates,
+    skipped_pages,
+)
+from metrics import span
+from page_content import USAGE_FIELDS, PageContent
+
+
+# Chunked extraction: documents longer than CHUNK_PAGES are split into
+# windows of CHUNK_PAGES pages that overlap by CHUNK_OVERLAP pages, so an
+# invoice running across a window boundary is seen whole in one window.
+CHUNK_PAGES = 10
+CHUNK_OVERLAP = 1
+# Page windows requested at once; with the renderer's look-ahead this bounds
+# how many pages of a streamed document are held in memory
+MAX_WINDOWS_IN_FLIGHT = 8
+EXTRACTED_DOCUMENT_TYPES = ("invoice", "reminder", "credit_note")
+
+
+# Validation: local checks of a parsed result that point at the invoices,
+# and through the text layer the pages, worth requesting again
+AMOUNT_TOLERANCE = 0.02
+AMOUNT_RELATIVE_TOLERANCE = 0.001
+MAX_VALIDATION_RETRIES = 2
+# Issues whose pages are requested again as they are, for the invoices that
+# were missed rather than misread; the others get a sharper render
+MISSING_INVOICE_REASONS = ("truncated", "failed_pages")
+
+
+@dataclass
+class ValidationIssue:
+    reason: str  # "no_result", "truncated", "failed_pages", "missing_fields", "line_item_total" or "line_items_sum"
+    detail: str
+    # Position of the invoice in the result, None for issues of the whole result
+    invoice: Optional[int] = None
+    # Pages the issue was located on; empty if it could not be, meaning all pages
+    pages: list[int] = field(default_factory=list)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """As recorded on results under "validation_issues", with pages numbered from 1."""
+        issue: Dict[str, Any] = {"reason": self.reason, "detail": self.detail}
+        if self.invoice is not None:
+            issue["invoice"] = self.invoice
+        if self.pages:
+            issue["pages"] = [page + 1 for page in self.pages]
+        return issue
+
+
+def _amount(value: Any) -> Optional[float]:
+    """A numeric field as a float, None where it is missing (0.0 once normalized)."""
+    if isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number and not isnan(number) else None
+
+
+def _amounts_match(a: float, b: float) -> bool:
+    return abs(a - b) <= max(AMOUNT_TOLERANCE, AMOUNT_RELATIVE_TOLERANCE * max(abs(a), abs(b)))
+
+
+def validate_invoice(invoice: Dict[str, Any], index: Optional[int] = None) -> list[ValidationIssue]:
+    """Check that an invoice has a number or amount and that its arithmetic adds up.
+
+    Each line item's quantity times unit price must match its total, and the
+    line totals must sum to the amount with or without the tax. Checks are
+    skipped where the values they need are missing.
+    """
+    issues = []
+    amount = _amount(invoice.get("amount"))
+    if not invoice.get("number") and amount is None:
+        issues.append(ValidationIssue("missing_fields", "no invoice number or amount", index))
+
+    items = invoice.get("line_items")
+    totals = []
+    for line, item in enumerate(items if isinstance(items, list) else []):
+        if not isinstance(item, dict):
+            continue
+        quantity, unit_price, total = (_amount(item.get(f)) for f in ("quantity", "unit_price", "total"))
+        totals.append(total)
+        if quantity is not None and unit_price is not None and total is not None:
+            if not _amounts_match(quantity * unit_price, total):
+                issues.append(ValidationIssue(
+                    "line_item_total", f"line {line + 1}: {quantity:g} x {unit_price:g} != {total:g}", index
+                ))
+
+    if amount is not None and totals and None not in totals:
+        line_sum = sum(totals)
+        tax = _amount(invoice.get("tax_amount")) or 0.0
+        # Line items may be net or gross of tax, and credit notes negative on one side only
+        if not any(_amounts_match(abs(line_sum), abs(expected)) for expected in (amount, amount - tax)):
+            issues.append(ValidationIssue(
+                "line_items_sum", f"line items sum to {line_sum:.2f}, amount is {amount:.2f}", index
+            ))
+    return issues
+
+
+def validate_result(result: Optional[Dict[str, Any]]) -> list[ValidationIssue]:
+    """Check a parsed result locally, without calling the model; empty when it looks valid.
+
+    Besides the per-invoice checks of `validate_invoice`, a response cut off
+    at max_tokens and pages lost with failed page windows are issues of the
+    whole result.
+    """
+    if result is None or not isinstance(result.get("invoices"), list):
+        return [ValidationIssue("no_result", "no usable result")]
+    issues = []
+    for index, invoice in enumerate(result["invoices"]):
+        if isinstance(invoice, dict):
+            issues.extend(validate_invoice(invoice, index))
+    if result.get("truncated"):
+        issues.append(ValidationIssue("truncated", f"response ended after {len(result['invoices'])} invoices"))
+    if result.get("failed_pages"):
+        issues.append(ValidationIssue(
+            "failed_pages", "extraction failed for some pages", pages=[page - 1 for page in result["failed_pages"]]
+        ))
+    return issues
+
+
+def locate_issues(
+    issues: list[ValidationIssue], result: Optional[Dict[str, Any]], pdf_bytes: bytes, page_numbers: list[int]
+) -> None:
+    """Set the pages of each invoice issue from where the invoice's number appears.
+
+    An invoice is taken to run from the first page mentioning its number up
+    to the page before the next invoice starts, or the last of `page_numbers`.
+    A truncated response is located from the first page of its last complete
+    invoice onwards. Issues that cannot be located, e.g. on scanned pages,
+    are left without pages.
+    """
+    invoices = result.get("invoices") if result else None
+    if not invoices or not any(issue.invoice is not None or issue.reason == "truncated" for issue in issues):
+        return
+    located = locate_invoice_pages(
+        pdf_bytes, [invoice.get("number") if isinstance(invoice, dict) else None for invoice in invoices], page_numbers
+    )
+    starts = sorted({pages[0] for pages in located if pages})
+
+    def invoice_pages(index: int) -> list[int]:
+        pages = located[index]
+        if not pages:
+            return []
+        next_start = next((start for start in starts if start > pages[0]), None)
+        end = max(pages[-1], next_start - 1 if next_start is not None else page_numbers[-1])
+        return [page for page in page_numbers if pages[0] <= page <= end]
+
+    for issue in issues:
+        if issue.reason == "truncated":
+            last_invoice = invoice_pages(len(invoices) - 1)
+            if last_invoice:
+                issue.pages = [page for page in page_numbers if page >= last_invoice[0]]
+        elif issue.invoice is not None:
+            issue.pages = invoice_pages(issue.invoice)
+
+
+def merge_corrections(
+    result: Optional[Dict[str, Any]], issues: list[ValidationIssue], correction: Optional[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """Merge a re-extraction of the pages behind `issues` back into `result`.
+
+    A failing invoice is replaced by its copy in the correction (matched by
+    number and vendor, or else in order among failing invoices without a
+    number) only if the copy has fewer validation issues. Invoices the
+    correction adds are kept only where the result was missing some, i.e. it
+    was truncated or lost pages; other invoices it repeats are ignored.
+    Token usage is summed.
+    """
+    if correction is None or not isinstance(correction.get("invoices"), list):
+        return result
+    if result is None or not isinstance(result.get("invoices"), list):
+        return correction
+
+    failing = {issue.invoice for issue in issues if issue.invoice is not None}
+    reasons = {issue.reason for issue in issues}
+    invoices = list(result["invoices"])
+    unnumbered = [index for index in sorted(failing) if not _normalize_key(invoices[index].get("number"))]
+    for invoice in correction["invoices"]:
+        index = _matching_invoice(invoices, invoice)
+        if index is None and unnumbered:
+            index = unnumbered.pop(0)
+        if index is None:
+            if reasons.intersection(MISSING_INVOICE_REASONS):
+                invoices.append(invoice)
+        elif index in failing and len(validate_invoice(invoice)) < len(validate_invoice(invoices[index])):
+            invoices[index] = invoice
+
+    merged = {**result, "invoices": invoices}
+    if "truncated" in reasons and not correction.get("truncated"):
+        merged.pop("truncated", None)
+    if "failed_pages" in reasons:
+        retried = {page + 1 for issue in issues if issue.reason == "failed_pages" for page in issue.pages}
+        failed_pages = sorted(set(result["failed_pages"]) - retried | set(correction.get("failed_pages") or []))
+        if failed_pages:
+            merged["failed_pages"] = failed_pages
+        else:
+            merged.pop("failed_pages", None)
+    if "usage" in result or "usage" in correction:
+        merged["usage"] = {
+            field: result.get("usage", {}).get(field, 0) + correction.get("usage", {}).get(field, 0)
+            for field in USAGE_FIELDS
+        }
+    return merged
+
+
+def correct_invoice_data(
+    client,
+    pdf_bytes: bytes,
+    result: Optional[Dict[str, Any]],
+    budget: Optional[RenderBudget] = None,
+    page_numbers: Optional[list[int]] = None,
+    validate: Callable[[Optional[Dict[str, Any]]], list[ValidationIssue]] = validate_result,
+    max_retries: int = MAX_VALIDATION_RETRIES,
+    max_detail_level: int = MAX_DETAIL_LEVEL,
+    max_workers: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """Request again only the parts of `result` that fail `validate`, and merge in the corrections.
+
+    `result` was extracted from `page_numbers` (all pages by default), with
+    any "failed_pages" numbered as pages of the whole document, as
+    `apply_triage` leaves them. Each round locates the issues on pages (see
+    `locate_issues`), renders just those pages within `budget` and extracts
+    them in one request per page window; pages of misread invoices are
+    rendered one detail level higher each round, up to `max_detail_level`.
+    Issues that cannot be located send every page again. Issues left after
+    `max_retries` rounds are recorded on the result under "validation_issues".
+    Pages are rendered by up to `max_workers` processes (see
+    `get_pdf_page_images`); pass 1 where the caller already runs its own pool.
+    """
+    budget = budget or RenderBudget()
+    if page_numbers is None:
+        page_numbers = list(range(pdf_page_count(pdf_bytes)))
+    detail_levels = {page_num: 0 for page_num in page_numbers}
+
+    for attempt in range(max_retries + 1):
+        with span("validate") as attributes:
+            issues = validate(result)
+            locate_issues(issues, result, pdf_bytes, page_numbers)
+            retry_pages = sorted({page for issue in issues for page in issue.pages or page_numbers})
+            attributes.update(issues=len(issues), retry_pages=len(retry_pages) if attempt < max_retries else 0)
+        if not issues or attempt == max_retries:
+            break
+
+        for page_num in {
+            page
+            for issue in issues
+            if issue.reason not in MISSING_INVOICE_REASONS
+            for page in issue.pages or page_numbers
+        }:
+            detail_levels[page_num] = min(detail_levels[page_num] + 1, max_detail_level)
+        # A response cut off at max_tokens is requested again in halves, each with fewer invoices to return
+        window = CHUNK_PAGES
+        if any(issue.reason == "truncated" for issue in issues):
+            window = max(1, (len(retry_pages) + 1) // 2)
+        page_images = get_pdf_page_images(
+            pdf_bytes,
+            max_workers=max_workers,
+            page_numbers=retry_pages,
+            budget=budget,
+            detail_levels=detail_levels,
+        )
+        correction = extract_invoice_data_chunked(client, encode_page_images(page_images), window=window)
+        if correction is not None and correction.get("failed_pages"):
+            correction["failed_pages"] = [retry_pages[page - 1] + 1 for page in correction["failed_pages"]]
+        result = merge_corrections(result, issues, correction)
+
+    if result is not None:
+        if issues:
+            result["validation_issues"] = [issue.as_dict() for issue in issues]
+        else:
+            result.pop("validation_issues", None)
+    return result
+
+
+def extract_invoice_data_adaptive(
+    client,
+    pdf_bytes: bytes,
+    budget: Optional[RenderBudget] = None,
+    page_triage: Optional[list[PageTriage]] = None,
+    validate: Callable[[Optional[Dict[str, Any]]], list[ValidationIssue]] = validate_result,
+    max_retries: int = MAX_VALIDATION_RETRIES,
+    max_detail_level: int = MAX_DETAIL_LEVEL,
+    max_workers: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """Extract with adaptively rendered pages, then correct what fails validation.
+
+    Pages (all, or only those `page_triage` keeps) are streamed through the
+    renderer within `budget` at detail level 0 and extracted as in
+    `extract_invoice_data_chunked`, with the triage recorded by
+    `apply_triage`. `correct_invoice_data` then requests only the pages
+    behind failing invoices again, rather than the whole document.
+    """
+    budget = budget or RenderBudget()
+    if page_triage is not None:
+        page_numbers = kept_page_numbers(page_triage)
+    else:
+        page_numbers = list(range(pdf_page_count(pdf_bytes)))
+    result = extract_invoice_data_chunked(
+        client, iter_image_from_pdf(pdf_bytes, budget=budget, page_numbers=page_numbers)
+    )
+    if page_triage is not None:
+        result = apply_triage(result, page_triage)
+    elif result is not None and result.get("failed_pages"):
+        result["failed_pages"] = [page_numbers[page - 1] + 1 for page in result["failed_pages"]]
+    return correct_invoice_data(
+        client, pdf_bytes, result, budget, page_numbers, validate, max_retries, max_detail_level, max_workers
+    )
+
+
+def result_status(result: Dict[str, Any]) -> str:
+    """"partial" if pages were lost or a response was cut off, so a re-run retries it, else "ok"."""
+    return "partial" if result.get("failed_pages") or result.get("truncated") else "ok"
+
+
+def apply_triage(result: Optional[Dict[str, Any]], triage: list[PageTriage]) -> Optional[Dict[str, Any]]:
+    """Record the pages triage skipped on a result extracted from the kept pages.
+
+    Adds "skipped_pages", "possible_duplicates" (pages kept although they
+    look like an earlier one) and maps "failed_pages", which count the pages
+    that were sent, back to page numbers of the whole document.
+    """
+    if result is None:
+        return None
+    kept = kept_page_numbers(triage)
+    if result.get("failed_pages"):
+        result["failed_pages"] = [kept[page - 1] + 1 for page in result["failed_pages"]]
+    skipped = skipped_pages(triage)
+    if skipped:
+        result["skipped_pages"] = skipped
+    possible = possible_duplicates(triage)
+    if possible:
+        result["possible_duplicates"] = possible
+    return result
+
+
+def page_windows(page_count: int, window: int = CHUNK_PAGES, overlap: int = CHUNK_OVERLAP) -> list[range]:
+    """Split `page_count` pages into overlapping windows covering every page."""
+    if page_count <= window:
+        return [range(page_count)]
+    step = max(1, window - overlap)
+    windows = []
+    for start in range(0, page_count, step):
+        windows.append(range(start, min(start + window, page_count)))
+        if start + window >= page_count:
+            break
+    return windows
+
+
+def iter_page_windows(
+    pages: Iterable[PageContent], window: int = CHUNK_PAGES, overlap: int = CHUNK_OVERLAP
+) -> Iterator[tuple[range, list[PageContent]]]:
+    """Group pages into the windows of `page_windows` as they arrive.
+
+    Yields each window's page range and pages; only the pages of the window
+    being filled are buffered.
+    """
+    step = max(1, window - overlap)
+    start = 0
+    buffer: list[PageContent] = []
+    for page in pages:
+        if len(buffer) == window:
+            # Only emitted once another page shows it is not the last window
+            yield range(start, start + window), buffer
+            buffer = buffer[step:]
+            start += step
+        buffer.append(page)
+    if buffer:
+        yield range(start, start + len(buffer)), buffer
+
+
+def _normalize_key(value: Any) -> str:
+    return "".join(c for c in str(value or "").lower() if c.isalnum())
+
+
+def _merge_line_items(existing: list, new: list) -> list:
+    """Union of two line item lists, dropping items repeated by the overlap page."""
+    merged = list(existing)
+    seen = {
+        tuple(_normalize_key(item.get(f)) for f in ("description", "quantity", "unit_price", "total"))
+        for item in existing
+    }
+    for item in new:
+        key = tuple(_normalize_key(item.get(f)) for f in ("description", "quantity", "unit_price", "total"))
+        if key not in seen:
+            seen.add(key)
+            merged.append(item)
+    return merged
+
+
+def _matching_invoice(invoices: list[Dict[str, Any]], invoice: Dict[str, Any]) -> Optional[int]:
+    """Index of the invoice with the same normalized number and vendor (an empty vendor matches any)."""
+    number = _normalize_key(invoice.get("number"))
+    if not number:
+        return None
+    vendor = _normalize_key(invoice.get("vendor"))
+    return next(
+        (
+            index
+            for index, existing in enumerate(invoices)
+            if _normalize_key(existing.get("number")) == number
+            and (
+                not vendor
+                or not _normalize_key(existing.get("vendor"))
+                or _normalize_key(existing.get("vendor")) == vendor
+            )
+        ),
+        None,
+    )
+
+
+def merge_invoice_results(partials: list[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Reduce per-window results into one result for the whole document.
+
+    Invoices are deduplicated by normalized number and vendor (an empty
+    vendor matches any vendor). Missing fields are filled in from later
+    copies, and their line items are merged. Token usage is summed, and the
+    result is "truncated" if any window's response was.
+    """
+    results = [partial for partial in partials if partial is not None]
+    if not results:
+        return None
+
+    document_types = [result.get("document_type") for result in results]
+    document_type = next(
+        (t for t in document_types if t in EXTRACTED_DOCUMENT_TYPES),
+        document_types[0],
+    )
+
+    invoices: list[Dict[str, Any]] = []
+    for result in results:
+        for invoice in result.get("invoices") or []:
+            index = _matching_invoice(invoices, invoice)
+            if index is None:
+                invoices.append(dict(invoice))
+                continue
+            match = invoices[index]
+            for field, value in invoice.items():
+                if field == "line_items":
+                    match["line_items"] = _merge_line_items(match.get("line_items") or [], value or [])
+                elif not match.get(field) and value:
+                    match[field] = value
+
+    merged = {"document_type": document_type, "invoices": invoices}
+    if any(result.get("truncated") for result in results):
+        merged["truncated"] = True
+    if any("usage" in result for result in results):
+        merged["usage"] = {
+            field: sum(r.get("usage", {}).get(field, 0) for r in results) for field in USAGE_FIELDS
+        }
+    return merged
+
+
+def _merge_chunk_results(windows: list[range], partials: list[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    merged = merge_invoice_results(partials)
+    if merged is not None:
+        covered = {page for window, partial in zip(windows, partials) if partial is not None for page in window}
+        failed_pages = sorted(
+            {page + 1 for window in windows for page in window if page not in covered}
+        )
+        if failed_pages:
+            # Keep what the other windows found, but flag the pages that were lost
+            merged["failed_pages"] = failed_pages
+    return merged
+
+
+def merge_window_results(windows: list[range], partials: list[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Combine the results of `page_windows` requests made elsewhere, e.g. in a batch.
+
+    A single window's result is returned as it is, as
+    `extract_invoice_data_chunked` does; pages covered only by failed windows
+    are listed under "failed_pages".
+    """
+    if len(windows) == 1:
+        return partials[0]
+    return _merge_chunk_results(windows, partials)
+
+
+def extract_invoice_data_chunked(
+    client,
+    pages: Iterable[PageContent],
+    window: int = CHUNK_PAGES,
+    overlap: int = CHUNK_OVERLAP,
+    max_windows_in_flight: int = MAX_WINDOWS_IN_FLIGHT,
+) -> Optional[Dict[str, Any]]:
+    """Extract a long document as concurrent page windows and merge the results.
+
+    Short documents are sent as a single request. Windows run in parallel
+    threads, so wall-clock time follows the slowest window rather than the
+    page count. If some windows fail, the merged result lists their pages
+    under "failed_pages"; None is returned only if every window failed.
+
+    `pages` may be a lazy iterator such as `iter_image_from_pdf`: each window
+    is requested as soon as its pages have arrived, and no more pages are
+    pulled while `max_windows_in_flight` windows are waiting, so only those
+    windows' pages are held in memory.
+    """
+    windows = iter_page_windows(pages, window, overlap)
+    first = next(windows, None)
+    if first is None:
+        return None
+    second = next(windows, None)
+    if second is None:
+        return client.extract_invoice_data(first[1])
+
+    window_ranges: list[range] = []
+    futures = []
+    windows = chain([first, second], windows)
+    first = second = None
+    with ThreadPoolExecutor(max_workers=max_windows_in_flight) as executor:
+        in_flight: set = set()
+        for page_range, window_pages in windows:
+            if len(in_flight) >= max_windows_in_flight:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            window_ranges.append(page_range)
+            futures.append(executor.submit(client.extract_invoice_data, window_pages))
+            in_flight.add(futures[-1])
+    return _merge_chunk_results(window_ranges, [future.result() for future in futures])
@@ -1,10 +1,117 @@
 import fitz
 import numpy as np
-import cv2
+# OpenCV is imported by the functions that use it, so importing this module
+# (e.g. for the text layer or triage) does not pay for it up front
 import base64
-from typing import Optional
-from dataclasses import dataclass
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterable, Iterator, Optional
+from dataclasses import dataclass, field
 from time import time
+from metrics import record_span, span
+from page_content import PageContent, PDFPageText
+
+# Quality used for the single JPEG encode of every rendered page
+JPEG_QUALITY = 90
+
+# Documents shorter than this are rendered serially; below it the cost of
+# starting worker processes outweighs the rendering time saved
+PARALLEL_MIN_PAGES = 8
+
+# Text-layer fast path: a page is sent as text when it has at least
+# MIN_TEXT_CHARS non-whitespace characters, at least MIN_PRINTABLE_RATIO of
+# them are printable and no more than MAX_IMAGE_COVERAGE of the page is
+# covered by images
+MIN_TEXT_CHARS = 100
+MIN_PRINTABLE_RATIO = 0.9
+MAX_IMAGE_COVERAGE = 0.5
+
+# Adaptive rendering (see plan_page_render). Pages whose thumbnail has less
+# than SPARSE_INK_RATIO of pixels darker than INK_THRESHOLD get half the
+# pixel budget, and pages whose mean saturation is below
+# GRAYSCALE_MAX_SATURATION are sent in grayscale. Each detail level above 0
+# doubles the pixel budget, up to MAX_IMAGE_SIDE pixels per side.
+SPARSE_INK_RATIO = 0.01
+INK_THRESHOLD = 200
+GRAYSCALE_MAX_SATURATION = 8.0
+MAX_DETAIL_LEVEL = 2
+MAX_IMAGE_SIDE = 8000
+THUMBNAIL_ZOOM = 0.2
+JPEG_QUALITY_STEP = 10
+
+# Page triage (see triage_pdf_pages). A page is blank when less than
+# BLANK_INK_RATIO of its thumbnail is ink and its text layer has no more
+# than BLANK_MAX_TEXT_CHARS characters, or it says it was left blank. Pages
+# with a usable text layer are duplicates when their text is identical.
+# Image-only pages whose perceptual hashes differ in at most
+# DUPLICATE_MAX_HASH_DISTANCE of PHASH_SIZE**2 bits are only candidates:
+# same-template invoices hash that close too, so a page is skipped only if
+# its hash is identical and both pages rendered at DUPLICATE_CONFIRM_ZOOM
+# have no pixel differing by more than DUPLICATE_PIXEL_TOLERANCE. Other
+# candidates are kept and reported as possible duplicates. A page is
+# boilerplate when its text layer has at most BOILERPLATE_MAX_AMOUNTS money
+# amounts and either hits at least BOILERPLATE_MIN_KEYWORDS of the legal
+# keywords, or is a tear-off remittance slip: it has a remittance marker and
+# nothing of an invoice (number, totals, line items). Invoice pages often
+# end in a tear-off stub with the same markers, and are kept.
+BLANK_INK_RATIO = 0.0005
+BLANK_MAX_TEXT_CHARS = 40
+BLANK_PAGE_MARKERS = ("intentionally left blank", "page left blank", "this page is blank")
+PHASH_SIZE = 16
+PHASH_SAMPLE_SIDE = 64
+DUPLICATE_MAX_HASH_DISTANCE = 10
+DUPLICATE_CONFIRM_ZOOM = 1.0
+DUPLICATE_PIXEL_TOLERANCE = 32
+BOILERPLATE_KEYWORDS = (
+    "terms and conditions",
+    "general terms",
+    "liability",
+    "governing law",
+    "jurisdiction",
+    "warranty",
+    "indemnif",
+    "force majeure",
+    "retention of title",
+    "arbitration",
+    "severability",
+    "data protection",
+    "privacy policy",
+)
+BOILERPLATE_MIN_KEYWORDS = 3
+BOILERPLATE_MAX_AMOUNTS = 2
+REMITTANCE_SLIP_MARKERS = ("please detach", "detach and return", "return this portion", "remittance slip")
+# Matched against the lower-cased text; any hit keeps a page with a remittance marker
+INVOICE_CONTENT_PATTERN = re.compile(
+    r"\binvoice\s*(?:no\b|number|#)|\b(?:sub)?total\b|\bqty\b|\bquantity\b|\bunit price\b|\bline items?\b"
+)
+MONEY_AMOUNT_PATTERN = re.compile(r"\d[\d.,' ]*[.,]\d{2}\b")
+# Invoice numbers shorter than this match too much unrelated text to locate a page by
+MIN_LOCATABLE_NUMBER_CHARS = 4
+
+# Document opened once per render worker process by _init_render_worker
+_worker_doc: Optional[fitz.Document] = None
+
+@dataclass
+class RenderBudget:
+    """Per-page limits for adaptive rendering.
+
+    The defaults keep pages around the ~1.15 megapixels vision models work
+    at, and well below the 3.75 MB Bedrock / 5 MB Anthropic image limits.
+    """
+    max_bytes: int = 1_000_000
+    max_pixels: int = 1_150_000
+    max_quality: int = 85
+    min_quality: int = 45
+
+@dataclass
+class RenderPlan:
+    zoom: float
+    grayscale: bool
+    quality: int
+    detail_level: int = 0
+    ink_ratio: float = 0.0
 
 @dataclass
 class PDFPageImage:
@@ -13,36 +120,133 @@ class PDFPageImage:
     height: int
     applied_rotation: float
     elapsed_time: float
+    # Per-stage timings in seconds, e.g. {"render": ..., "preprocess": ..., "encode": ...}
+    stage_timings: dict[str, float] = field(default_factory=dict)
+    # Settings chosen by adaptive rendering, None for fixed-zoom renders
+    render_plan: Optional[RenderPlan] = None
+
+@dataclass
+class PDFPageRoute:
+    page_number: int
+    route: str  # "text" or "image"
+    reason: str
+    char_count: int
+    image_coverage: float
+
+@dataclass
+class PageTriage:
+    page_number: int
+    action: str  # "keep" or "skip"
+    reason: str
+    ink_ratio: float
+    char_count: int
+    # For duplicates and possible duplicates, the earlier page they look like
+    duplicate_of: Optional[int] = None
 
 def bytes_to_cv2(image_bytes: bytes) -> np.ndarray:
     """Convert bytes to OpenCV image format."""
+    import cv2
+
     nparr = np.frombuffer(image_bytes, np.uint8)
     return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-def cv2_to_bytes(image: np.ndarray) -> bytes:
+def cv2_to_bytes(image: np.ndarray, quality: int = JPEG_QUALITY) -> bytes:
     """Convert OpenCV image to bytes."""
-    _, buffer = cv2.imencode('.jpg', image)
+    import cv2
+
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
     return buffer.tobytes()
 
+def pixmap_to_ndarray(pix: fitz.Pixmap) -> np.ndarray:
+    """Wrap the pixmap sample buffer as a read-only NumPy view without copying.
+
+    The view is only valid while `pix` is alive and is in the pixmap's
+    channel order (RGB), not OpenCV's BGR.
+    """
+    view = np.ndarray(
+        shape=(pix.h, pix.w, pix.n),
+        dtype=np.uint8,
+        buffer=pix.samples_mv,
+        strides=(pix.stride, pix.n, 1),
+    )
+    view.setflags(write=False)
+    return view
+
+def render_page_pixmap(page: fitz.Page, zoom: float = 2.0, grayscale: bool = False) -> fitz.Pixmap:
+    """Rasterize a PDF page into an RGB (or gray) pixmap without an alpha channel."""
+    return page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom),
+        colorspace=fitz.csGRAY if grayscale else fitz.csRGB,
+        alpha=False,
+    )
+
+def pixmap_to_cv2(pix: fitz.Pixmap) -> np.ndarray:
+    """Convert a rendered pixmap to OpenCV's BGR layout with a single copy.
+
+    Grayscale pixmaps need no conversion and are returned as a view, which
+    is only valid while `pix` is alive.
+    """
+    import cv2
+
+    view = pixmap_to_ndarray(pix)
+    if pix.n == 1:
+        return view
+    return cv2.cvtColor(view, cv2.COLOR_RGB2BGR)
+
 def extract_image_page_bytes(page: fitz.Page, zoom: float = 2.0) -> bytes:
     """Extract image from PDF page."""
-    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).pil_tobytes(format="JPEG", optimize=True)
+    pix = render_page_pixmap(page, zoom)
+    return cv2_to_bytes(pixmap_to_cv2(pix))
+
+def needs_preprocessing(pre_defined_rotation: Optional[float] = None) -> bool:
+    """Whether a page needs any preprocessing step before it is encoded."""
+    return bool(pre_defined_rotation) and pre_defined_rotation % 360 != 0
+
+def rotate_image(image: np.ndarray, angle: float) -> np.ndarray:
+    """Rotate an image clockwise by `angle` degrees, expanding the canvas to fit."""
+    import cv2
+
+    angle = angle % 360
+    quarter_turns = {
+        90: cv2.ROTATE_90_CLOCKWISE,
+        180: cv2.ROTATE_180,
+        270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    }
+    if angle in quarter_turns:
+        return cv2.rotate(image, quarter_turns[angle])
+
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width = int(height * sin + width * cos)
+    new_height = int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+    return cv2.warpAffine(
+        image, matrix, (new_width, new_height), borderValue=(255, 255, 255)
+    )
 
 def preprocess_pdf_page_image(
     source_image: np.ndarray,
     pre_defined_rotation: Optional[float] = None,
     is_structured: bool = True,
+    quality: int = JPEG_QUALITY,
 ) -> PDFPageImage:
-    """Preprocess the image for optimal processing."""
-    start_time = time()
-    source_image = np.copy(source_image)
-    img_height, img_width, *_ = source_image.shape
+    """Preprocess the image for optimal processing.
 
-    # For now, we'll keep it simple and just return the image as is
-    # We can add more preprocessing steps later if needed
+    `source_image` is never modified, so it may be a read-only view over a
+    pixmap buffer; every OpenCV step below writes into a new array.
+    """
+    start_time = time()
     page = source_image
     page_rotation = 0
-    data = cv2_to_bytes(page)
+    if needs_preprocessing(pre_defined_rotation):
+        page = rotate_image(page, pre_defined_rotation)
+        page_rotation = pre_defined_rotation % 360
+    preprocess_done = time()
+
+    data = cv2_to_bytes(page, quality)
+    encode_done = time()
     page_height, page_width, *_ = page.shape
 
     return PDFPageImage(
@@ -50,25 +254,546 @@ def preprocess_pdf_page_image(
         width=page_width,
         height=page_height,
         applied_rotation=page_rotation,
-        elapsed_time=time() - start_time,
+        elapsed_time=encode_done - start_time,
+        stage_timings={
+            "preprocess": preprocess_done - start_time,
+            "encode": encode_done - preprocess_done,
+        },
+    )
+
+def plan_page_render(page: fitz.Page, budget: RenderBudget, detail_level: int = 0) -> RenderPlan:
+    """Pick zoom, grayscale and JPEG quality for a page from its size and content.
+
+    A low resolution thumbnail measures how much ink the page has and
+    whether it has any colour. Sparse pages (a one-line remittance) get half
+    the pixel budget; `detail_level` doubles it per level for retries.
+    """
+    import cv2
+
+    # Keep the pixmap referenced while its samples are read through the view
+    thumbnail_pix = render_page_pixmap(page, THUMBNAIL_ZOOM)
+    thumbnail = pixmap_to_ndarray(thumbnail_pix)
+    gray = cv2.cvtColor(thumbnail, cv2.COLOR_RGB2GRAY)
+    ink_ratio = float(np.count_nonzero(gray < INK_THRESHOLD)) / gray.size
+    saturation = float(cv2.cvtColor(thumbnail, cv2.COLOR_RGB2HSV)[:, :, 1].mean())
+
+    pixels = budget.max_pixels * 2 ** detail_level
+    if detail_level == 0 and ink_ratio < SPARSE_INK_RATIO:
+        pixels /= 2
+    width, height = page.rect.width, page.rect.height
+    zoom = (pixels / (width * height)) ** 0.5
+    zoom = min(zoom, MAX_IMAGE_SIDE / max(width, height))
+
+    return RenderPlan(
+        zoom=zoom,
+        grayscale=saturation < GRAYSCALE_MAX_SATURATION,
+        quality=budget.max_quality,
+        detail_level=detail_level,
+        ink_ratio=round(ink_ratio, 4),
     )
 
-def get_image_from_pdf(pdf_bytes: bytes) -> list[str]:
-    """Convert all pages of a PDF to a list of base64 encoded images."""
-    base64_images = []
+def render_pdf_page(
+    page: fitz.Page,
+    zoom: float = 2.0,
+    pre_defined_rotation: Optional[float] = None,
+    budget: Optional[RenderBudget] = None,
+    detail_level: int = 0,
+) -> PDFPageImage:
+    """Render a PDF page and JPEG-encode it exactly once.
+
+    The pixmap samples are handed to OpenCV directly, so no intermediate
+    JPEG is produced and decoded again. Preprocessing only runs for pages
+    that need it.
+
+    With a `budget`, `zoom` is ignored: resolution, grayscale and quality are
+    chosen per page by `plan_page_render`. If the encoded page is still over
+    `budget.max_bytes`, quality is lowered step by step down to
+    `budget.min_quality` and then the image is downscaled.
+    """
+    import cv2
+
+    start_time = time()
+    plan = None
+    if budget is not None:
+        plan = plan_page_render(page, budget, detail_level)
+        zoom = plan.zoom
+    pix = render_page_pixmap(page, zoom, grayscale=plan is not None and plan.grayscale)
+    source_image = pixmap_to_cv2(pix)
+    render_done = time()
+
+    quality = plan.quality if plan else JPEG_QUALITY
+    processed_image = preprocess_pdf_page_image(source_image, pre_defined_rotation, quality=quality)
+    while plan is not None and len(processed_image.data) > budget.max_bytes:
+        if quality - JPEG_QUALITY_STEP >= budget.min_quality:
+            quality -= JPEG_QUALITY_STEP
+        else:
+            source_image = cv2.resize(
+                source_image, None, fx=0.75, fy=0.75, interpolation=cv2.INTER_AREA
+            )
+            plan.zoom *= 0.75
+        processed_image = preprocess_pdf_page_image(source_image, pre_defined_rotation, quality=quality)
+    if plan is not None:
+        plan.quality = quality
+        processed_image.render_plan = plan
+
+    processed_image.stage_timings = {
+        "render": render_done - start_time,
+        "preprocess": processed_image.stage_timings["preprocess"],
+        "encode": time() - render_done - processed_image.stage_timings["preprocess"],
+    }
+    processed_image.elapsed_time = time() - start_time
+    return processed_image
+
+def _init_render_worker(pdf_bytes: bytes) -> None:
+    """Open the shared PDF once in each worker process."""
+    global _worker_doc
+    _worker_doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+
+def _render_worker_page(
+    page_num: int,
+    zoom: float,
+    pre_defined_rotation: Optional[float],
+    budget: Optional[RenderBudget],
+    detail_level: int,
+) -> PDFPageImage:
+    """Render a single page of the worker's document."""
+    return render_pdf_page(_worker_doc[page_num], zoom, pre_defined_rotation, budget, detail_level)
+
+def resolve_worker_count(page_count: int, max_workers: Optional[int] = None) -> int:
+    """Number of render processes to use for a document, 1 meaning serial."""
+    if page_count < PARALLEL_MIN_PAGES:
+        return 1
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    return max(1, min(max_workers, page_count))
+
+def iter_pdf_page_images(
+    pdf_bytes: bytes,
+    zoom: float = 2.0,
+    page_rotations: Optional[dict[int, float]] = None,
+    max_workers: Optional[int] = None,
+    page_numbers: Optional[list[int]] = None,
+    budget: Optional[RenderBudget] = None,
+    detail_levels: Optional[dict[int, int]] = None,
+    max_pending: Optional[int] = None,
+) -> Iterator[PDFPageImage]:
+    """Render the pages of a PDF lazily, yielding them in page order.
+
+    Takes the same arguments as `get_pdf_page_images`. Pages are rendered as
+    they are consumed: with a process pool, at most `max_pending` pages (two
+    per worker by default) are rendered ahead of the consumer, and rendering
+    waits while the consumer is busy. Only those pages and the ones the
+    consumer still holds are in memory, however long the document is.
+    """
+    page_rotations = page_rotations or {}
+    detail_levels = detail_levels or {}
+    with span("pdf_open", payload_bytes=len(pdf_bytes)):
+        doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+    with doc:
+        page_nums = list(range(doc.page_count)) if page_numbers is None else page_numbers
+        workers = resolve_worker_count(len(page_nums), max_workers)
+        if workers == 1:
+            for page_num in page_nums:
+                page_image = render_pdf_page(
+                    doc[page_num],
+                    zoom,
+                    page_rotations.get(page_num),
+                    budget,
+                    detail_levels.get(page_num, 0),
+                )
+                record_page_spans([page_num], [page_image])
+                yield page_image
+            return
+
+    # Each worker opens its own copy of the document from pdf_bytes once
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_render_worker,
+        initargs=(pdf_bytes,),
+    )
+    remaining = iter(page_nums)
+    pending: deque = deque()
+
+    def submit_next() -> None:
+        page_num = next(remaining, None)
+        if page_num is not None:
+            pending.append((page_num, executor.submit(
+                _render_worker_page,
+                page_num,
+                zoom,
+                page_rotations.get(page_num),
+                budget,
+                detail_levels.get(page_num, 0),
+            )))
+
+    try:
+        for _ in range(max_pending or 2 * workers):
+            submit_next()
+        while pending:
+            page_num, future = pending.popleft()
+            page_image = future.result()
+            submit_next()
+            record_page_spans([page_num], [page_image])
+            yield page_image
+    finally:
+        # A consumer that stops early leaves nothing queued behind it
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def get_pdf_page_images(
+    pdf_bytes: bytes,
+    zoom: float = 2.0,
+    page_rotations: Optional[dict[int, float]] = None,
+    max_workers: Optional[int] = None,
+    page_numbers: Optional[list[int]] = None,
+    budget: Optional[RenderBudget] = None,
+    detail_levels: Optional[dict[int, int]] = None,
+) -> list[PDFPageImage]:
+    """Render the pages of a PDF, keeping the per-page metadata and timings.
+
+    All pages are rendered unless `page_numbers` selects a subset. With a
+    `budget`, every page is rendered adaptively (see `render_pdf_page`) at
+    its entry in `detail_levels`, 0 by default.
+    Long documents are spread across a process pool of `max_workers`
+    processes (defaults to the CPU count). Each worker opens its own copy of
+    the document from `pdf_bytes` once, and pages come back in page order.
+    Pass `max_workers=1` to always render serially.
+    """
+    with span("render_pages") as attributes:
+        page_images = list(
+            iter_pdf_page_images(
+                pdf_bytes, zoom, page_rotations, max_workers, page_numbers, budget, detail_levels
+            )
+        )
+        attributes.update(
+            pages=len(page_images),
+            workers=resolve_worker_count(len(page_images), max_workers),
+            payload_bytes=sum(len(page_image.data) for page_image in page_images),
+        )
+    return page_images
+
+def record_page_spans(page_nums: list[int], page_images: list[PDFPageImage]) -> None:
+    """Record the per-page stage timings, which may have been measured in a worker."""
+    for page_num, page_image in zip(page_nums, page_images):
+        timings = page_image.stage_timings
+        record_span("render", timings.get("render", 0.0), page=page_num, pages=1,
+                    width=page_image.width, height=page_image.height)
+        record_span("preprocess", timings.get("preprocess", 0.0), page=page_num)
+        record_span("encode", timings.get("encode", 0.0), page=page_num,
+                    payload_bytes=len(page_image.data))
+
+def encode_page_images(page_images: list[PDFPageImage]) -> list[str]:
+    """Base64 encode rendered pages for the Messages API."""
+    with span("base64", pages=len(page_images)) as attributes:
+        encoded = [base64.b64encode(page_image.data).decode("utf-8") for page_image in page_images]
+        attributes["payload_bytes"] = sum(len(page) for page in encoded)
+    return encoded
+
+def iter_encoded_pages(page_images: Iterable[PDFPageImage]) -> Iterator[str]:
+    """Base64 encode rendered pages one at a time, as they are consumed."""
+    for page_image in page_images:
+        with span("base64", pages=1) as attributes:
+            encoded = base64.b64encode(page_image.data).decode("utf-8")
+            attributes["payload_bytes"] = len(encoded)
+        yield encoded
+
+def iter_image_from_pdf(
+    pdf_bytes: bytes,
+    max_workers: Optional[int] = None,
+    budget: Optional[RenderBudget] = None,
+    max_pending: Optional[int] = None,
+    page_numbers: Optional[list[int]] = None,
+) -> Iterator[str]:
+    """Lazily convert the pages of a PDF to base64 encoded images.
+
+    The streaming counterpart of `get_image_from_pdf`: each page is
+    rendered and encoded as it is consumed, with at most `max_pending` pages
+    rendered ahead (see `iter_pdf_page_images`). Unlike `get_image_from_pdf`,
+    errors are raised, so a broken document is not mistaken for a short one.
+    """
+    return iter_encoded_pages(
+        iter_pdf_page_images(
+            pdf_bytes,
+            max_workers=max_workers,
+            page_numbers=page_numbers,
+            budget=budget,
+            max_pending=max_pending,
+        )
+    )
+
+def pdf_page_count(pdf_bytes: bytes) -> int:
+    """Number of pages in a PDF, without rendering any of them."""
+    with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+def get_image_from_pdf(
+    pdf_bytes: bytes,
+    max_workers: Optional[int] = None,
+    budget: Optional[RenderBudget] = None,
+    page_numbers: Optional[list[int]] = None,
+) -> list[str]:
+    """Convert the pages of a PDF (all, or only `page_numbers`) to a list of base64 encoded images."""
     try:
-        with fitz.Document(stream=pdf_bytes, filetype="pdf") as doc:
-            for page_num in range(doc.page_count):
-                page = doc[page_num]
-                # Extract image
-                image_bytes = extract_image_page_bytes(page)
-                # Convert to OpenCV format
-                cv_image = bytes_to_cv2(image_bytes)
-                # Preprocess
-                processed_image = preprocess_pdf_page_image(cv_image)
-                # Convert to base64 and add to list
-                base64_images.append(base64.b64encode(processed_image.data).decode("utf-8"))
-        return base64_images
+        return encode_page_images(
+            get_pdf_page_images(
+                pdf_bytes, max_workers=max_workers, page_numbers=page_numbers, budget=budget
+            )
+        )
     except Exception as e:
         print(f"Error processing PDF: {str(e)}")
-        return [] 
\ No newline at end of file
+        return []
+
+def page_image_coverage(page: fitz.Page) -> float:
+    """Fraction of the page area covered by embedded images (0.0 - 1.0)."""
+    page_rect = page.rect
+    page_area = page_rect.width * page_rect.height
+    if not page_area:
+        return 0.0
+    covered = 0.0
+    for image in page.get_image_info():
+        bbox = fitz.Rect(image["bbox"]) & page_rect
+        covered += bbox.width * bbox.height
+    return min(1.0, covered / page_area)
+
+def page_text_layout(page: fitz.Page, word_positions: bool = False) -> str:
+    """Compact text of a page in reading order.
+
+    With `word_positions`, every line is prefixed with `@x,y`, the position
+    of its first word in points, so the model can still see the layout of
+    tables and columns.
+    """
+    if not word_positions:
+        return page.get_text("text", sort=True).strip()
+
+    lines: dict[tuple[int, int], list[tuple]] = {}
+    for word in page.get_text("words", sort=True):
+        x0, y0, _, _, text, block_no, line_no, _ = word
+        lines.setdefault((block_no, line_no), []).append((x0, y0, text))
+    return "\n".join(
+        f"@{round(words[0][0])},{round(words[0][1])} " + " ".join(w[2] for w in words)
+        for words in lines.values()
+    )
+
+def route_pdf_page(page: fitz.Page) -> PDFPageRoute:
+    """Decide whether a page can be sent as text or has to be rendered."""
+    text = page.get_text("text")
+    chars = [c for c in text if not c.isspace()]
+    char_count = len(chars)
+    # Unmapped glyphs come out as U+FFFD; a garbled layer is no better than none
+    printable_count = sum(1 for c in chars if c.isprintable() and c != "\ufffd")
+    printable_ratio = printable_count / char_count if char_count else 0.0
+    coverage = page_image_coverage(page)
+
+    if char_count < MIN_TEXT_CHARS:
+        route, reason = "image", "too little text"
+    elif printable_ratio < MIN_PRINTABLE_RATIO:
+        route, reason = "image", "unreadable text layer"
+    elif coverage > MAX_IMAGE_COVERAGE:
+        route, reason = "image", "mostly images (likely a scan with OCR text)"
+    else:
+        route, reason = "text", "usable text layer"
+    return PDFPageRoute(
+        page_number=page.number,
+        route=route,
+        reason=reason,
+        char_count=char_count,
+        image_coverage=round(coverage, 3),
+    )
+
+def perceptual_hash(gray: np.ndarray) -> int:
+    """DCT-based perceptual hash of a grayscale image, as a PHASH_SIZE**2-bit integer."""
+    import cv2
+
+    sample = cv2.resize(gray, (PHASH_SAMPLE_SIDE, PHASH_SAMPLE_SIDE), interpolation=cv2.INTER_AREA)
+    frequencies = cv2.dct(sample.astype(np.float32))[:PHASH_SIZE, :PHASH_SIZE].flatten()
+    # The DC term is the mean brightness and would dominate the median
+    bits = frequencies > np.median(frequencies[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+def same_rendering(page: fitz.Page, other: fitz.Page, renders: dict[int, np.ndarray]) -> bool:
+    """True if two pages render to the same pixels, up to DUPLICATE_PIXEL_TOLERANCE grey levels.
+
+    Renders are kept in `renders` by page number, so each page is rendered once.
+    """
+    if page.rect != other.rect:
+        return False
+    grays = []
+    for candidate in (page, other):
+        if candidate.number not in renders:
+            # Copied out, so the pixmap can be released
+            pix = render_page_pixmap(candidate, DUPLICATE_CONFIRM_ZOOM, grayscale=True)
+            renders[candidate.number] = pixmap_to_ndarray(pix)[:, :, 0].astype(np.int16)
+        grays.append(renders[candidate.number])
+    if grays[0].shape != grays[1].shape:
+        return False
+    return not np.any(np.abs(grays[0] - grays[1]) > DUPLICATE_PIXEL_TOLERANCE)
+
+def triage_pdf_page(
+    page: fitz.Page,
+    kept: list[tuple[int, Optional[str], int, np.ndarray]],
+    renders: Optional[dict[int, np.ndarray]] = None,
+) -> PageTriage:
+    """Decide whether a page is worth sending to the model.
+
+    `kept` holds (page number, normalized text or None, perceptual hash,
+    thumbnail) of the pages kept so far, which duplicates are compared
+    against. `renders` caches the renders `same_rendering` compares.
+    """
+    text = page.get_text("text")
+    normalized = " ".join(text.split()).lower()
+    char_count = sum(1 for c in text if not c.isspace())
+    # Keep the pixmap referenced while its samples are read through the view
+    thumbnail_pix = render_page_pixmap(page, THUMBNAIL_ZOOM, grayscale=True)
+    gray = np.array(pixmap_to_ndarray(thumbnail_pix)[:, :, 0])
+    ink_ratio = float(np.count_nonzero(gray < INK_THRESHOLD)) / gray.size
+    page_hash = perceptual_hash(gray)
+
+    def triage(action: str, reason: str, duplicate_of: Optional[int] = None) -> PageTriage:
+        return PageTriage(page.number, action, reason, round(ink_ratio, 5), char_count, duplicate_of)
+
+    if (ink_ratio < BLANK_INK_RATIO and char_count <= BLANK_MAX_TEXT_CHARS) or (
+        char_count <= 2 * BLANK_MAX_TEXT_CHARS and any(marker in normalized for marker in BLANK_PAGE_MARKERS)
+    ):
+        return triage("skip", "blank")
+
+    has_text = char_count >= MIN_TEXT_CHARS
+    possible_duplicate_of = None
+    for kept_number, kept_text, kept_hash, kept_gray in kept:
+        if has_text and kept_text is not None:
+            if normalized == kept_text:
+                return triage("skip", "duplicate", kept_number)
+        elif (page_hash ^ kept_hash).bit_count() <= DUPLICATE_MAX_HASH_DISTANCE:
+            # Identical pixels hash identically and have identical thumbnails, so only
+            # those matches are worth rendering again
+            if (
+                page_hash == kept_hash
+                and kept_gray.shape == gray.shape
+                and not np.any(np.abs(kept_gray.astype(np.int16) - gray) > DUPLICATE_PIXEL_TOLERANCE)
+                and same_rendering(page, page.parent[kept_number], renders if renders is not None else {})
+            ):
+                return triage("skip", "duplicate", kept_number)
+            if possible_duplicate_of is None:
+                possible_duplicate_of = kept_number
+
+    if has_text:
+        keywords = sum(1 for keyword in BOILERPLATE_KEYWORDS if keyword in normalized)
+        amounts = len(MONEY_AMOUNT_PATTERN.findall(text))
+        if keywords >= BOILERPLATE_MIN_KEYWORDS and amounts <= BOILERPLATE_MAX_AMOUNTS:
+            return triage("skip", "boilerplate")
+        if (
+            amounts <= BOILERPLATE_MAX_AMOUNTS
+            and any(marker in normalized for marker in REMITTANCE_SLIP_MARKERS)
+            and not INVOICE_CONTENT_PATTERN.search(normalized)
+        ):
+            return triage("skip", "remittance slip")
+
+    kept.append((page.number, normalized if has_text else None, page_hash, gray))
+    if possible_duplicate_of is not None:
+        return triage("keep", "possible duplicate", possible_duplicate_of)
+    return triage("keep", "content")
+
+def triage_pdf_pages(pdf_bytes: bytes) -> list[PageTriage]:
+    """Find blank, duplicate and boilerplate pages before anything is rendered in full.
+
+    Uses a low resolution thumbnail and the text layer of every page, so it
+    costs a fraction of rendering the document. Duplicates are collapsed
+    onto their first occurrence; scanned pages that only look alike are kept
+    as "possible duplicate" (see `possible_duplicates`). If every page would
+    be skipped, all are kept, so a document is never reduced to nothing.
+    """
+    with span("pdf_open", payload_bytes=len(pdf_bytes)):
+        doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+    with doc, span("triage", pages=doc.page_count) as attributes:
+        kept: list[tuple[int, Optional[str], int, np.ndarray]] = []
+        renders: dict[int, np.ndarray] = {}
+        triage = [triage_pdf_page(page, kept, renders) for page in doc]
+        if not kept:
+            for page_triage in triage:
+                page_triage.action = "keep"
+        attributes["skipped"] = sum(1 for page_triage in triage if page_triage.action == "skip")
+    return triage
+
+def kept_page_numbers(triage: list[PageTriage]) -> list[int]:
+    return [page_triage.page_number for page_triage in triage if page_triage.action == "keep"]
+
+def skipped_pages(triage: list[PageTriage]) -> list[dict]:
+    """The skipped pages as recorded on results, numbered from 1."""
+    return [
+        {"page": page_triage.page_number + 1, "reason": page_triage.reason}
+        | ({"duplicate_of": page_triage.duplicate_of + 1} if page_triage.duplicate_of is not None else {})
+        for page_triage in triage
+        if page_triage.action == "skip"
+    ]
+
+def possible_duplicates(triage: list[PageTriage]) -> list[dict]:
+    """Kept pages that look like an earlier page, as recorded on results, numbered from 1."""
+    return [
+        {"page": page_triage.page_number + 1, "duplicate_of": page_triage.duplicate_of + 1}
+        for page_triage in triage
+        if page_triage.action == "keep" and page_triage.duplicate_of is not None
+    ]
+
+def locate_invoice_pages(
+    pdf_bytes: bytes, numbers: list[Any], page_numbers: Optional[list[int]] = None
+) -> list[list[int]]:
+    """Pages whose text layer mentions each invoice number, compared as letters and digits only.
+
+    Only `page_numbers` are searched if given. A number is not located (an
+    empty list) when it is too short to be told apart from other text or no
+    page has it, e.g. because the pages are scans without a text layer.
+    """
+    keys = ["".join(c for c in str(number or "").lower() if c.isalnum()) for number in numbers]
+    located: list[list[int]] = [[] for _ in keys]
+    if not any(len(key) >= MIN_LOCATABLE_NUMBER_CHARS for key in keys):
+        return located
+    with span("pdf_open", payload_bytes=len(pdf_bytes)):
+        doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+    with doc:
+        for page_num in page_numbers if page_numbers is not None else range(doc.page_count):
+            text = "".join(c for c in doc[page_num].get_text("text").lower() if c.isalnum())
+            for key, pages in zip(keys, located):
+                if len(key) >= MIN_LOCATABLE_NUMBER_CHARS and key in text:
+                    pages.append(page_num)
+    return located
+
+def get_document_pages(
+    pdf_bytes: bytes,
+    word_positions: bool = False,
+    max_workers: Optional[int] = None,
+    budget: Optional[RenderBudget] = None,
+    page_numbers: Optional[list[int]] = None,
+) -> tuple[list[PageContent], list[PDFPageRoute]]:
+    """Convert a PDF to page content, using the text layer where it is usable.
+
+    Born-digital pages are returned as PDFPageText, everything else is
+    rendered to a base64 encoded image as in `get_image_from_pdf`. The routes
+    report which path every page took and why. Only `page_numbers` are
+    converted if given, e.g. the pages kept by `triage_pdf_pages`.
+    """
+    with span("pdf_open", payload_bytes=len(pdf_bytes)):
+        doc = fitz.Document(stream=pdf_bytes, filetype="pdf")
+    with doc, span("text_layer") as attributes:
+        if page_numbers is None:
+            page_numbers = list(range(doc.page_count))
+        routes = [route_pdf_page(doc[page_num]) for page_num in page_numbers]
+        pages: list[PageContent] = [
+            PDFPageText(route.page_number, page_text_layout(doc[route.page_number], word_positions))
+            if route.route == "text"
+            else None
+            for route in routes
+        ]
+        text_pages = [page for page in pages if page is not None]
+        attributes.update(
+            pages=len(text_pages), payload_bytes=sum(len(page.text) for page in text_pages)
+        )
+
+    image_indices = [index for index, route in enumerate(routes) if route.route == "image"]
+    if image_indices:
+        page_images = get_pdf_page_images(
+            pdf_bytes,
+            max_workers=max_workers,
+            page_numbers=[routes[index].page_number for index in image_indices],
+            budget=budget,
+        )
+        for index, encoded in zip(image_indices, encode_page_images(page_images)):
+            pages[index] = encoded
+    return pages, routes
@@ -0,0 +1,277 @@
+"""Timing spans for the extraction pipeline and the sinks they are sent to.
+
+Every stage records a span: its name, its duration and attributes such as
+the page count, payload bytes and token usage:
+
+    with span("model_request", provider=client.model_key, pages=3) as attributes:
+        response = ...
+        attributes.update(input_tokens=..., output_tokens=...)
+
+Spans go to the process-wide sink, which discards them until one is set:
+
+    set_metrics_sink(JsonlMetricsSink("metrics.jsonl"))   # one line per span
+    sink = PrometheusMetricsSink(); sink.serve(9108)       # GET /metrics
+
+`configure_from_env` sets the sink from INVOICE_METRICS_JSONL and
+INVOICE_METRICS_PORT. Spans recorded in a worker process are collected with
+`collect_spans` and recorded again in the parent with `record_spans`.
+
+Stages: pdf_open, triage, render, preprocess, encode, render_pages,
+text_layer, base64, request_build, model_request (with time_to_first_token
+when streaming), batch_submit, json_parse, postprocess, validate and
+document.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+from typing import Any, Dict, Iterator, Optional
+
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Numeric attributes summed into counters by the Prometheus sink
+COUNTED_ATTRIBUTES = (
+    "pages",
+    "payload_bytes",
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
+# Attributes used as Prometheus labels
+LABEL_ATTRIBUTES = ("provider",)
+
+
+@dataclass
+class Span:
+    name: str
+    duration: float
+    # Wall-clock time the span started, in seconds since the epoch
+    started_at: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class MetricsSink:
+    """Receives every recorded span; the base class discards them."""
+
+    def record(self, span: Span) -> None:
+        pass
+
+
+class CollectingMetricsSink(MetricsSink):
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def record(self, span: Span) -> None:
+        self.spans.append(span)
+
+
+class JsonlMetricsSink(MetricsSink):
+    """Appends one JSON line per span to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def record(self, span: Span) -> None:
+        line = json.dumps(asdict(span), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusMetricsSink(MetricsSink):
+    """Aggregates spans into Prometheus histograms and counters.
+
+    `render` returns the text exposition format; `serve` exposes it over
+    HTTP at /metrics from a background thread.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Keyed by (stage, labels)
+        self._durations: Dict[tuple, list] = {}
+        self._first_token: Dict[tuple, list] = {}
+        self._errors: Dict[tuple, int] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _observe(self, histograms: Dict[tuple, list], key: tuple, value: float) -> None:
+        # [bucket counts..., sum, count]
+        histogram = histograms.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record(self, span: Span) -> None:
+        labels = tuple(
+            (name, str(span.attributes[name])) for name in LABEL_ATTRIBUTES if name in span.attributes
+        )
+        key = (span.name, labels)
+        with self._lock:
+            self._observe(self._durations, key, span.duration)
+            if "time_to_first_token" in span.attributes:
+                self._observe(self._first_token, key, span.attributes["time_to_first_token"])
+            if span.attributes.get("error"):
+                self._errors[key] = self._errors.get(key, 0) + 1
+            for name in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(name)
+                if isinstance(value, (int, float)):
+                    counter_key = (name, key)
+                    self._counters[counter_key] = self._counters.get(counter_key, 0) + value
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        stage, labels = key
+        pairs = (("stage", stage),) + labels + extra
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def _render_histogram(self, name: str, help_text: str, histograms: Dict[tuple, list]) -> list[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f"{name}_bucket{self._labels(key, (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{self._labels(key)} {histogram[-2]}")
+            lines.append(f"{name}_count{self._labels(key)} {histogram[-1]}")
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            lines = self._render_histogram(
+                "invoice_stage_duration_seconds",
+                "Time spent in each pipeline stage.",
+                self._durations,
+            )
+            lines += self._render_histogram(
+                "invoice_time_to_first_token_seconds",
+                "Time from sending a streaming request to its first token.",
+                self._first_token,
+            )
+            lines += [
+                "# HELP invoice_stage_errors_total Spans that ended in an error.",
+                "# TYPE invoice_stage_errors_total counter",
+            ]
+            lines += [f"invoice_stage_errors_total{self._labels(key)} {count}" for key, count in sorted(self._errors.items())]
+            for name in COUNTED_ATTRIBUTES:
+                metric = f"invoice_{name}_total"
+                lines += [f"# HELP {metric} Sum of {name} over spans.", f"# TYPE {metric} counter"]
+                lines += [
+                    f"{metric}{self._labels(key)} {value}"
+                    for (counter, key), value in sorted(self._counters.items())
+                    if counter == name
+                ]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """Serve /metrics on `port` from a daemon thread."""
+        sink = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+
+class MultiMetricsSink(MetricsSink):
+    def __init__(self, sinks: list[MetricsSink]):
+        self.sinks = sinks
+
+    def record(self, span: Span) -> None:
+        for sink in self.sinks:
+            sink.record(span)
+
+
+_sink: MetricsSink = MetricsSink()
+
+
+def get_metrics_sink() -> MetricsSink:
+    return _sink
+
+
+def set_metrics_sink(sink: Optional[MetricsSink]) -> None:
+    """Send spans to `sink` from now on; None discards them again."""
+    global _sink
+    _sink = sink if sink is not None else MetricsSink()
+
+
+def configure_from_env() -> MetricsSink:
+    """Set the sink from INVOICE_METRICS_JSONL and INVOICE_METRICS_PORT, if set."""
+    sinks: list[MetricsSink] = []
+    if os.getenv("INVOICE_METRICS_JSONL"):
+        sinks.append(JsonlMetricsSink(os.environ["INVOICE_METRICS_JSONL"]))
+    if os.getenv("INVOICE_METRICS_PORT"):
+        prometheus = PrometheusMetricsSink()
+        prometheus.serve(int(os.environ["INVOICE_METRICS_PORT"]))
+        sinks.append(prometheus)
+    if sinks:
+        set_metrics_sink(sinks[0] if len(sinks) == 1 else MultiMetricsSink(sinks))
+    return get_metrics_sink()
+
+
+def record_span(name: str, duration: float, started_at: Optional[float] = None, **attributes) -> None:
+    """Record a span whose duration was measured elsewhere."""
+    if started_at is None:
+        started_at = time() - duration
+    _sink.record(Span(name, duration, started_at, attributes))
+
+
+def record_spans(spans: list[Span]) -> None:
+    """Record spans collected in another process."""
+    for collected in spans:
+        _sink.record(collected)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Dict[str, Any]]:
+    """Time the block as a span; the yielded attributes may be added to.
+
+    An exception is recorded as the span's "error" attribute and re-raised.
+    """
+    started_at = time()
+    start = perf_counter()
+    try:
+        yield attributes
+    except Exception as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _sink.record(Span(name, perf_counter() - start, started_at, attributes))
+
+
+@contextmanager
+def collect_spans() -> Iterator[list[Span]]:
+    """Collect spans into a list instead of the sink, e.g. in a worker process."""
+    global _sink
+    previous = _sink
+    collector = CollectingMetricsSink()
+    _sink = collector
+    try:
+        yield collector.spans
+    finally:
+        _sink = previous
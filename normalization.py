@@ -0,0 +1,258 @@
+"""Normalization of extracted invoice fields, shared by both clients.
+
+Single responses are normalized value by value with precompiled patterns
+(`normalize_invoices`), which is what the clients and streaming need; whole
+batches of results are parsed a column at a time with pyarrow
+(`invoices_to_frames`). Both follow the same rules for amounts:
+
+- Currency symbols, codes and spaces are dropped: "EUR 1 234,56" -> 1234.56
+- If both "." and "," appear, the last one is the decimal separator:
+  "1.234,56" -> 1234.56 and "1,234.56" -> 1234.56
+- A single "," is a decimal comma unless exactly three digits follow it:
+  "12,5" -> 12.5 but "1,234" -> 1234.0
+- Repeated "." are thousands separators: "1.234.567" -> 1234567.0
+- Parentheses, a minus sign anywhere or a "CR" suffix make it negative:
+  "(120.00)" -> -120.0, "120.00-" -> -120.0
+- Missing or unparseable values are NaN in columns and 0.0 in dicts
+
+`decimal_comma` overrides the separator guess when the locale is known.
+"""
+from __future__ import annotations
+
+import math
+import re
+from datetime import date
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional
+
+import numpy as np
+
+# pandas and pyarrow are imported on first use, so the clients and workers
+# importing this module start without them
+if TYPE_CHECKING:
+    import pandas as pd
+
+INVOICE_NUMERIC_FIELDS = ("amount", "tax_amount", "payment_term_days")
+INVOICE_DATE_FIELDS = ("date", "due_date")
+INVOICE_TEXT_FIELDS = ("number", "po_number", "vendor")
+LINE_ITEM_NUMERIC_FIELDS = ("quantity", "unit_price", "total")
+
+# Applied with pyarrow.compute to whole columns in `invoices_to_frames`, and
+# compiled once below for the value-by-value path
+NEGATIVE_PATTERN = r"^\s*\(.*\)\s*$|-|\bCR\b"
+NON_NUMERIC_PATTERN = r"[^\d.,]"
+# The shapes of cleaned amounts in which "," is the decimal separator
+DECIMAL_COMMA_PATTERN = "^(?:" + "|".join([
+    r"[\d.]*\.[\d.]*,\d*",  # a "," after the last "." ("1.234,56")
+    r"\d*,(?:\d{0,2}|\d{4,})",  # a single "," not followed by a thousands group ("12,5")
+    r"0,\d+",  # a leading "0," ("0,125")
+    r"\d*(?:\.\d*){2,}",  # repeated "." as thousands separators ("1.234.567")
+]) + ")$"
+PLAIN_NUMBER_PATTERN = r"^(?:\d+(?:\.\d*)?|\.\d+)$"
+ISO_DATE_PATTERN = r"^\s*(?P<year>\d{4})[-/.](?P<month>\d{1,2})[-/.](?P<day>\d{1,2})(?:$|[\sT])"
+# Dotted dates are day-first everywhere they are used; slashed ones are not
+# (01/02/2024 is ambiguous), so those are left unparsed
+DOTTED_DATE_PATTERN = r"^\s*(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4})\s*$"
+CURRENCY_CODE_PATTERN = r"[A-Z]{3}"
+# Only symbols that name a single currency
+CURRENCY_SYMBOLS = {"€": "EUR", "£": "GBP", "₹": "INR", "US$": "USD"}
+
+_NEGATIVE_RE = re.compile(NEGATIVE_PATTERN)
+_NON_NUMERIC_RE = re.compile(NON_NUMERIC_PATTERN)
+_DECIMAL_COMMA_RE = re.compile(DECIMAL_COMMA_PATTERN)
+_PLAIN_NUMBER_RE = re.compile(PLAIN_NUMBER_PATTERN)
+_ISO_DATE_RE = re.compile(ISO_DATE_PATTERN)
+_DOTTED_DATE_RE = re.compile(DOTTED_DATE_PATTERN)
+_CURRENCY_CODE_RE = re.compile(CURRENCY_CODE_PATTERN)
+
+
+def parse_amount(value: Any, decimal_comma: Optional[bool] = None) -> float:
+    """Parse one amount or quantity like `parse_amounts`, NaN where missing."""
+    if type(value) in (int, float):
+        return float(value)
+    if type(value) is not str:
+        return math.nan
+    if not decimal_comma and _PLAIN_NUMBER_RE.match(value):
+        # Most values are already plain numbers ("25.00")
+        return float(value)
+    digits = _NON_NUMERIC_RE.sub("", value)
+    if decimal_comma is None:
+        decimal_comma = _DECIMAL_COMMA_RE.match(digits) is not None
+    if decimal_comma:
+        cleaned = digits.replace(".", "").replace(",", ".")
+    else:
+        cleaned = digits.replace(",", "")
+    if not _PLAIN_NUMBER_RE.match(cleaned):
+        return math.nan
+    parsed = float(cleaned)
+    return -parsed if _NEGATIVE_RE.search(value) else parsed
+
+
+def parse_date(value: Any) -> Optional[date]:
+    """Parse one date like `parse_dates`, None otherwise."""
+    text = str(value)
+    match = _ISO_DATE_RE.search(text) or _DOTTED_DATE_RE.search(text)
+    if match is None:
+        return None
+    try:
+        return date(int(match["year"]), int(match["month"]), int(match["day"]))
+    except ValueError:
+        return None
+
+
+def parse_currency_code(value: Any) -> Optional[str]:
+    """Normalize one currency code like `parse_currency_codes`, None where unrecognized."""
+    code = str(value).strip()
+    code = CURRENCY_SYMBOLS.get(code, code).upper()
+    return code if _CURRENCY_CODE_RE.fullmatch(code) else None
+
+
+def parse_amounts(values: Iterable[Any], decimal_comma: Optional[bool] = None) -> pd.Series:
+    """Parse amounts and quantities into a float64 Series, NaN where missing."""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    values = list(values)
+    # Values the model already returned as numbers need no parsing
+    numbers = np.array(
+        [value if type(value) in (int, float) else np.nan for value in values], dtype="float64"
+    )
+    text = pa.array([value if type(value) is str else None for value in values], type=pa.string())
+    if text.null_count == len(text):
+        return pd.Series(numbers)
+
+    negative = pc.match_substring_regex(text, NEGATIVE_PATTERN)
+    digits = pc.replace_substring_regex(text, NON_NUMERIC_PATTERN, "")
+    if decimal_comma is None:
+        comma_is_decimal = pc.match_substring_regex(digits, DECIMAL_COMMA_PATTERN)
+    else:
+        comma_is_decimal = pa.scalar(decimal_comma)
+    cleaned = pc.if_else(
+        comma_is_decimal,
+        pc.replace_substring(pc.replace_substring(digits, ".", ""), ",", "."),
+        pc.replace_substring(digits, ",", ""),
+    )
+    # Anything left that is not a plain number is unparseable
+    parsed = pc.cast(
+        pc.if_else(pc.match_substring_regex(cleaned, PLAIN_NUMBER_PATTERN), cleaned, None),
+        pa.float64(),
+    )
+    parsed = pc.if_else(negative, pc.negate(parsed), parsed).to_numpy(zero_copy_only=False)
+    return pd.Series(np.where(pc.is_valid(text).to_numpy(zero_copy_only=False), parsed, numbers))
+
+
+def parse_dates(values: Iterable[Any]) -> pd.Series:
+    """Parse ISO (yyyy-mm-dd) and dotted day-first dates, NaT otherwise."""
+    import pandas as pd
+
+    text = pd.Series(list(values), dtype=object).astype(str)
+    parts = text.str.extract(ISO_DATE_PATTERN)
+    dotted = text.str.extract(DOTTED_DATE_PATTERN)
+    parts = parts.fillna(dotted[parts.columns])
+    if parts.empty:
+        return pd.Series(pd.NaT, index=text.index, dtype="datetime64[ns]")
+    return pd.to_datetime(parts.apply(pd.to_numeric), errors="coerce")
+
+
+def parse_currency_codes(values: Iterable[Any]) -> pd.Series:
+    """Normalize currency codes to upper-case ISO 4217, NA where unrecognized."""
+    import pandas as pd
+
+    codes = pd.Series(list(values), dtype=object).astype(str).str.strip()
+    codes = codes.replace(CURRENCY_SYMBOLS).str.upper()
+    return codes.where(codes.str.fullmatch(CURRENCY_CODE_PATTERN)).astype("string")
+
+
+def normalize_invoices(invoices: list[Dict[str, Any]], decimal_comma: Optional[bool] = None) -> list[Dict[str, Any]]:
+    """Normalize the fields of extracted invoices in place.
+
+    Amounts, quantities and payment terms become floats, with 0.0 for
+    missing values; line items are always present as a list. Dates are
+    rewritten as yyyy-mm-dd and currency codes upper-cased when they can be
+    parsed, and left as they are otherwise.
+
+    Values are parsed one at a time, so a single response costs
+    microseconds; tables for many results come from `invoices_to_frames`.
+    """
+    for invoice in invoices:
+        items = invoice.get("line_items")
+        line_items = []
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            item = dict(item)
+            for field in LINE_ITEM_NUMERIC_FIELDS:
+                amount = parse_amount(item.get(field), decimal_comma)
+                item[field] = 0.0 if math.isnan(amount) else amount
+            line_items.append(item)
+        invoice["line_items"] = line_items
+
+        for field in INVOICE_NUMERIC_FIELDS:
+            amount = parse_amount(invoice.get(field), decimal_comma)
+            invoice[field] = 0.0 if math.isnan(amount) else amount
+
+        for field in INVOICE_DATE_FIELDS:
+            parsed = parse_date(invoice.get(field))
+            if parsed is not None:
+                invoice[field] = parsed.strftime("%Y-%m-%d")
+        code = parse_currency_code(invoice.get("currency_code"))
+        if code is not None:
+            invoice["currency_code"] = code
+    return invoices
+
+
+def invoices_to_frames(
+    results: list[Optional[Dict[str, Any]]],
+    sources: Optional[list[Any]] = None,
+    decimal_comma: Optional[bool] = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Flatten extraction results into typed invoice and line item tables.
+
+    Rows are keyed by `source` (the document's entry in `sources`, or its
+    index in `results`) and the invoice's position in the document; line
+    items add their own position. Amounts are float64, payment terms Int64,
+    dates datetime64 and text columns the pandas string dtype, with missing
+    values as NaN/NA rather than 0.0. Raw values are accepted, so results
+    need not have been normalized already.
+    """
+    import pandas as pd
+
+    # Gathered column by column; building row lists is far slower at scale
+    invoice_keys = []
+    invoice_records = []
+    line_item_keys = []
+    line_item_records = []
+    for index, result in enumerate(results):
+        if not result:
+            continue
+        source = sources[index] if sources is not None else index
+        document_type = result.get("document_type")
+        for invoice_index, invoice in enumerate(result.get("invoices") or []):
+            invoice_keys.append((source, invoice_index, document_type))
+            invoice_records.append(invoice)
+            items = invoice.get("line_items")
+            for line, item in enumerate(items if isinstance(items, list) else []):
+                if isinstance(item, dict):
+                    line_item_keys.append((source, invoice_index, line))
+                    line_item_records.append(item)
+
+    invoices = pd.DataFrame(invoice_keys, columns=["source", "invoice", "document_type"])
+    invoices["document_type"] = invoices["document_type"].astype("string")
+    for field in INVOICE_TEXT_FIELDS:
+        invoices[field] = pd.Series([invoice.get(field) for invoice in invoice_records], dtype=object).astype("string")
+    for field in INVOICE_NUMERIC_FIELDS:
+        invoices[field] = parse_amounts([invoice.get(field) for invoice in invoice_records], decimal_comma)
+    invoices["payment_term_days"] = invoices["payment_term_days"].round().astype("Int64")
+    invoices["currency_code"] = parse_currency_codes(invoice.get("currency_code") for invoice in invoice_records)
+    for field in INVOICE_DATE_FIELDS:
+        invoices[field] = parse_dates(invoice.get(field) for invoice in invoice_records)
+    invoices["invoice"] = invoices["invoice"].astype("int64")
+
+    line_items = pd.DataFrame(line_item_keys, columns=["source", "invoice", "line"])
+    line_items["description"] = pd.Series(
+        [item.get("description") for item in line_item_records], dtype=object
+    ).astype("string")
+    for field in LINE_ITEM_NUMERIC_FIELDS:
+        line_items[field] = parse_amounts([item.get(field) for item in line_item_records], decimal_comma)
+    line_items[["invoice", "line"]] = line_items[["invoice", "line"]].astype("int64")
+    return invoices, line_items
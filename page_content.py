@@ -0,0 +1,101 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Union
+
+from prompts import (
+    INVOICE_EXTRACTION_PROMPT,
+    INVOICE_TOOL,
+    INVOICE_TOOL_NAME,
+    INVOICE_TOOL_PROMPT,
+    TEXT_PAGES_NOTE,
+)
+
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
+
+
+@dataclass
+class PDFPageText:
+    """A page sent to the model as its embedded text layer instead of an image."""
+
+    page_number: int
+    text: str
+
+    def to_prompt_text(self) -> str:
+        return f"--- Page {self.page_number + 1} (text layer) ---\n{self.text}"
+
+
+# A page is either a base64 encoded JPEG or its text layer
+PageContent = Union[str, PDFPageText]
+
+
+def page_content_block(page: PageContent) -> dict:
+    """Build the Messages API content block for one page."""
+    if isinstance(page, PDFPageText):
+        return {"type": "text", "text": page.to_prompt_text()}
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": "image/jpeg",
+            "data": page,
+        },
+    }
+
+
+def extraction_prompt(pages: list[PageContent], tool_output: bool = False) -> str:
+    """The extraction prompt, noting text-layer pages when there are any."""
+    prompt = INVOICE_TOOL_PROMPT if tool_output else INVOICE_EXTRACTION_PROMPT
+    if any(isinstance(page, PDFPageText) for page in pages):
+        return f"{prompt}\n\n{TEXT_PAGES_NOTE}"
+    return prompt
+
+
+def payload_bytes(pages: list[PageContent]) -> int:
+    """Size of the page content sent to the model, base64 or text."""
+    return sum(len(page.text) if isinstance(page, PDFPageText) else len(page) for page in pages)
+
+
+def extraction_request(
+    pages: list[PageContent],
+    prompt_caching: bool = False,
+    tool_output: bool = False,
+    prompt_first: bool = False,
+) -> Dict[str, Any]:
+    """The Messages API arguments for extracting `pages`, without the model.
+
+    With `prompt_caching`, the static prompt moves into a system block marked
+    for caching, so only the pages are billed at the full input rate on later
+    requests; the tool definition is part of the cached prefix too. With
+    `tool_output`, the answer is forced through the `record_invoices` tool,
+    whose input schema replaces the prompt's example output. `prompt_first`
+    puts the prompt before the pages when it stays in the user message.
+    """
+    content = [page_content_block(page) for page in pages]
+    request: Dict[str, Any] = {}
+    if prompt_caching:
+        # The note on text-layer pages varies per document, so it stays out of the cached prefix
+        prompt = INVOICE_TOOL_PROMPT if tool_output else INVOICE_EXTRACTION_PROMPT
+        request["system"] = [
+            {"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}
+        ]
+        if any(isinstance(page, PDFPageText) for page in pages):
+            content.append({"type": "text", "text": TEXT_PAGES_NOTE})
+    else:
+        prompt_block = {"type": "text", "text": extraction_prompt(pages, tool_output)}
+        content = [prompt_block] + content if prompt_first else content + [prompt_block]
+    request["messages"] = [{"role": "user", "content": content}]
+    if tool_output:
+        request["tools"] = [INVOICE_TOOL]
+        request["tool_choice"] = {"type": "tool", "name": INVOICE_TOOL_NAME}
+    return request
+
+
+def response_usage(usage: Any) -> Dict[str, int]:
+    """Token counts from a response's usage, as a dict or SDK object."""
+    if not isinstance(usage, dict):
+        usage = {field: getattr(usage, field, None) for field in USAGE_FIELDS}
+    return {field: usage.get(field) or 0 for field in USAGE_FIELDS}
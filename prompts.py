@@ -1,4 +1,5 @@
-INVOICE_EXTRACTION_PROMPT = """These images are pages from a document sent to an accounts payable inbox. 
+# The instructions shared by the free-form JSON and the tool output variants
+INVOICE_INSTRUCTIONS = """These images are pages from a document sent to an accounts payable inbox. 
 Your job is to identify the type of document and extract details for a number of different fields 
 if the document is an invoice, credit note, or a reminder document, and return those in JSON format. 
 Before extracting any information, you need to classify the document to one of the following types:
@@ -44,7 +45,9 @@ assume that the date has been written in month-first date format and convert it
   - unit_price: The unit price as a number
   - total: The total amount for this line item as a number
 
-Your response should be formatted in JSON format, with two keys in a dictionary: 
+"""
+
+JSON_OUTPUT_INSTRUCTIONS = """Your response should be formatted in JSON format, with two keys in a dictionary: 
 "document_type" and "invoices". 
 "document_type" should contain your classification of the document, and "invoices" should be a list of 
 dictionaries containing invoice details for every extracted invoice. 
@@ -74,4 +77,76 @@ Here is an example output format for a document classified as 'invoice' containi
     }]
 }
 
-Once again, make sure to return your answers in JSON format and do not return any other text in your answer.""" 
\ No newline at end of file
+Once again, make sure to return your answers in JSON format and do not return any other text in your answer."""
+
+INVOICE_EXTRACTION_PROMPT = INVOICE_INSTRUCTIONS + JSON_OUTPUT_INSTRUCTIONS
+
+INVOICE_TOOL_NAME = "record_invoices"
+
+TOOL_OUTPUT_INSTRUCTIONS = """Record your answer by calling the `record_invoices` tool with the document type and 
+the list of extracted invoices. If the document is not classified as 'invoice', 'reminder', or 'credit_note', 
+"invoices" must be an empty list."""
+
+# Without the example output block, which the tool's input schema replaces
+INVOICE_TOOL_PROMPT = INVOICE_INSTRUCTIONS + TOOL_OUTPUT_INSTRUCTIONS
+
+_TEXT_FIELD = {"type": "string"}
+_NUMBER_FIELD = {"type": ["number", "string"]}
+
+INVOICE_TOOL = {
+    "name": INVOICE_TOOL_NAME,
+    "description": "Record the document type and the invoices extracted from the document.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "document_type": {
+                "type": "string",
+                "enum": [
+                    "invoice",
+                    "statement",
+                    "reminder",
+                    "credit_note",
+                    "purchase_order",
+                    "remittance_advice",
+                    "other",
+                ],
+            },
+            "invoices": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "number": _TEXT_FIELD,
+                        "po_number": _TEXT_FIELD,
+                        "amount": _NUMBER_FIELD,
+                        "tax_amount": _NUMBER_FIELD,
+                        "currency_code": _TEXT_FIELD,
+                        "date": _TEXT_FIELD,
+                        "due_date": _TEXT_FIELD,
+                        "payment_term_days": _NUMBER_FIELD,
+                        "vendor": _TEXT_FIELD,
+                        "line_items": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "description": _TEXT_FIELD,
+                                    "quantity": _NUMBER_FIELD,
+                                    "unit_price": _NUMBER_FIELD,
+                                    "total": _NUMBER_FIELD,
+                                },
+                            },
+                        },
+                    },
+                },
+            },
+        },
+        "required": ["document_type", "invoices"],
+    },
+}
+
+
+TEXT_PAGES_NOTE = """Some pages of this document were born-digital and are provided as their extracted text 
+layer instead of an image. Each of them starts with a line like '--- Page N (text layer) ---'. 
+Lines may start with '@x,y', the position of the line on the page in points from the top-left corner. 
+Treat these pages exactly like the page images, in page order."""
@@ -0,0 +1,682 @@
+"""Local stand-in for the Anthropic and Bedrock endpoints, for offline benchmarks.
+
+    store = ReplayStore("recordings.jsonl", fallback=result)
+    with ReplayServer(store, latency=0.5, throttle_rate=0.05) as server:
+        anthropic = AnthropicClient(base_url=server.url)
+        bedrock = BedrockClient(endpoint_url=server.url)
+
+Routes are POST /v1/messages (Anthropic, as JSON or server-sent events),
+POST /model/{model_id}/invoke (Bedrock InvokeModel) and POST
+/model/{model_id}/invoke-with-response-stream (as AWS event-stream frames).
+
+Batches are served too: the Message Batches routes under
+/v1/messages/batches, and Bedrock batch inference jobs under
+/model-invocation-job, which read their input from and write their output to
+an in-memory S3 served at /{bucket}/{key}. Batches end `batch_latency`
+seconds after they were submitted.
+
+Results are looked up by a hash of the request's pages only, so one
+recording serves both providers, with or without prompt caching, and is
+returned as JSON text or as a `record_invoices` tool call to match the
+request. Requests without a recording get the store's fallback result.
+Usage is estimated like the scheduler does, with the prompt counted as a
+cache write the first time a cached system prompt is seen and as a cache
+read after that.
+
+Every response takes `latency` seconds to its first token, plus its output
+tokens at `tokens_per_second`, scaled by a random factor within `jitter`.
+Requests beyond `max_concurrency` in flight, and a `throttle_rate` fraction
+of the rest, are throttled with a 429 and a retry-after header.
+
+With `upstream`, Anthropic requests are forwarded to the real API and the
+results recorded. Bedrock requests are signed for the real host and cannot
+be forwarded, but recordings made through the Anthropic route serve them.
+
+Usage:
+    python replay_stub.py --recordings recordings.jsonl --latency 0.5 --port 8765
+    python replay_stub.py --recordings recordings.jsonl --record
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+from time import sleep, time
+from typing import Any, Dict, Optional
+from urllib.parse import unquote
+from uuid import uuid4
+
+import httpx
+
+from prompts import INVOICE_TOOL_NAME
+from scheduler import IMAGE_TOKEN_ESTIMATE, PROMPT_TOKEN_ESTIMATE
+
+ANTHROPIC_UPSTREAM = "https://api.anthropic.com"
+# Request headers passed on to the upstream API when recording
+FORWARDED_HEADERS = ("x-api-key", "anthropic-version", "anthropic-beta", "content-type")
+BEDROCK_INVOKE_PATH = re.compile(r"^/model/(?P<model_id>[^/]+)/invoke(?P<stream>-with-response-stream)?$")
+ANTHROPIC_BATCH_PATH = re.compile(r"^/v1/messages/batches/(?P<batch_id>[^/]+)(?P<results>/results)?$")
+BEDROCK_JOB_PATH = re.compile(r"^/model-invocation-job/(?P<job>[^/]+)$")
+# Characters of output sent per streamed delta
+STREAM_CHUNK_CHARS = 64
+
+
+def event_stream_frame(payload: Dict[str, Any]) -> bytes:
+    """Encode a Bedrock response stream chunk as an AWS event-stream message."""
+    headers = b"".join(
+        struct.pack("!B", len(name)) + name + struct.pack("!BH", 7, len(value)) + value
+        for name, value in (
+            (b":event-type", b"chunk"),
+            (b":content-type", b"application/json"),
+            (b":message-type", b"event"),
+        )
+    )
+    body = json.dumps({"bytes": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")})
+    body = body.encode("utf-8")
+    # Total length, headers length and their CRC, then headers, payload and the message CRC
+    prelude = struct.pack("!II", 16 + len(headers) + len(body), len(headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def request_key(body: Dict[str, Any]) -> str:
+    """Hash of the pages in a Messages request, ignoring prompt and options."""
+    digest = hashlib.sha256()
+    for message in body.get("messages", []):
+        content = message.get("content")
+        for block in content if isinstance(content, list) else []:
+            if block.get("type") == "image":
+                digest.update(block["source"]["data"].encode("utf-8"))
+            elif block.get("type") == "text" and block["text"].startswith("--- Page "):
+                digest.update(block["text"].encode("utf-8"))
+    return digest.hexdigest()
+
+
+def estimate_usage(body: Dict[str, Any], cached_prompt: Optional[bool]) -> Dict[str, int]:
+    """Token usage of a request, estimated like `scheduler.estimate_input_tokens`.
+
+    `cached_prompt` is None when the prompt is not marked for caching, False
+    for a cache write and True for a cache read.
+    """
+    page_tokens = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        for block in content if isinstance(content, list) else []:
+            if block.get("type") == "image":
+                page_tokens += IMAGE_TOKEN_ESTIMATE
+            elif block.get("type") == "text" and block["text"].startswith("--- Page "):
+                page_tokens += len(block["text"]) // 4
+    usage = {
+        "input_tokens": page_tokens,
+        "output_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0,
+    }
+    if cached_prompt is None:
+        usage["input_tokens"] += PROMPT_TOKEN_ESTIMATE
+    elif cached_prompt:
+        usage["cache_read_input_tokens"] = PROMPT_TOKEN_ESTIMATE
+    else:
+        usage["cache_creation_input_tokens"] = PROMPT_TOKEN_ESTIMATE
+    return usage
+
+
+class ReplayStore:
+    """Recorded extraction results, kept in memory and appended to a JSONL file."""
+
+    def __init__(self, path: Optional[str] = None, fallback: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            path (str): JSONL file of {"key", "result", "usage"} lines; recordings are
+                loaded from it and new ones appended to it
+            fallback (dict): Result returned for requests without a recording; without
+                one, such requests fail with a 404
+        """
+        self.path = path
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._recordings: Dict[str, Dict[str, Any]] = {}
+        if path:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        if line.strip():
+                            recording = json.loads(line)
+                            self._recordings[recording["key"]] = recording
+            except FileNotFoundError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._recordings)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The recording for a request key, or the fallback result without usage."""
+        recording = self._recordings.get(key)
+        if recording is None and self.fallback is not None:
+            return {"key": key, "result": self.fallback, "usage": None}
+        return recording
+
+    def put(self, key: str, result: Dict[str, Any], usage: Optional[Dict[str, int]] = None) -> None:
+        recording = {"key": key, "result": result, "usage": usage}
+        with self._lock:
+            self._recordings[key] = recording
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(recording) + "\n")
+
+
+class ReplayServer:
+    """HTTP server replaying a ReplayStore with configurable latency and throttling."""
+
+    def __init__(
+        self,
+        store: ReplayStore,
+        latency: float = 0.5,
+        tokens_per_second: float = 200.0,
+        jitter: float = 0.2,
+        throttle_rate: float = 0.0,
+        max_concurrency: Optional[int] = None,
+        retry_after: float = 0.1,
+        upstream: Optional[str] = None,
+        seed: Optional[int] = None,
+        batch_latency: float = 2.0,
+    ):
+        """
+        Args:
+            latency (float): Seconds to the first token of every response
+            tokens_per_second (float): Output generation speed after the first token
+            jitter (float): Latencies are scaled by a random factor in [1 - jitter, 1 + jitter]
+            throttle_rate (float): Fraction of requests throttled at random
+            max_concurrency (int): Requests in flight beyond this are throttled
+            retry_after (float): Seconds sent in the retry-after header of throttled requests
+            upstream (str): Forward Anthropic requests to this API and record the results
+            batch_latency (float): Seconds until a submitted batch or batch job ends
+        """
+        self.store = store
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.upstream = upstream
+        self.batch_latency = batch_latency
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._seen_prompts: set[str] = set()
+        self._upstream_client: Optional[httpx.Client] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+        # Submitted batches by ID and S3 objects by "bucket/key"
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._objects: Dict[str, bytes] = {}
+        self.stats = {"requests": 0, "throttled": 0, "recorded": 0, "missing": 0, "batches": 0}
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, port: int = 0, host: str = "127.0.0.1") -> str:
+        """Serve from a daemon thread on `port` (0 picks a free one); returns the URL."""
+        stub = self
+
+        class ReplayHandler(BaseHTTPRequestHandler):
+            # Keep-alive, so the clients' connection pools are exercised as in production
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                path = self.path.split("?")[0]
+                match = BEDROCK_INVOKE_PATH.match(path)
+                if path == "/v1/messages":
+                    stub._handle(self, body, "anthropic")
+                elif match:
+                    stub._handle(self, {**body, "stream": bool(match["stream"])}, "bedrock")
+                elif path == "/v1/messages/batches":
+                    stub._create_anthropic_batch(self, body)
+                elif path == "/model-invocation-job":
+                    stub._create_bedrock_job(self, body)
+                else:
+                    stub._send_json(self, 404, {"message": f"No route for {path}"})
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                anthropic_batch = ANTHROPIC_BATCH_PATH.match(path)
+                bedrock_job = BEDROCK_JOB_PATH.match(path)
+                if anthropic_batch:
+                    stub._get_anthropic_batch(self, anthropic_batch["batch_id"], bool(anthropic_batch["results"]))
+                elif bedrock_job:
+                    stub._get_bedrock_job(self, unquote(bedrock_job["job"]))
+                else:
+                    stub._get_object(self, unquote(path.lstrip("/")))
+
+            def do_PUT(self):
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub._lock:
+                    stub._objects[unquote(self.path.split("?")[0].lstrip("/"))] = data
+                stub._send_bytes(self, 200, b"", "application/xml", {"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), ReplayHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._upstream_client is not None:
+            self._upstream_client.close()
+
+    def __enter__(self) -> "ReplayServer":
+        if self._server is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _scaled(self, seconds: float) -> float:
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, seconds * factor)
+
+    def _should_throttle(self) -> bool:
+        """Count the request in flight, unless it is throttled."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if (self.max_concurrency is not None and self._in_flight >= self.max_concurrency) or (
+                self._random.random() < self.throttle_rate
+            ):
+                self.stats["throttled"] += 1
+                return True
+            self._in_flight += 1
+            return False
+
+    def _cached_prompt(self, body: Dict[str, Any]) -> Optional[bool]:
+        system = body.get("system")
+        if not isinstance(system, list) or not any("cache_control" in block for block in system):
+            return None
+        prompt = hashlib.sha256(json.dumps([system, body.get("tools")]).encode("utf-8")).hexdigest()
+        with self._lock:
+            seen = prompt in self._seen_prompts
+            self._seen_prompts.add(prompt)
+        return seen
+
+    def _handle(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any], provider: str) -> None:
+        if self._should_throttle():
+            self._send_throttled(handler, provider)
+            return
+        try:
+            key = request_key(body)
+            if self.upstream and provider == "anthropic":
+                recording = self._record(handler, body, key)
+                if recording is None:
+                    return
+                simulate_latency = False
+            else:
+                recording = self.store.get(key)
+                simulate_latency = True
+            if recording is None:
+                with self._lock:
+                    self.stats["missing"] += 1
+                self._send_json(handler, 404, {
+                    "type": "error",
+                    "error": {"type": "not_found_error", "message": f"No recording for request {key}"},
+                })
+                return
+
+            usage = self._usage(body, recording)
+            first_token = self._scaled(self.latency) if simulate_latency else 0.0
+            generation = (
+                self._scaled(usage["output_tokens"] / self.tokens_per_second) if simulate_latency else 0.0
+            )
+            if body.get("stream"):
+                self._send_stream(handler, provider, body, recording["result"], usage, first_token, generation)
+            else:
+                sleep(first_token + generation)
+                self._send_json(handler, 200, self._message(body, recording["result"], usage))
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _usage(self, body: Dict[str, Any], recording: Dict[str, Any]) -> Dict[str, int]:
+        """Recorded usage, or an estimate, with output tokens from the result's length."""
+        usage = recording["usage"] or estimate_usage(body, self._cached_prompt(body))
+        output = self._output_text(recording["result"])
+        return {**usage, "output_tokens": usage.get("output_tokens") or len(output) // 4}
+
+    def _batch_message(self, body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """The message a batched request is answered with, or None without a recording."""
+        recording = self.store.get(request_key(body))
+        if recording is None:
+            with self._lock:
+                self.stats["missing"] += 1
+            return None
+        return self._message(body, recording["result"], self._usage(body, recording))
+
+    def _submit_batch(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        batch["submitted_at"] = time()
+        batch["ends_at"] = batch["submitted_at"] + self._scaled(self.batch_latency)
+        with self._lock:
+            self._batches[batch["id"]] = batch
+            self.stats["batches"] += 1
+        return batch
+
+    @staticmethod
+    def _timestamp(seconds: float) -> str:
+        return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+    def _create_anthropic_batch(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any]) -> None:
+        batch = self._submit_batch({"id": f"msgbatch_{uuid4().hex}", "requests": body.get("requests", [])})
+        self._send_json(handler, 200, self._anthropic_batch(batch))
+
+    def _anthropic_batch(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        ended = time() >= batch["ends_at"]
+        count = len(batch["requests"])
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count if ended else 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": self._timestamp(batch["submitted_at"]),
+            "ended_at": self._timestamp(batch["ends_at"]) if ended else None,
+            "expires_at": self._timestamp(batch["submitted_at"] + 24 * 60 * 60),
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+    def _get_anthropic_batch(self, handler: BaseHTTPRequestHandler, batch_id: str, results: bool) -> None:
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            self._send_json(handler, 404, {
+                "type": "error", "error": {"type": "not_found_error", "message": f"No batch {batch_id}"},
+            })
+        elif not results:
+            self._send_json(handler, 200, self._anthropic_batch(batch))
+        else:
+            lines = []
+            for request in batch["requests"]:
+                message = self._batch_message(request["params"])
+                if message is None:
+                    result = {
+                        "type": "errored",
+                        "error": {"type": "error", "error": {"type": "not_found_error", "message": "No recording"}},
+                    }
+                else:
+                    result = {"type": "succeeded", "message": message}
+                lines.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+            self._send_bytes(handler, 200, "\n".join(lines).encode("utf-8"), "application/binary")
+
+    def _create_bedrock_job(self, handler: BaseHTTPRequestHandler, body: Dict[str, Any]) -> None:
+        input_uri = body["inputDataConfig"]["s3InputDataConfig"]["s3Uri"]
+        data = self._objects.get(input_uri.removeprefix("s3://"))
+        if data is None:
+            self._send_json(handler, 400, {"message": f"No input file at {input_uri}"}, {
+                "x-amzn-ErrorType": "ValidationException",
+            })
+            return
+        job_id = uuid4().hex[:12]
+        batch = self._submit_batch({
+            "id": f"arn:aws:bedrock:us-east-1:000000000000:model-invocation-job/{job_id}",
+            "job": body,
+            "records": [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()],
+        })
+        self._send_json(handler, 200, {"jobArn": batch["id"]})
+
+    def _get_bedrock_job(self, handler: BaseHTTPRequestHandler, job_arn: str) -> None:
+        batch = self._batches.get(job_arn)
+        if batch is None:
+            self._send_json(handler, 404, {"message": f"No job {job_arn}"}, {
+                "x-amzn-ErrorType": "ResourceNotFoundException",
+            })
+            return
+        job = batch["job"]
+        ended = time() >= batch["ends_at"]
+        if ended and "output_written" not in batch:
+            # Output goes to <output prefix>/<job ID>/<input file name>.out
+            input_name = job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"].rsplit("/", 1)[-1]
+            output_uri = job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"].removeprefix("s3://").rstrip("/")
+            lines = []
+            for record in batch["records"]:
+                message = self._batch_message(record["modelInput"])
+                if message is None:
+                    record = {**record, "error": {"errorCode": 404, "errorMessage": "No recording"}}
+                else:
+                    record = {**record, "modelOutput": message}
+                lines.append(json.dumps(record))
+            with self._lock:
+                self._objects[f"{output_uri}/{job_arn.rsplit('/', 1)[-1]}/{input_name}.out"] = (
+                    "\n".join(lines).encode("utf-8")
+                )
+            batch["output_written"] = True
+        self._send_json(handler, 200, {
+            "jobArn": job_arn,
+            "jobName": job["jobName"],
+            "modelId": job["modelId"],
+            "roleArn": job["roleArn"],
+            "status": "Completed" if ended else "InProgress",
+            "submitTime": self._timestamp(batch["submitted_at"]),
+            "inputDataConfig": job["inputDataConfig"],
+            "outputDataConfig": job["outputDataConfig"],
+        })
+
+    def _get_object(self, handler: BaseHTTPRequestHandler, key: str) -> None:
+        data = self._objects.get(key)
+        if data is None:
+            error = f"<Error><Code>NoSuchKey</Code><Message>No object {key}</Message></Error>"
+            self._send_bytes(handler, 404, error.encode("utf-8"), "application/xml")
+        else:
+            self._send_bytes(handler, 200, data, "application/octet-stream")
+
+    def _record(
+        self, handler: BaseHTTPRequestHandler, body: Dict[str, Any], key: str
+    ) -> Optional[Dict[str, Any]]:
+        """Forward a request upstream and record its result; errors are passed through."""
+        if self._upstream_client is None:
+            self._upstream_client = httpx.Client(timeout=httpx.Timeout(300.0, connect=10.0))
+        # Streams are recorded from a plain request and replayed as a stream
+        upstream_body = {name: value for name, value in body.items() if name != "stream"}
+        response = self._upstream_client.post(
+            f"{self.upstream.rstrip('/')}/v1/messages",
+            json=upstream_body,
+            headers={name: handler.headers[name] for name in FORWARDED_HEADERS if name in handler.headers},
+        )
+        if response.status_code != 200:
+            content_type = response.headers.get("content-type", "application/json")
+            self._send_bytes(handler, response.status_code, response.content, content_type)
+            return None
+        message = response.json()
+        tool_use = next((block for block in message["content"] if block["type"] == "tool_use"), None)
+        try:
+            result = tool_use["input"] if tool_use is not None else json.loads(message["content"][0]["text"])
+        except (json.JSONDecodeError, IndexError, KeyError) as e:
+            print(f"Not recording unparseable response: {e}")
+            self._send_bytes(handler, 200, response.content, "application/json")
+            return None
+        self.store.put(key, result, message.get("usage"))
+        with self._lock:
+            self.stats["recorded"] += 1
+        return {"key": key, "result": result, "usage": message.get("usage")}
+
+    @staticmethod
+    def _output_text(result: Dict[str, Any]) -> str:
+        return json.dumps(result, indent=2)
+
+    def _content_block(self, body: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+        if body.get("tool_choice", {}).get("type") == "tool":
+            return {"type": "tool_use", "id": "toolu_replay", "name": INVOICE_TOOL_NAME, "input": result}
+        return {"type": "text", "text": self._output_text(result)}
+
+    def _message(self, body: Dict[str, Any], result: Dict[str, Any], usage: Dict[str, int]) -> Dict[str, Any]:
+        block = self._content_block(body, result)
+        return {
+            "id": "msg_replay",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "replay"),
+            "content": [block],
+            "stop_reason": "tool_use" if block["type"] == "tool_use" else "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+    def _send_stream(
+        self,
+        handler: BaseHTTPRequestHandler,
+        provider: str,
+        body: Dict[str, Any],
+        result: Dict[str, Any],
+        usage: Dict[str, int],
+        first_token: float,
+        generation: float,
+    ) -> None:
+        """Send the response as Messages API stream events.
+
+        Anthropic sends them as server-sent events, Bedrock as event-stream
+        frames carrying the same events.
+        """
+        message = self._message(body, result, usage)
+        block = message["content"][0]
+        text = self._output_text(result)
+        chunks = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)]
+        if block["type"] == "tool_use":
+            start_block = {**block, "input": {}}
+            deltas = [{"type": "input_json_delta", "partial_json": chunk} for chunk in chunks]
+        else:
+            start_block = {"type": "text", "text": ""}
+            deltas = [{"type": "text_delta", "text": chunk} for chunk in chunks]
+
+        handler.send_response(200)
+        if provider == "bedrock":
+            handler.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        else:
+            handler.send_header("Content-Type", "text/event-stream")
+            handler.send_header("Cache-Control", "no-cache")
+        # Without a length the end of the stream is marked by closing the connection
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+
+        def send(event: str, data: Dict[str, Any]) -> None:
+            if provider == "bedrock":
+                handler.wfile.write(event_stream_frame(data))
+            else:
+                handler.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+
+        send("message_start", {
+            "type": "message_start",
+            "message": {**message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}},
+        })
+        send("content_block_start", {"type": "content_block_start", "index": 0, "content_block": start_block})
+        sleep(first_token)
+        for delta in deltas:
+            send("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta})
+            sleep(generation / len(deltas))
+        send("content_block_stop", {"type": "content_block_stop", "index": 0})
+        send("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+            "usage": {"output_tokens": usage["output_tokens"]},
+        })
+        send("message_stop", {"type": "message_stop"})
+
+    def _send_throttled(self, handler: BaseHTTPRequestHandler, provider: str) -> None:
+        headers = {
+            "retry-after": str(max(1, round(self.retry_after))),
+            "retry-after-ms": str(round(self.retry_after * 1000)),
+        }
+        if provider == "bedrock":
+            headers["x-amzn-ErrorType"] = "ThrottlingException"
+            payload = {"message": "Too many requests, please wait before trying again."}
+        else:
+            payload = {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limited by replay stub"}}
+        self._send_json(handler, 429, payload, headers)
+
+    @staticmethod
+    def _send_json(
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        ReplayServer._send_bytes(handler, status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    @staticmethod
+    def _send_bytes(
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        data: bytes,
+        content_type: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recordings", help="JSONL file recordings are read from and written to")
+    parser.add_argument("--fallback", help="JSON file with the result returned for unrecorded requests")
+    parser.add_argument("--record", action="store_true", help="Forward Anthropic requests upstream and record them")
+    parser.add_argument("--upstream", default=ANTHROPIC_UPSTREAM, help="API recorded requests are forwarded to")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests throttled")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Throttle requests beyond this many in flight")
+    parser.add_argument("--batch-latency", type=float, default=2.0, help="Seconds until a submitted batch ends")
+    args = parser.parse_args(argv)
+
+    fallback = None
+    if args.fallback:
+        with open(args.fallback) as f:
+            fallback = json.load(f)
+    server = ReplayServer(
+        ReplayStore(args.recordings, fallback),
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        throttle_rate=args.throttle_rate,
+        max_concurrency=args.max_concurrency,
+        upstream=args.upstream if args.record else None,
+        batch_latency=args.batch_latency,
+    )
+    url = server.start(args.port, args.host)
+    print(f"Replaying {len(server.store)} recordings at {url}")
+    print(f"  ANTHROPIC: AnthropicClient(base_url={url!r})")
+    print(f"  BEDROCK:   BedrockClient(endpoint_url={url!r})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from time import time
+from typing import Dict, Any, Iterable, Iterator, Optional
+
+from extraction import apply_triage, extract_invoice_data_chunked
+from image_processor import iter_image_from_pdf, kept_page_numbers, triage_pdf_pages
+from prompts import INVOICE_EXTRACTION_PROMPT, INVOICE_TOOL, INVOICE_TOOL_PROMPT
+
+DEFAULT_CACHE_PATH = os.getenv("INVOICE_CACHE_PATH", ".invoice_cache.sqlite3")
+DEFAULT_MAX_RESULT_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_PAGE_IMAGE_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Changing the prompt changes what the model returns, so it is part of the key
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps([INVOICE_EXTRACTION_PROMPT, INVOICE_TOOL_PROMPT, INVOICE_TOOL]).encode("utf-8")
+).hexdigest()[:16]
+
+
+def hash_pdf(pdf_bytes: bytes) -> str:
+    """Content hash used to identify a PDF regardless of its file name."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+class ExtractionCache:
+    """SQLite-backed cache for extraction results and rendered page images.
+
+    Results are keyed by PDF hash, provider/model and prompt version. Page
+    images are keyed by PDF hash only, so a document already rendered for one
+    provider is not rendered again for the other. They are stored one row per
+    page, so a document can be written and read a page at a time without
+    holding all of its pages in memory. Results and page images are evicted
+    independently, first by age and then least-recently-used down to their
+    size limits.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_result_bytes: int = DEFAULT_MAX_RESULT_BYTES,
+        max_page_image_bytes: int = DEFAULT_MAX_PAGE_IMAGE_BYTES,
+        max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+    ):
+        self.path = path
+        self.max_result_bytes = max_result_bytes
+        self.max_page_image_bytes = max_page_image_bytes
+        self.max_age_seconds = max_age_seconds
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS extraction_results (
+                    key TEXT PRIMARY KEY,
+                    pdf_hash TEXT NOT NULL,
+                    model_key TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            # Superseded by the per-page tables below
+            conn.execute("DROP TABLE IF EXISTS page_images")
+            # One row per document; `pages` stays 0 until every page is stored
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS page_image_documents (
+                    key TEXT PRIMARY KEY,
+                    pages INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS page_image_pages (
+                    pdf_hash TEXT NOT NULL,
+                    page INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (pdf_hash, page)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # A connection per operation keeps the cache safe to share between threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def result_key(pdf_hash: str, model_key: str) -> str:
+        return f"{pdf_hash}:{model_key}:{PROMPT_VERSION}"
+
+    def _get(self, table: str, key: str, column: str = "data") -> Optional[Any]:
+        now = time()
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT {column}, created_at FROM {table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            data, created_at = row
+            if now - created_at > self.max_age_seconds:
+                conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                f"UPDATE {table} SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            return data
+
+    def _evict(self, conn: sqlite3.Connection, table: str, max_bytes: int) -> None:
+        conn.execute(
+            f"DELETE FROM {table} WHERE created_at < ?",
+            (time() - self.max_age_seconds,),
+        )
+        (total,) = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()
+        if total <= max_bytes:
+            return
+        rows = conn.execute(
+            f"SELECT key, size FROM {table} ORDER BY accessed_at ASC"
+        ).fetchall()
+        stale_keys = []
+        for key, size in rows:
+            if total <= max_bytes:
+                break
+            stale_keys.append((key,))
+            total -= size
+        conn.executemany(f"DELETE FROM {table} WHERE key = ?", stale_keys)
+
+    def get_result(self, pdf_hash: str, model_key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached extraction result, or None on a miss."""
+        data = self._get("extraction_results", self.result_key(pdf_hash, model_key))
+        return json.loads(data) if data is not None else None
+
+    def put_result(self, pdf_hash: str, model_key: str, result: Dict[str, Any]) -> None:
+        """Store an extraction result and evict entries over the limits."""
+        data = json.dumps(result)
+        now = time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO extraction_results
+                (key, pdf_hash, model_key, prompt_version, data, size, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    self.result_key(pdf_hash, model_key),
+                    pdf_hash,
+                    model_key,
+                    PROMPT_VERSION,
+                    data,
+                    len(data),
+                    now,
+                    now,
+                ),
+            )
+            self._evict(conn, "extraction_results", self.max_result_bytes)
+
+    @staticmethod
+    def _delete_orphan_pages(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "DELETE FROM page_image_pages WHERE pdf_hash NOT IN (SELECT key FROM page_image_documents)"
+        )
+
+    def iter_page_images(self, pdf_hash: str) -> Optional[Iterator[str]]:
+        """Return the cached base64 page images as a lazy iterator, or None on a miss.
+
+        Pages are read one at a time as they are consumed, each in its own
+        query, so no read lock is held while the consumer works.
+        """
+        page_count = self._get("page_image_documents", pdf_hash, "pages")
+        if not page_count:
+            return None
+        with self._connect() as conn:
+            (stored,) = conn.execute(
+                "SELECT COUNT(*) FROM page_image_pages WHERE pdf_hash = ?", (pdf_hash,)
+            ).fetchone()
+        # Pages of a document rewritten concurrently may be missing
+        if stored != page_count:
+            return None
+
+        def read_pages() -> Iterator[str]:
+            for page in range(page_count):
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT data FROM page_image_pages WHERE pdf_hash = ? AND page = ?",
+                        (pdf_hash, page),
+                    ).fetchone()
+                if row is None:
+                    raise LookupError(f"Page {page + 1} of cached document {pdf_hash} was evicted")
+                yield row[0]
+
+        return read_pages()
+
+    def get_page_images(self, pdf_hash: str) -> Optional[list[str]]:
+        """Return the cached base64 page images, or None on a miss."""
+        pages = self.iter_page_images(pdf_hash)
+        return list(pages) if pages is not None else None
+
+    def cache_page_images(self, pdf_hash: str, image_base64_list: Iterable[str]) -> Iterator[str]:
+        """Pass base64 page images through, storing each one as it goes by.
+
+        Every page is written in its own short transaction. The document only
+        becomes visible once its last page is stored; if the consumer stops
+        early or the pages raise, what was written is removed again.
+        """
+        now = time()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO page_image_documents (key, pages, size, created_at, accessed_at)
+                VALUES (?, 0, 0, ?, ?)
+                """,
+                (pdf_hash, now, now),
+            )
+            conn.execute("DELETE FROM page_image_pages WHERE pdf_hash = ?", (pdf_hash,))
+
+        page_count = size = 0
+        complete = False
+        try:
+            for image_base64 in image_base64_list:
+                with self._connect() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO page_image_pages (pdf_hash, page, data) VALUES (?, ?, ?)",
+                        (pdf_hash, page_count, image_base64),
+                    )
+                page_count += 1
+                size += len(image_base64)
+                yield image_base64
+            complete = page_count > 0
+        finally:
+            with self._connect() as conn:
+                if complete:
+                    conn.execute(
+                        "UPDATE page_image_documents SET pages = ?, size = ? WHERE key = ?",
+                        (page_count, size, pdf_hash),
+                    )
+                    self._evict(conn, "page_image_documents", self.max_page_image_bytes)
+                else:
+                    conn.execute("DELETE FROM page_image_documents WHERE key = ?", (pdf_hash,))
+                self._delete_orphan_pages(conn)
+
+    def put_page_images(self, pdf_hash: str, image_base64_list: Iterable[str]) -> None:
+        """Store base64 page images and evict entries over the limits."""
+        for _ in self.cache_page_images(pdf_hash, image_base64_list):
+            pass
+
+    def iter_document_pages(
+        self,
+        pdf_bytes: bytes,
+        pdf_hash: Optional[str] = None,
+        page_numbers: Optional[list[int]] = None,
+    ) -> Iterator[str]:
+        """Lazily yield the page images for a PDF, rendering it only on a cache miss.
+
+        Rendered pages are stored as they are yielded (see `cache_page_images`).
+        A selection of `page_numbers` is cached on its own.
+        """
+        pdf_hash = pdf_hash or hash_pdf(pdf_bytes)
+        key = page_selection_key(pdf_hash, page_numbers)
+        pages = self.iter_page_images(key)
+        if pages is None:
+            pages = self.cache_page_images(
+                key, iter_image_from_pdf(pdf_bytes, page_numbers=page_numbers)
+            )
+        return pages
+
+    def load_page_images(
+        self,
+        pdf_bytes: bytes,
+        pdf_hash: Optional[str] = None,
+        page_numbers: Optional[list[int]] = None,
+    ) -> list[str]:
+        """Return the page images for a PDF, rendering it only on a cache miss.
+
+        Errors are printed and an empty list is returned.
+        """
+        try:
+            return list(self.iter_document_pages(pdf_bytes, pdf_hash, page_numbers))
+        except Exception as e:
+            print(f"Error processing PDF: {str(e)}")
+            return []
+
+    def clear(self) -> None:
+        """Remove every cached result and page image."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM extraction_results")
+            conn.execute("DELETE FROM page_image_documents")
+            conn.execute("DELETE FROM page_image_pages")
+
+
+def page_selection_key(pdf_hash: str, page_numbers: Optional[list[int]] = None) -> str:
+    """Page image cache key for some of a PDF's pages, or all of them."""
+    if page_numbers is None:
+        return pdf_hash
+    selection = hashlib.sha256(",".join(map(str, page_numbers)).encode()).hexdigest()[:16]
+    return f"{pdf_hash}:{selection}"
+
+
+def result_model_key(model_key: str, triage: bool = False) -> str:
+    """Model key for cached results; results from triaged pages are kept apart."""
+    return f"{model_key}:triage" if triage else model_key
+
+
+def extract_invoice_data_cached(
+    client,
+    pdf_bytes: bytes,
+    cache: ExtractionCache,
+    pdf_hash: Optional[str] = None,
+    triage: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """Run `client.extract_invoice_data` on a PDF through the cache.
+
+    Long documents are extracted in concurrent page windows
+    (see `extract_invoice_data_chunked`). Pages are streamed from the cache,
+    or rendered and cached as they are consumed, so only the windows in
+    flight are held in memory.
+
+    A result hit returns without rendering or calling the model. Failed
+    extractions (None) are not cached so they are retried next time. Errors
+    rendering the PDF are printed and None is returned.
+
+    With `triage`, blank, duplicate and boilerplate pages are left out (see
+    `triage_pdf_pages`) and listed under "skipped_pages" on the result.
+    """
+    pdf_hash = pdf_hash or hash_pdf(pdf_bytes)
+    model_key = result_model_key(client.model_key, triage)
+    result = cache.get_result(pdf_hash, model_key)
+    if result is not None:
+        return result
+
+    try:
+        page_triage = triage_pdf_pages(pdf_bytes) if triage else None
+        page_numbers = kept_page_numbers(page_triage) if triage else None
+        result = extract_invoice_data_chunked(
+            client, cache.iter_document_pages(pdf_bytes, pdf_hash, page_numbers)
+        )
+    except Exception as e:
+        print(f"Error processing PDF: {str(e)}")
+        return None
+    if triage:
+        result = apply_triage(result, page_triage)
+    # Partial results (some page windows failed or a response was cut off) are retried next time
+    if result is not None and not result.get("failed_pages") and not result.get("truncated"):
+        cache.put_result(pdf_hash, model_key, result)
+    return result
@@ -0,0 +1,251 @@
+"""Rate-limited, retrying scheduler that spreads extraction over providers.
+
+Both clients send the same INVOICE_EXTRACTION_PROMPT and return the same
+output shape, so one queue can drive them together:
+
+    scheduler = ExtractionScheduler([
+        ProviderLane(AnthropicClient(max_retries=0), requests_per_minute=50,
+                     input_tokens_per_minute=40_000),
+        ProviderLane(BedrockClient(max_retries=0), requests_per_minute=20,
+                     input_tokens_per_minute=100_000),
+    ])
+    results = asyncio.run(scheduler.extract_many(documents))
+
+`ScheduledClient` puts a scheduler behind the synchronous client interface,
+so the rest of the pipeline (`extract_invoice_data_chunked`, batch.py with
+`--failover`) sends every request through it.
+
+Each request goes to the first lane that can admit it now. A lane is ready
+when it is not in a throttle cool-down, is below its in-flight limit, and has
+request and token budget in its buckets. When one provider throttles, its
+lane cools down for the retry-after period (or a jittered backoff) and work
+spills over to the other lane. Build the clients with `max_retries=0` so
+throttles reach the scheduler instead of being retried inside the SDK.
+"""
+import asyncio
+import random
+import sys
+import threading
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Dict, Optional
+
+from page_content import PageContent, PDFPageText
+
+# Rough input cost of a request, used to reserve token budget up front.
+# The prompt is ~1,200 tokens, and a page image at the default zoom is
+# downscaled by the API to about 1,600 tokens. The estimate is corrected
+# from the response usage once the request completes.
+PROMPT_TOKEN_ESTIMATE = 1200
+IMAGE_TOKEN_ESTIMATE = 1600
+
+
+def estimate_input_tokens(image_base64_list: list[PageContent]) -> int:
+    tokens = PROMPT_TOKEN_ESTIMATE
+    for page in image_base64_list:
+        if isinstance(page, PDFPageText):
+            # Roughly four characters per token for text-layer pages
+            tokens += len(page.text) // 4
+        else:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_minute`.
+
+    The balance may go negative when a reservation is corrected upwards
+    after the fact; the bucket then stays closed until it has refilled.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be taken now."""
+        self._refill()
+        # A request larger than the whole bucket is admitted once it is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate_per_second
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def give_back(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+@dataclass
+class ProviderLane:
+    """One provider client with its own limits and throttle state."""
+
+    client: Any
+    requests_per_minute: float = 50
+    input_tokens_per_minute: float = 40_000
+    max_in_flight: int = 32
+    in_flight: int = 0
+    throttled_until: float = 0.0
+    consecutive_throttles: int = 0
+    request_bucket: TokenBucket = field(init=False)
+    token_bucket: TokenBucket = field(init=False)
+
+    def __post_init__(self):
+        self.request_bucket = TokenBucket(self.requests_per_minute)
+        self.token_bucket = TokenBucket(self.input_tokens_per_minute)
+
+    @property
+    def name(self) -> str:
+        return self.client.model_key
+
+    def wait_time(self, input_tokens: int) -> float:
+        """Seconds until this lane can admit a request of `input_tokens`."""
+        if self.in_flight >= self.max_in_flight:
+            # Re-checked as soon as any request on the lane finishes
+            return float("inf")
+        return max(
+            self.throttled_until - monotonic(),
+            self.request_bucket.wait_time(1),
+            self.token_bucket.wait_time(input_tokens),
+            0.0,
+        )
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ExtractionScheduler:
+    def __init__(self, lanes: list[ProviderLane], max_attempts: int = 6):
+        if not lanes:
+            raise ValueError("ExtractionScheduler needs at least one provider lane")
+        self.lanes = lanes
+        self.max_attempts = max_attempts
+        self._lane_released: Optional[asyncio.Event] = None
+
+    async def _acquire_lane(self, input_tokens: int) -> ProviderLane:
+        """Wait for the first lane able to take the request and reserve budget on it."""
+        if self._lane_released is None:
+            self._lane_released = asyncio.Event()
+        while True:
+            # Lanes earlier in the list are preferred when several are ready
+            lane = min(self.lanes, key=lambda lane: lane.wait_time(input_tokens))
+            wait = lane.wait_time(input_tokens)
+            if wait == 0:
+                lane.in_flight += 1
+                lane.request_bucket.take(1)
+                lane.token_bucket.take(input_tokens)
+                return lane
+            self._lane_released.clear()
+            try:
+                await asyncio.wait_for(
+                    self._lane_released.wait(), None if wait == float("inf") else wait
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def _release_lane(self, lane: ProviderLane) -> None:
+        lane.in_flight -= 1
+        self._lane_released.set()
+
+    async def extract(self, image_base64_list: list[PageContent]) -> Optional[Dict[str, Any]]:
+        """Extract one document, retrying and failing over between providers.
+
+        Returns None when the error is not retryable or every attempt failed.
+        """
+        input_tokens = estimate_input_tokens(image_base64_list)
+        for attempt in range(self.max_attempts):
+            lane = await self._acquire_lane(input_tokens)
+            retry_delay = 0.0
+            try:
+                result = await lane.client.extract_invoice_data_async(
+                    image_base64_list, raise_errors=True
+                )
+            except Exception as e:
+                kind, retry_after = lane.client.classify_error(e)
+                # On stderr, away from batch.py's summary and worker.py's JSON records
+                print(f"{lane.name} request failed ({kind}, attempt {attempt + 1}): {e}", file=sys.stderr)
+                # Nothing was processed, so the reserved input budget is returned
+                lane.token_bucket.give_back(input_tokens)
+                if kind == "fatal":
+                    return None
+                if kind == "throttle":
+                    # Cool the lane down so other work spills over to the other provider
+                    lane.consecutive_throttles += 1
+                    cool_down = retry_after if retry_after is not None else backoff_delay(
+                        lane.consecutive_throttles
+                    )
+                    lane.throttled_until = max(lane.throttled_until, monotonic() + cool_down)
+                else:
+                    retry_delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                result = e
+            finally:
+                self._release_lane(lane)
+
+            if isinstance(result, Exception):
+                if retry_delay:
+                    await asyncio.sleep(retry_delay)
+                continue
+
+            lane.consecutive_throttles = 0
+            if result is None:
+                return None
+            usage = result.get("usage", {})
+            if "input_tokens" in usage:
+                # Prompt cache writes and reads are still input, as in the estimate
+                actual_tokens = (
+                    usage["input_tokens"]
+                    + usage.get("cache_creation_input_tokens", 0)
+                    + usage.get("cache_read_input_tokens", 0)
+                )
+                # Settle the difference between the estimate and the actual usage
+                if actual_tokens > input_tokens:
+                    lane.token_bucket.take(actual_tokens - input_tokens)
+                else:
+                    lane.token_bucket.give_back(input_tokens - actual_tokens)
+            result["provider"] = lane.name
+            return result
+        return None
+
+    async def extract_many(self, documents: list[list[PageContent]]) -> list[Optional[Dict[str, Any]]]:
+        """Extract many documents concurrently, returning results in input order."""
+        return await asyncio.gather(*(self.extract(images) for images in documents))
+
+
+class ScheduledClient:
+    """Synchronous stand-in for a client that sends every request through a scheduler.
+
+    Offers `extract_invoice_data` like the clients, so it can be passed to
+    `extract_invoice_data_chunked` and called from many threads at once. The
+    scheduler runs on its own event loop thread, which `close` stops.
+    """
+
+    def __init__(self, scheduler: ExtractionScheduler):
+        self.scheduler = scheduler
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="extraction-scheduler", daemon=True)
+        self._thread.start()
+
+    @property
+    def model_key(self) -> str:
+        return "+".join(lane.name for lane in self.scheduler.lanes)
+
+    def extract_invoice_data(self, image_base64_list: list[PageContent]) -> Optional[Dict[str, Any]]:
+        """Extract through the scheduler, blocking until a lane has answered or every attempt failed."""
+        return asyncio.run_coroutine_threadsafe(self.scheduler.extract(image_base64_list), self._loop).result()
+
+    def close(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
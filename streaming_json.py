@@ -0,0 +1,130 @@
+import json
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+
+class InvoiceStreamParser:
+    """Incremental parser for the extraction response as it streams in.
+
+    Text is fed in arbitrary chunks. `feed` yields ("document_type", value)
+    as soon as the classification is complete, and ("invoice", dict) for every
+    object in the top-level "invoices" list as soon as its closing brace
+    arrives. Anything before the first "{" (prose, a ```json fence) is
+    ignored. `result` returns what has been parsed so far, so a stream that
+    ends early still keeps every invoice that was completed.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.finished = False
+        # State for the keys and values of the top-level object
+        self.string_start = 0
+        self.current_key: Optional[str] = None
+        self.expecting_value = False
+        self.in_invoices = False
+        self.invoice_start: Optional[int] = None
+
+        self.document_type: Optional[str] = None
+        self.invoices: list[Dict[str, Any]] = []
+
+    def feed(self, text: str) -> Iterator[Tuple[str, Any]]:
+        self.buffer += text
+        while self.position < len(self.buffer) and not self.finished:
+            char = self.buffer[self.position]
+            index = self.position
+            self.position += 1
+
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        event = self._top_level_string(self.buffer[self.string_start:index + 1])
+                        if event:
+                            yield event
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = index
+            elif char == ":" and self.depth == 1:
+                self.expecting_value = True
+            elif char == "," and self.depth == 1:
+                self.expecting_value = False
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 2 and char == "[" and self.current_key == "invoices":
+                    self.in_invoices = True
+                elif self.depth == 3 and char == "{" and self.in_invoices:
+                    self.invoice_start = index
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 2 and char == "}" and self.invoice_start is not None:
+                    invoice = self._parse_invoice(self.buffer[self.invoice_start:index + 1])
+                    self.invoice_start = None
+                    if invoice is not None:
+                        self.invoices.append(invoice)
+                        yield "invoice", invoice
+                elif self.depth == 1:
+                    self.in_invoices = False
+                    self.expecting_value = False
+                elif self.depth == 0:
+                    self.finished = True
+
+    def _top_level_string(self, token: str) -> Optional[Tuple[str, Any]]:
+        value = json.loads(token)
+        if not self.expecting_value:
+            self.current_key = value
+            return None
+        self.expecting_value = False
+        if self.current_key == "document_type":
+            self.document_type = value
+            return "document_type", value
+        return None
+
+    @staticmethod
+    def _parse_invoice(text: str) -> Optional[Dict[str, Any]]:
+        try:
+            invoice = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return invoice if isinstance(invoice, dict) else None
+
+    @property
+    def truncated(self) -> bool:
+        """True if the top-level object was never closed."""
+        return not self.finished
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """The parsed result so far, or None if nothing usable arrived."""
+        if self.document_type is None and not self.invoices:
+            return None
+        result = {"document_type": self.document_type or "other", "invoices": self.invoices}
+        if self.truncated:
+            result["truncated"] = True
+        return result
+
+
+def parse_partial_response(text: str) -> Optional[Dict[str, Any]]:
+    """Parse a whole response that may have been cut off, e.g. at max_tokens.
+
+    Every invoice completed before the cut is kept and the result is marked
+    "truncated" as in `InvoiceStreamParser.result`.
+    """
+    parser = InvoiceStreamParser()
+    for _ in parser.feed(text):
+        pass
+    return parser.result()
@@ -0,0 +1,135 @@
+"""Minimal extraction worker, without the Streamlit UI.
+
+Usage:
+    python worker.py invoice.pdf other.pdf --provider anthropic
+    find inbox -name "*.pdf" | python worker.py --provider bedrock --triage
+
+Extracts each PDF in this process and prints one JSON line per document to
+stdout; diagnostics go to stderr. Without paths on the command line, paths
+are read from stdin one per line as they arrive, so a long-running worker
+can be fed from a queue.
+
+Importing this module loads the PDF renderer and the extraction pipeline
+only: the provider SDK is imported when its client is created, and OpenCV,
+pandas and pyarrow when a page or a response first needs them.
+`python benchmark.py --scenarios import` measures the import time against
+its budget.
+"""
+import argparse
+import json
+import sys
+from contextlib import redirect_stdout
+from time import time
+from typing import Any, Dict, Iterable, Optional
+
+from extraction import apply_triage, extract_invoice_data_adaptive, extract_invoice_data_chunked, result_status
+from image_processor import iter_image_from_pdf, kept_page_numbers, triage_pdf_pages
+from metrics import configure_from_env
+
+PROVIDERS = ("anthropic", "bedrock")
+
+
+def make_client(
+    provider: str, prompt_caching: bool = False, tool_output: bool = False, max_retries: Optional[int] = None
+):
+    """Build the extraction client for a provider name, importing only its SDK.
+
+    `max_retries` overrides the client's own retries, e.g. 0 when a
+    scheduler handles them.
+    """
+    options = {"prompt_caching": prompt_caching, "tool_output": tool_output}
+    if max_retries is not None:
+        options["max_retries"] = max_retries
+    if provider == "anthropic":
+        from anthropic_client import AnthropicClient
+
+        return AnthropicClient(**options)
+    if provider == "bedrock":
+        from bedrock_client import BedrockClient
+
+        return BedrockClient(**options)
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+def process_document(
+    client, pdf_bytes: bytes, triage: bool = False, validate: bool = False
+) -> Optional[Dict[str, Any]]:
+    """Extract one PDF, streaming its pages through the renderer.
+
+    Long documents are extracted in page windows (see
+    `extract_invoice_data_chunked`). With `triage`, blank, duplicate and
+    boilerplate pages are skipped and listed on the result. With `validate`,
+    the pages behind invoices that fail validation are requested again (see
+    `extract_invoice_data_adaptive`). Errors are printed and None is returned.
+    """
+    try:
+        page_triage = triage_pdf_pages(pdf_bytes) if triage else None
+        if validate:
+            return extract_invoice_data_adaptive(client, pdf_bytes, page_triage=page_triage, max_workers=1)
+        page_numbers = kept_page_numbers(page_triage) if triage else None
+        result = extract_invoice_data_chunked(client, iter_image_from_pdf(pdf_bytes, page_numbers=page_numbers))
+        if triage:
+            result = apply_triage(result, page_triage)
+    except Exception as e:
+        print(f"Error processing PDF: {str(e)}", file=sys.stderr)
+        return None
+    return result
+
+
+def process_paths(client, paths: Iterable[str], triage: bool = False, validate: bool = False) -> int:
+    """Extract every path and print a JSON line for each; returns the number that failed.
+
+    Only the records go to stdout: anything the clients and the pipeline
+    print while extracting is sent to stderr.
+    """
+    records = sys.stdout
+    failed = 0
+    for path in paths:
+        start_time = time()
+        record: Dict[str, Any] = {"source": path}
+        try:
+            with open(path, "rb") as f, redirect_stdout(sys.stderr):
+                result = process_document(client, f.read(), triage, validate)
+        except OSError as e:
+            result = None
+            record["error"] = str(e)
+        if result is None:
+            failed += 1
+            record.setdefault("error", "extraction failed")
+            record["status"] = "error"
+        else:
+            record.update(
+                status=result_status(result),
+                latency_seconds=round(time() - start_time, 3),
+                result=result,
+            )
+        print(json.dumps(record), file=records, flush=True)
+    return failed
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="PDF files; read from stdin when none are given")
+    parser.add_argument("--provider", choices=PROVIDERS, default="anthropic")
+    parser.add_argument(
+        "--triage",
+        action="store_true",
+        help="Skip blank, duplicate and boilerplate pages instead of sending them to the model",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check totals and line items locally and request the pages of failing invoices again",
+    )
+    parser.add_argument("--prompt-caching", action="store_true")
+    parser.add_argument("--tool-output", action="store_true")
+    args = parser.parse_args(argv)
+
+    configure_from_env()
+    client = make_client(args.provider, args.prompt_caching, args.tool_output)
+    paths = args.paths or (line.strip() for line in sys.stdin if line.strip())
+    return 1 if process_paths(client, paths, args.triage, args.validate) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())